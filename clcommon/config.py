@@ -18,6 +18,8 @@ This module provides functions to handle loading and working with
 configuration from various sources. Configuration objects are nested
 dictionaries that can be updated to provide multiple versions if
 needed. All configuration should start with some default dictionary.
+Updated configuration is immutable, so it can be shared between threads
+and forked processes without copying.
 
 Most applications will want to call load() with a default config and
 use the resulting configuration, but other functions are available for
@@ -44,13 +46,27 @@ values in configuration files.
 
 All config files are JSON files for ease to use across languages and via
 HTTP. Any lines in configuration files that begin with any whitespace
-and then a '#' will be removed during parsing to allow for comments.'''
+and then a '#' will be removed during parsing to allow for comments.
+
+Parsed files are cached by path along with their modification time, size,
+and inode, so loading the same files again, such as when reloading, only
+parses files that changed. Directories also keep the result of merging
+their files, which is reused when none of them changed.
+
+Config returned by update() and the load functions is a Config object,
+which is a dict that raises a TypeError when modified. Lists become
+tuples. Updating config only copies the dicts along the paths that
+changed, and the rest of the tree is shared with the original. Config
+dicts with the same contents are also shared, so loading the same values
+again gives the same objects.'''
 
 import json
 import inspect
 import optparse
 import os.path
+import re
 import sys
+import weakref
 
 import clcommon
 
@@ -58,6 +74,11 @@ VALID_JSON_BYTES = dict((str(byte), None) for byte in ['[', '{', '"'])
 VALID_JSON_NUMBERS = dict((str(byte), None) for byte in range(10) + ['-'])
 VALID_JSON_WORDS = dict((word, None) for word in ['true', 'false', 'null'])
 
+_COMMENT = re.compile(r'^[^\S\n]*#[^\n]*', re.MULTILINE)
+_file_cache = {}
+_dir_cache = {}
+_interned = weakref.WeakValueDictionary()
+
 
 def load(config, config_files=None, config_dirs=None, expect_args=True,
         args=None):
@@ -93,14 +114,16 @@ def load(config, config_files=None, config_dirs=None, expect_args=True,
         print str(exception)
         exit(1)
 
+    overrides = {}
     for option in get_options(config):
         value = getattr(options, option, None)
         if value is not None:
             try:
-                config = update_option(config, option, value)
+                _set_option(overrides, option, parse_value(value))
             except Exception, exception:
                 print _('Error parsing option: %s (%s)') % (option, exception)
                 exit(1)
+    config = update(config, overrides)
     if options.debug:
         config = update(config,
             dict(clcommon=dict(log=dict(console=True, level='DEBUG'))))
@@ -161,47 +184,136 @@ def parse_value(value):
 
 def load_file(config, config_file):
     '''Load a JSON file into the given config, stripping out comments.'''
-    config_fd = open(os.path.expanduser(config_file))
-    config_data = ''
-    while True:
-        line = config_fd.readline()
-        if line == '':
-            break
-        if line.lstrip()[:1] == '#':
-            line = '\n'
-        config_data += line
+    return update(config, _parse_file(config_file))
+
+
+def load_dir(config, config_dir):
+    '''Load a directory of JSON files in sorted order into the given config.
+    The merged files are reused if none of them changed since the last
+    time the directory was loaded.'''
+    path = os.path.expanduser(config_dir)
+    fragments = [_parse_file(os.path.join(config_dir, config_file))
+        for config_file in sorted(os.listdir(path))]
+    cached = _dir_cache.get(path)
+    if cached is not None and len(cached[0]) == len(fragments) and \
+            all(old is new for old, new in zip(cached[0], fragments)):
+        merged = cached[1]
+    else:
+        merged = update({}, *fragments)
+        _dir_cache[path] = (fragments, merged)
+    return update(config, merged)
+
+
+def _parse_file(config_file):
+    '''Parse a JSON config file with a single read, stripping out comments.
+    The last result is returned if the file has not changed.'''
+    path = os.path.expanduser(config_file)
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size, stat.st_ino)
+    cached = _file_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    config_fd = open(path)
+    try:
+        config_data = _COMMENT.sub('', config_fd.read())
+    finally:
+        config_fd.close()
     try:
-        config = update(config, json.loads(config_data))
+        parsed = json.loads(config_data)
+        if not isinstance(parsed, dict):
+            raise ValueError(_('Config must be an object'))
+        parsed = freeze(parsed)
     except Exception, exception:
         raise ConfigError(_('Could not parse config file: %s (%s)') %
             (config_file, exception))
-    return config
+    _file_cache[path] = (key, parsed)
+    return parsed
 
 
-def load_dir(config, config_dir):
-    '''Load a directory of JSON files in sorted order into the given config.'''
-    config_files = os.listdir(os.path.expanduser(config_dir))
-    config_files.sort()
-    for config_file in config_files:
-        config = load_file(config, os.path.join(config_dir, config_file))
-    return config
+def clear_cache():
+    '''Forget all parsed files so they are loaded again.'''
+    _file_cache.clear()
+    _dir_cache.clear()
 
 
 def update(config, *new_configs):
-    '''Update the given config with a new one, copying if needed to ensure
-    the original config dict passed in is not modified.'''
-    copied = False
+    '''Update the given config with new ones in order, merging nested
+    dicts. The original config is not modified, and the result is an
+    immutable Config that shares every dict that did not change with the
+    original, so an update only copies the dicts along its changed paths.'''
+    config = freeze(config)
     for new_config in new_configs:
-        for key, value in new_config.iteritems():
-            if isinstance(value, dict) and key in config:
-                value = update(config[key], value)
-            if not copied:
-                config = config.copy()
-                copied = True
-            config[key] = value
+        config = _update(config, new_config)
+    return config
+
+
+def _update(config, new_config):
+    '''Update a frozen config with a new one, returning the original
+    config if nothing changed.'''
+    changes = {}
+    for key, value in new_config.iteritems():
+        current = config.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            value = _update(current, value)
+        else:
+            value = freeze(value)
+        if key not in config or current is not value:
+            changes[key] = value
+    if not changes:
+        return config
+    # Only the keys of changed values are computed, the rest of the
+    # interned key is copied from the original config.
+    old = [(key, _key(config[key])) for key in changes if key in config]
+    new = [(key, _key(value)) for key, value in changes.iteritems()]
+    return _intern(config._interned_key.difference(old).union(new), config,
+        changes)
+
+
+def freeze(value):
+    '''Get an immutable version of a config value. Dicts become Config
+    objects and lists become tuples. Frozen values are returned as is.'''
+    if isinstance(value, Config) and hasattr(value, '_interned_key'):
+        return value
+    if isinstance(value, dict):
+        items = dict((key, freeze(item)) for key, item in value.iteritems())
+        return _intern(frozenset((key, _key(item))
+            for key, item in items.iteritems()), items)
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def _intern(key, items, changes=()):
+    '''Get the shared Config for an interned key, creating it from a dict
+    of frozen values and changes to them if there is not one. Creating a
+    duplicate when called from multiple threads is harmless, so no lock is
+    used and forking is always safe.'''
+    config = _interned.get(key)
+    if config is None:
+        config = Config(items)
+        dict.update(config, changes)
+        config._interned_key = key
+        _interned[key] = config
     return config
 
 
+def _key(value):
+    '''Get a key for a frozen value that only matches identical values.
+    Values like 1, 1.0, and True are equal in Python, so the type is part
+    of the key. Config objects are interned, so they match by identity.'''
+    if isinstance(value, Config):
+        return id(value)
+    if isinstance(value, tuple):
+        return (tuple, tuple(_key(item) for item in value))
+    if isinstance(value, float):
+        return (float, repr(value))
+    try:
+        hash(value)
+    except TypeError:
+        return (type(value), id(value))
+    return (type(value), value)
+
+
 def get_options(config, prefix=None):
     '''Get a flat list of options in the given config using dot notation
     (a.b.c) to separate nested dict keys.'''
@@ -215,6 +327,15 @@ def get_options(config, prefix=None):
             yield '.'.join(parts)
 
 
+def _set_option(config, name, value):
+    '''Set a value in a mutable nested dict using dot notation for the
+    name, creating dicts for each part as needed.'''
+    parts = name.split('.')
+    for part in parts[:-1]:
+        config = config.setdefault(part, {})
+    config[parts[-1]] = value
+
+
 def update_option(config, name, value):
     '''Update a single value in the given config using dot notation (a.b.c)
     for the name, where each part in the name becomes a nested dict key.'''
@@ -244,6 +365,31 @@ def method_help(method):
     return '%s%s' % (method.__name__, args)
 
 
+class Config(dict):
+    '''Immutable config dict created by update() and freeze(). Reading
+    works like any other dict, but methods that would modify it raise a
+    TypeError. Use update() to get a modified version, or copy() to get a
+    mutable dict with the same frozen values.'''
+
+    __slots__ = ('__weakref__', '_interned_key')
+
+    def _immutable(self, *_args, **_kwargs):
+        '''Raise an error for any attempt to modify the config.'''
+        raise TypeError(_('Config can not be modified, use update()'))
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, _memo):
+        return self
+
+    def __reduce__(self):
+        return freeze, (dict(self),)
+
+
 class ConfigError(Exception):
     '''Exception raised when an error is encountered while checking config.'''
 
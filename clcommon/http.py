@@ -18,41 +18,170 @@ This module provides a class to manage HTTP servers, a convenience request
 handling class, and exception classes for HTTP error responses. This is
 built on top of the gevent WSGI server and can call other WSGI handlers
 within the request module. This module also provides some helper classes
-for dealing with httplib request and response bodies.
+for dealing with httplib request and response bodies, and a client class
+that keeps pools of persistent connections to other HTTP servers.
 
 The gevent setup for the server is delayed until it is actually being
 started because gevent is not designed to handle being forked after it has
 been initialized. The server object can be used to create multiple gevent
 processes for the same listening socket by having a parent process create
 the server object (which creates the listening socket), fork multiple
-children, and call the server start method in each child.'''
-
-import Cookie
+children, and call the server start method in each child. The listening
+socket comes from clcommon.server.listen so it can also be handed to a new
+version of the server when it is restarted.
+
+An in-memory response cache can be enabled for each child by setting
+cache_size to the maximum number of bytes to keep cached. Only GET and HEAD
+requests are cached, keyed on the method, path, query string, and the
+request headers listed in cache_vary. Successful responses are cached using
+the max-age and stale-while-revalidate values from their Cache-Control
+header, falling back to the cache_ttl and cache_stale options, and s-maxage
+takes precedence over max-age. Responses that are private, no-store,
+no-cache, that set cookies, or that vary on headers not in cache_vary are
+never cached. Requests with an Authorization or Cookie header not in
+cache_vary only use and store responses that are public or have s-maxage.
+Least recently used responses are evicted first when the cache is full.
+Requests with Cache-Control no-cache skip the cache lookup and refresh the
+cached response. Once a response is past its TTL but still within its stale
+window, the stale response is returned while a new one is generated in the
+background.
+
+The number of requests each child runs concurrently can be limited by
+setting max_requests. Requests over the limit wait their turn in a queue of
+up to queue_size requests for at most queue_timeout seconds, and requests
+that can't be queued or time out get a 503 response with a Retry-After
+header of retry_after seconds. A request holds its place until the request
+method returns, so responses with streaming bodies are only counted while
+they are being set up.
+
+Request counts, status counts, bytes in and out, and a latency histogram in
+microseconds are kept for each route. Routes are the longest matching
+prefix from stats_routes, or the first path segment if no routes are
+configured, with anything past stats_max_routes counted as other. If
+stats_path is set, requests for it return the stats for the child as JSON.
+If stats_dir is set, each child saves its stats there every stats_interval
+seconds, and stats_path?all=1 returns the totals for all children. The
+parent can get the same totals with clcommon.stats.load_dir. Server
+counters are kept in a clcommon.stats.Counters object, so a
+clcommon.server.Server parent can also total them through shared memory
+without a stats directory.
+
+Access log lines are written as each request finishes by default. If
+access_log is set to buffered, the fields for each request are saved and
+then formatted and written in batches by a separate greenlet, either once
+access_log_buffer requests are saved or every access_log_interval seconds.
+Only the access_log_sample fraction of requests are logged. If the log
+handlers are too slow and access_log_pending batches are already waiting,
+new batches are dropped instead of blocking. Saved records are written when
+the server stops.
+
+Connections are closed if the client takes longer than idle_timeout seconds
+to send the request line, or header_timeout seconds to send the rest of the
+headers after it. Each read or write of the request or response body can
+take at most body_timeout seconds, and requests that time out reading the
+body from Request.body get a 408 response. Connections are also closed
+after connection_requests requests if it is set. Any of these can be
+disabled with a value of 0.
+
+Requests can set and check signed cookies if cookie_secret is set. It can
+also be a list of secrets to allow for rotation, in which case the first
+one is used to sign and all of them are checked.
+
+Stopping the server drains it first. New connections are no longer
+accepted, idle keep-alive connections are closed, and connections with
+requests in progress are closed once their current response is sent. The
+stop timeout limits how long to wait for them.
+
+The warmup method sets up the WSGI server and runs a GET request for each
+of warmup_paths before any connections are accepted, so imports, lazily
+built data, and the response cache are ready for the first real requests.
+Warmup requests are not counted in route stats.'''
+
+import collections
+import datetime
+import email.utils
 import errno
+import functools
+import hashlib
+import hmac
+import httplib
 import json
+import logging
 import mimetypes
 import os
+import random
+import re
+import select
 import socket
+import time
 import traceback
+import urlparse
 
 import clcommon.log
 import clcommon.server
+import clcommon.stats
 
 DEFAULT_CONFIG = {
     'clcommon': {
         'http': {
+            'access_log': 'sync',
+            'access_log_buffer': 100,
+            'access_log_interval': 1,
+            'access_log_pending': 10,
+            'access_log_sample': 1.0,
             'backlog': 64,
+            'body_timeout': 30,
+            'cache_size': 0,
+            'cache_stale': 0,
+            'cache_ttl': 0,
+            'cache_vary': [],
+            'connection_requests': 0,
+            'cookie_secret': None,
+            'header_timeout': 10,
             'host': '',
+            'idle_timeout': 60,
             'log_level': 'NOTSET',
+            'max_requests': 0,
             'port': 8080,
-            'server_name': 'craigslist/%s' % clcommon.__version__}}}
+            'queue_size': 0,
+            'queue_timeout': 1,
+            'retry_after': 1,
+            'server_name': 'craigslist/%s' % clcommon.__version__,
+            'stats_dir': None,
+            'stats_interval': 10,
+            'stats_max_routes': 100,
+            'stats_path': None,
+            'stats_routes': [],
+            'warmup_paths': []},
+        'http_client': {
+            'buffer_size': 65536,
+            'coalesce': False,
+            'connect_timeout': 1,
+            'idle_timeout': 30,
+            'log_level': 'NOTSET',
+            'pool_size': 8,
+            'timeout': 10}}}
+
+_CONTENT_TYPES = {}
+_CREDENTIALS = ['HTTP_AUTHORIZATION', 'HTTP_COOKIE']
+_DEFAULT_HEADERS = [('Content-Type', 'text/plain')]
+_IDEMPOTENT_METHODS = ['DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT']
+_COOKIE_LEGAL = re.compile(r"^[A-Za-z0-9!#$%&'*+\-.^_`|~:]*$")
+_COOKIE_NAME = re.compile(r"^[A-Za-z0-9!#$%&'*+\-.^_`|~]+$")
+_COOKIE_ESCAPES = dict((chr(byte), '\\%03o' % byte)
+    for byte in range(32) + range(127, 256) + [ord(';'), ord(',')])
+_COOKIE_ESCAPES.update({'"': '\\"', '\\': '\\\\'})
+_COOKIE_UNESCAPE = re.compile(r'\\(?:([0-3][0-7][0-7])|(.))')
 
 JQUERY = os.path.join(os.path.dirname(__file__), 'jquery.js')
 FAVICON = os.path.join(os.path.dirname(__file__), 'favicon.ico')
 
 
 class Server(object):
-    '''HTTP server class.'''
+    '''HTTP server class. This wraps the gevent WSGI server with a response
+    cache, admission control, per-route stats, a buffered access log,
+    connection timeouts, signed cookies, draining, and warmup requests,
+    all configured from the clcommon.http config section.'''
 
     def __init__(self, config, request):
         self.config = config
@@ -61,27 +190,180 @@ class Server(object):
         self.log = clcommon.log.get_log('clcommon_http_server',
             config['log_level'])
         self.env = {'SERVER_SOFTWARE': str(config['server_name'])}
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.bind((config['host'], config['port']))
-        self._socket.listen(config['backlog'])
+        self.headers = Headers([('Server', self.env['SERVER_SOFTWARE'])])
+        cookie_secret = config['cookie_secret'] or []
+        if isinstance(cookie_secret, basestring):
+            cookie_secret = [cookie_secret]
+        self.cookie_keys = [hmac.new(str(secret), digestmod=hashlib.sha256)
+            for secret in cookie_secret]
+        self._responses = {}
+        self._socket = clcommon.server.listen(config['host'],
+            config['port'], config['backlog'])
         self._server = None
+        self._handler_class = None
+        self._handlers = set()
+        self._draining = False
+        self._drained = None
+        self.stats = clcommon.stats.Counters(['access_log_dropped',
+            'access_log_sampled', 'access_log_written', 'admission_active',
+            'admission_limit', 'admission_queued', 'admission_rejected',
+            'admission_timeout', 'admission_waited', 'cache_evict',
+            'cache_hit', 'cache_miss', 'cache_stale', 'cache_store',
+            'connections', 'connections_active', 'reaped_body',
+            'reaped_header', 'reaped_idle', 'reaped_requests', 'requests'])
+        self._admission = None
+        self._admitted = 0
+        self._max_requests = config['max_requests']
+        self.stats['admission_limit'] = max(self._max_requests, 0)
+        self._queue_size = config['queue_size']
+        self._queue_timeout = config['queue_timeout']
+        self._unavailable = ServiceUnavailable(
+            headers=[('Retry-After', str(config['retry_after']))])
+        self.routes = {}
+        self._stats_dir = config['stats_dir']
+        self._stats_interval = config['stats_interval']
+        self._stats_max_routes = config['stats_max_routes']
+        self._stats_path = config['stats_path']
+        self._stats_routes = sorted(config['stats_routes'], key=len,
+            reverse=True)
+        self._stats_saver = None
+        self._warmup_paths = config['warmup_paths']
+        self._access_log = None
+        self._access_log_flusher = None
+        self._cache = None
+        if config['cache_size'] > 0:
+            self._cache = _Cache(config['cache_size'], self.stats)
+        self._cache_stale = config['cache_stale']
+        self._cache_ttl = config['cache_ttl']
+        self._cache_vary = ['HTTP_%s' % name.upper().replace('-', '_')
+            for name in config['cache_vary']]
 
     def _start_server(self):
-        '''Start server using listening socket created in __init__.'''
-        log = {
-            'access': self.log,
-            'error': self.log}
-
+        '''Setup the WSGI handler class used for each connection.'''
+        import gevent
+        import gevent.event
         import gevent.pywsgi
+        http_server = self
         server_log = self.log
+        stats = self.stats
+        config = self.config['clcommon']['http']
+        if config['access_log'] == 'buffered':
+            self._access_log = _AccessLog(self.log, self.stats,
+                config['access_log_buffer'], config['access_log_pending'],
+                config['access_log_sample'])
+        access_log = self._access_log
+        body_timeout = config['body_timeout'] or None
+        connection_requests = config['connection_requests']
+        header_timeout = config['header_timeout']
+        idle_timeout = config['idle_timeout']
 
         class WSGIHandler(gevent.pywsgi.WSGIHandler):
-            '''Wrapper to do custom logging in HTTP server.'''
+            '''Wrapper to do custom logging and enforce client timeouts in
+            HTTP server.'''
+
+            requests = 0
+            idle = False
+
+            def set_timeout(self, timeout):
+                '''Set the socket timeout for reads and writes. The file
+                object for reading has its own copy of the socket, so it
+                must be set on both.'''
+                self.socket.settimeout(timeout)
+                self.rfile._sock.settimeout(timeout)
+
+            def handle(self):
+                '''Count and track the connection while it is being
+                handled so it can be drained.'''
+                stats['connections'] += 1
+                stats['connections_active'] += 1
+                http_server._handlers.add(self)
+                try:
+                    super(WSGIHandler, self).handle()
+                finally:
+                    stats['connections_active'] -= 1
+                    http_server._handlers.discard(self)
+                    if http_server._draining and not http_server._handlers:
+                        http_server._drained.set()
+
+            def read_requestline(self):
+                '''Read the request line, closing the connection if it
+                doesn't arrive within the idle timeout or the server is
+                draining.'''
+                if http_server._draining:
+                    return ''
+                self.set_timeout(None)
+                timeout = None
+                if idle_timeout:
+                    timeout = gevent.Timeout(idle_timeout)
+                    timeout.start()
+                self.idle = True
+                try:
+                    return super(WSGIHandler, self).read_requestline()
+                except gevent.Timeout, exception:
+                    if exception is not timeout:
+                        raise
+                finally:
+                    self.idle = False
+                    if timeout is not None:
+                        timeout.cancel()
+                stats['reaped_idle'] += 1
+                return ''
+
+            def read_request(self, raw_requestline):
+                '''Read the request headers, failing if they don't arrive
+                within the header timeout. The connection is marked to be
+                closed once it has handled the maximum number of requests
+                or if the server is draining.'''
+                timeout = None
+                if header_timeout:
+                    timeout = gevent.Timeout(header_timeout)
+                    timeout.start()
+                try:
+                    result = super(WSGIHandler, self).read_request(
+                        raw_requestline)
+                except gevent.Timeout, exception:
+                    if exception is not timeout:
+                        raise
+                    stats['reaped_header'] += 1
+                    return False
+                finally:
+                    if timeout is not None:
+                        timeout.cancel()
+                self.set_timeout(body_timeout)
+                self.requests += 1
+                if connection_requests and \
+                        self.requests >= connection_requests:
+                    stats['reaped_requests'] += 1
+                    self.close_connection = True
+                if http_server._draining:
+                    self.close_connection = True
+                return result
+
+            def get_environ(self):
+                '''Add the client socket to the environment so streaming
+                responses can check if the client has gone away.'''
+                env = super(WSGIHandler, self).get_environ()
+                env['clcommon.socket'] = self.socket
+                return env
+
+            def start_response(self, status, headers, exc_info=None):
+                '''Tell the client the connection is being closed if it
+                was closed by the server or the server is draining.'''
+                if http_server._draining:
+                    self.close_connection = True
+                if self.close_connection and \
+                        not header_exists('Connection', headers):
+                    headers = list(headers)
+                    headers.append(('Connection', 'close'))
+                return super(WSGIHandler, self).start_response(status,
+                    headers, exc_info)
 
             def log_request(self):
                 '''Log a request.'''
-                server_log.info(self.format_request())
+                if access_log is not None:
+                    access_log.add(self)
+                elif server_log.isEnabledFor(logging.INFO):
+                    server_log.info(self.format_request())
 
             def log_error(self, msg, *args):
                 '''Log an error.'''
@@ -97,39 +379,381 @@ class Server(object):
                     if exception.errno not in [errno.EPIPE, errno.ECONNRESET]:
                         raise
 
-        self._socket = socket.fromfd(self._socket.fileno(),
-            self._socket.family, self._socket.type, self._socket.proto)
-        self._server = gevent.pywsgi.WSGIServer(self._socket, self, log=log,
-            handler_class=WSGIHandler)
-        self._server.set_environ(self.env)
+        self._handler_class = WSGIHandler
+        self._drained = gevent.event.Event()
+        if self._max_requests > 0:
+            self._admission = collections.deque()
 
     def start(self):
-        '''Start the server. The first time this is called the listening
-        socket is created and the WSGI server is setup.'''
-        if self._server is None:
+        '''Start the server. The first time this is called the WSGI server
+        is setup, and each time a new copy of the listening socket is used
+        so closing it when draining doesn't affect other processes.'''
+        if self._handler_class is None:
             self._start_server()
+        import gevent.pywsgi
+        sock = socket.fromfd(self._socket.fileno(), self._socket.family,
+            self._socket.type, self._socket.proto)
+        self._server = gevent.pywsgi.WSGIServer(sock, self,
+            log=dict(access=self.log, error=self.log),
+            handler_class=self._handler_class)
+        self._server.set_environ(self.env)
+        self._draining = False
         self._server.start()
+        import gevent
+        if self._stats_dir is not None:
+            self._stats_saver = gevent.spawn(self._save_stats)
+        if self._access_log is not None:
+            self._access_log.start()
+            self._access_log_flusher = gevent.spawn(self._flush_access_log)
         self.log.info(_('Listening on %s:%d'), self._server.server_host,
             self._server.server_port)
 
     def stop(self, timeout=None):
-        '''Stop the server.'''
+        '''Stop the server after draining connections. Draining and closing
+        the connections that are left take at most timeout seconds in
+        total.'''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        if not self.drain(timeout):
+            self.log.warning(_('Stopping with %d connections active'),
+                len(self._handlers))
+        if deadline is not None:
+            timeout = max(deadline - time.time(), 0)
         self._server.stop(timeout)
+        if self._stats_saver is not None:
+            self._stats_saver.kill()
+            self._stats_saver = None
+            clcommon.stats.remove(self._stats_dir)
+        if self._access_log_flusher is not None:
+            self._access_log_flusher.kill()
+            self._access_log_flusher = None
+            self._access_log.stop()
+
+    def warmup(self):
+        '''Setup the WSGI server and run the warmup requests.'''
+        if self._handler_class is None:
+            self._start_server()
+        import gevent.pywsgi
+        for path in self._warmup_paths:
+            path, _separator, query = path.partition('?')
+            env = dict(self.env, REQUEST_METHOD='GET', PATH_INFO=path,
+                QUERY_STRING=query, SERVER_PROTOCOL='HTTP/1.1')
+            env['wsgi.input'] = gevent.pywsgi.Input(None, 0)
+            response = []
+
+            def capture(status, headers, exc_info=None):
+                '''Capture the response status.'''
+                response.append(status)
+
+            for _chunk in self._cached(env, capture):
+                pass
+            status = response[0] if response else _('no status')
+            if not status.startswith('2'):
+                self.log.warning(_('Warmup request for %s returned %s'),
+                    path, status)
+
+    def drain(self, timeout=None):
+        '''Stop accepting new connections and wait up to timeout seconds
+        for the connections that are left to finish. Return whether they
+        all finished.'''
+        if self._server is None:
+            return True
+        self._draining = True
+        self._drained.clear()
+        self._server.close()
+        for handler in list(self._handlers):
+            if handler.idle:
+                try:
+                    handler.socket.shutdown(socket.SHUT_RD)
+                except socket.error:
+                    pass
+        if self._handlers:
+            self._drained.wait(timeout)
+        return not self._handlers
+
+    def _flush_access_log(self):
+        '''Flush buffered access log records periodically.'''
+        import gevent
+        interval = self.config['clcommon']['http']['access_log_interval']
+        while True:
+            gevent.sleep(interval)
+            self._access_log.flush()
+
+    def _save_stats(self):
+        '''Save stats for this child periodically.'''
+        import gevent
+        while True:
+            try:
+                clcommon.stats.save(self._stats_dir, self.get_stats())
+            except Exception, exception:
+                self.log.warning(_('Could not save stats: %s'), exception)
+            gevent.sleep(self._stats_interval)
+
+    def get_stats(self):
+        '''Get server counters and route stats for this child.'''
+        routes = {}
+        for route, stats in self.routes.iteritems():
+            stats = dict(stats)
+            stats['status'] = dict(stats['status'])
+            stats['latency_us'] = stats['latency_us'].to_dict()
+            routes[route] = stats
+        return dict(counters=dict(self.stats), routes=routes)
 
     def __call__(self, env, start):
-        '''Entry point for all requests. Wrap all exceptions with an internal
-        server error.'''
+        '''Entry point for all requests. Return stats if requested, and
+        otherwise run the request and record stats for it.'''
+        if self._stats_path is not None and \
+                env.get('PATH_INFO') == self._stats_path:
+            return self._respond_stats(env, start)
+        started = time.time()
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            '''Capture the response status and headers.'''
+            response.extend([status, headers])
+            return start(status, headers, exc_info)
+
+        body = self._admit(env, capture)
+        self._record(env, response, body, time.time() - started)
+        return body
+
+    def _respond_stats(self, env, start):
+        '''Return stats for this child, or for all children if requested
+        and a stats directory is configured.'''
+        if self._stats_dir is not None and \
+                'all=1' in env.get('QUERY_STRING', '').split('&'):
+            stats = clcommon.stats.load_dir(self._stats_dir)
+        else:
+            stats = self.get_stats()
+        start(_('200 Ok'), [('Server', env['SERVER_SOFTWARE']),
+            ('Content-Type', 'application/json')])
+        return [json.dumps(stats, separators=(',', ':'))]
+
+    def _record(self, env, response, body, elapsed):
+        '''Record stats for a request.'''
+        self.stats['requests'] += 1
+        route = self._route(env.get('PATH_INFO') or '/')
+        stats = self.routes.get(route)
+        if stats is None:
+            stats = dict(bytes_in=0, bytes_out=0, requests=0, status={},
+                latency_us=clcommon.stats.Histogram())
+            self.routes[route] = stats
+        stats['requests'] += 1
+        if response:
+            status = response[0][:3]
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            if isinstance(body, list):
+                stats['bytes_out'] += sum(len(chunk) for chunk in body)
+            else:
+                for name, value in response[1]:
+                    if name.lower() == 'content-length':
+                        stats['bytes_out'] += int(value)
+        try:
+            stats['bytes_in'] += int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            pass
+        stats['latency_us'].add(elapsed * 1000000)
+
+    def _route(self, path):
+        '''Get the route name to record stats under for a path.'''
+        for route in self._stats_routes:
+            if path.startswith(route):
+                return route
+        if self._stats_routes:
+            return 'other'
+        route = '/' + path.lstrip('/').split('/', 1)[0]
+        if route not in self.routes and \
+                len(self.routes) >= self._stats_max_routes:
+            return 'other'
+        return route
+
+    def _admit(self, env, start):
+        '''Wait for a free request slot if the number of concurrent
+        requests is limited. Waiting requests get slots in the order they
+        arrived, since a freed slot is handed to the first one in the queue
+        rather than released for any request to take.'''
+        if self._admission is None:
+            return self._cached(env, start)
+        if self._admitted >= self._max_requests or self._admission:
+            if len(self._admission) >= self._queue_size:
+                self.stats['admission_rejected'] += 1
+                return self._respond(env, start, self._unavailable)
+            import gevent.event
+            waiter = gevent.event.Event()
+            self._admission.append(waiter)
+            self.stats['admission_waited'] += 1
+            self.stats['admission_queued'] += 1
+            try:
+                waiter.wait(self._queue_timeout)
+            except:
+                # The slot was handed over just before the request was
+                # killed, so pass it on.
+                if waiter.is_set():
+                    self._release()
+                raise
+            finally:
+                if not waiter.is_set():
+                    self._admission.remove(waiter)
+                    self.stats['admission_queued'] -= 1
+            if not waiter.is_set():
+                self.stats['admission_timeout'] += 1
+                return self._respond(env, start, self._unavailable)
+        else:
+            self._admitted += 1
+        self.stats['admission_active'] += 1
+        try:
+            return self._cached(env, start)
+        finally:
+            self.stats['admission_active'] -= 1
+            self._release()
+
+    def _release(self):
+        '''Hand a request slot to the first waiting request, or free it if
+        none are waiting.'''
+        if self._admission:
+            self._admission.popleft().set()
+            self.stats['admission_queued'] -= 1
+        else:
+            self._admitted -= 1
+
+    def _cached(self, env, start):
+        '''Use the response cache if enabled, otherwise run the request.'''
+        if self._cache is None or \
+                env['REQUEST_METHOD'].upper() not in ['GET', 'HEAD']:
+            return self._run(env, start)
+        cache_control = env.get('HTTP_CACHE_CONTROL', '')
+        if 'no-store' in cache_control:
+            return self._run(env, start)
+        key = (env['REQUEST_METHOD'].upper(), env.get('PATH_INFO'),
+            env.get('QUERY_STRING')) + \
+            tuple(env.get(name) for name in self._cache_vary)
+        if 'no-cache' not in cache_control:
+            entry = self._cache.get(key)
+            if entry is not None and \
+                    (entry.public or not self._private(env)):
+                now = time.time()
+                if now < entry.expires:
+                    self.stats['cache_hit'] += 1
+                    return entry.respond(now, start)
+                if now < entry.stale:
+                    self.stats['cache_stale'] += 1
+                    if not entry.revalidating:
+                        entry.revalidating = True
+                        import gevent
+                        gevent.spawn(self._revalidate, key, dict(env), entry)
+                    return entry.respond(now, start)
+        self.stats['cache_miss'] += 1
+        return self._run_cached(key, env, start)
+
+    def _private(self, env):
+        '''Check if a request has credentials that are not part of the
+        cache key, in which case only public responses can be cached or
+        returned from the cache.'''
+        for name in _CREDENTIALS:
+            if name in env and name not in self._cache_vary:
+                return True
+        return False
+
+    def _revalidate(self, key, env, entry):
+        '''Run a request in the background to replace a stale response.'''
+        try:
+            self._run_cached(key, env, lambda *_args: None)
+        finally:
+            entry.revalidating = False
+
+    def _run_cached(self, key, env, start):
+        '''Run a request and cache the response if possible. Responses
+        that vary on headers not in cache_vary are not cached.'''
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            '''Capture the response status and headers.'''
+            response.extend([status, list(headers)])
+            return start(status, headers, exc_info)
+
+        body = self._run(env, capture)
+        if not isinstance(body, list) or not response or \
+                response[0][:4] != '200 ':
+            return body
+        ttl = self._cache_ttl
+        shared_ttl = None
+        stale = self._cache_stale
+        public = False
+        for name, value in response[1]:
+            name = name.lower()
+            if name == 'set-cookie':
+                return body
+            if name == 'vary':
+                for header in value.split(','):
+                    header = header.strip()
+                    if header and (header == '*' or 'HTTP_%s' %
+                            header.upper().replace('-', '_') not in
+                            self._cache_vary):
+                        return body
+            if name != 'cache-control':
+                continue
+            for directive in value.lower().split(','):
+                directive = directive.strip().split('=', 1)
+                if directive[0] in ['private', 'no-store', 'no-cache']:
+                    return body
+                if directive[0] in ['public', 's-maxage']:
+                    public = True
+                try:
+                    if directive[0] == 'max-age':
+                        ttl = int(directive[1])
+                    elif directive[0] == 's-maxage':
+                        shared_ttl = int(directive[1])
+                    elif directive[0] == 'stale-while-revalidate':
+                        stale = int(directive[1])
+                except (IndexError, ValueError):
+                    pass
+        if not public and self._private(env):
+            return body
+        if shared_ttl is not None:
+            ttl = shared_ttl
+        if ttl > 0:
+            body = [''.join(body)]
+            self._cache.put(key, _CacheEntry(response[0], response[1],
+                body[0], ttl, stale, public))
+            self.stats['cache_store'] += 1
+        return body
+
+    def _run(self, env, start):
+        '''Run the request. Wrap all exceptions with an internal server
+        error.'''
         try:
             return self._request(self, env, start).run()
+        except BodyTimeout, exception:
+            self.stats['reaped_body'] += 1
+            response = exception
         except StatusCode, exception:
             response = exception
         except Exception, exception:
             self.log.error(_('Uncaught exception in request: %s (%s)'),
                 exception, ''.join(traceback.format_exc().split('\n')))
             response = InternalServerError()
+        return self._respond(env, start, response)
+
+    def _respond(self, env, start, response):
+        '''Build a response from a status code exception. Responses for
+        exceptions created without a body or headers are only built once
+        for each status, as long as the headers and body were not changed
+        after the exception was created.'''
+        if response.default and response.headers == _DEFAULT_HEADERS and \
+                response.body == [response.status]:
+            cached = self._responses.get(response.status)
+            if cached is None:
+                headers = Headers(self.headers)
+                headers.extend(response.headers)
+                cached = (tuple(headers), response.body)
+                self._responses[response.status] = cached
+            start(response.status, list(cached[0]))
+            return cached[1]
+        headers = list(response.headers)
         if not header_exists('Server', response.headers):
-            response.headers.insert(0, ('Server', env['SERVER_SOFTWARE']))
-        start(response.status, response.headers)
+            headers.insert(0, ('Server', env['SERVER_SOFTWARE']))
+        start(response.status, headers)
         return response.body
 
 
@@ -149,7 +773,7 @@ class Request(object):
         self._cookies = None
         self.body = Input(self.env.get('wsgi.input'))
         self._body_data = None
-        self.headers = [('Server', self.env['SERVER_SOFTWARE'])]
+        self.headers = Headers(getattr(server, 'headers', ()))
 
     def run(self):
         '''Run the request.'''
@@ -218,21 +842,33 @@ class Request(object):
     @property
     def cookies(self):
         '''Parse the cookie header into a dictionary.'''
-        if self._cookies is not None:
-            return self._cookies
-        self._cookies = {}
-        cookies = self.env.get('HTTP_COOKIE')
-        if cookies is None:
-            return self.cookies
-        for cookie in cookies.split(';'):
-            cookie = cookie.split('=', 1)
-            key = cookie[0].strip()
-            if len(cookie) == 1:
-                self._cookies[key] = None
-            else:
-                self._cookies[key] = cookie[1].strip(' \t"')
+        if self._cookies is None:
+            self._cookies = parse_cookies(self.env.get('HTTP_COOKIE'))
         return self._cookies
 
+    def signed_cookie(self, name, max_age=None):
+        '''Get the value of a cookie set with set_signed_cookie. None is
+        returned if the cookie is missing, the signature is not valid, or
+        it was signed more than max_age seconds ago.'''
+        cookie = self.cookies.get(name)
+        if cookie is None:
+            return None
+        cookie = cookie.rsplit('|', 2)
+        if len(cookie) != 3:
+            return None
+        value, signed, signature = cookie
+        if max_age is not None:
+            try:
+                if int(signed) + max_age < time.time():
+                    return None
+            except ValueError:
+                return None
+        for key in self.server.cookie_keys:
+            if hmac.compare_digest(signature, _sign(key, name, value,
+                    signed)):
+                return value
+        return None
+
     @property
     def body_data(self):
         '''Read and cache the request body.'''
@@ -241,28 +877,31 @@ class Request(object):
         self._body_data = self.body.read()
         return self._body_data
 
-    def set_cookie(self, name, value, expires=None, path=None, domain=None):
+    def set_cookie(self, name, value, expires=None, path=None, domain=None,
+            max_age=None, secure=False, http_only=False, same_site=None):
         '''Set a cookie in the response headers.'''
-        cookie = Cookie.SimpleCookie()
-        cookie[name] = value
-        if expires is not None:
-            cookie[name]['expires'] = expires
-        if path is not None:
-            cookie[name]['path'] = path
-        if domain is not None:
-            cookie[name]['domain'] = path
-        self.headers.append(('Set-Cookie', cookie[name].OutputString()))
+        self.headers.append(('Set-Cookie', format_cookie(name, value, expires,
+            path, domain, max_age, secure, http_only, same_site)))
+
+    def set_signed_cookie(self, name, value, *args, **kwargs):
+        '''Set a cookie with the time and an HMAC signature appended to the
+        value so it can be checked later with signed_cookie. This takes the
+        same arguments as set_cookie. The server must have a cookie_secret
+        and the name can't contain | or ;.'''
+        if not self.server.cookie_keys:
+            raise ValueError(_('Signed cookies need a cookie_secret'))
+        if '|' in name or ';' in name:
+            raise ValueError(_('Invalid signed cookie name: %s') % name)
+        signed = str(int(time.time()))
+        value = '%s|%s|%s' % (value, signed,
+            _sign(self.server.cookie_keys[0], name, value, signed))
+        self.set_cookie(name, value, *args, **kwargs)
 
     def set_content(self, name, body):
         '''Set content type and length if we can. Also encode the body
         into a JSON blob if the body is not a string or is readable.'''
         if hasattr(body, 'read') or isinstance(body, basestring):
-            content_type = mimetypes.guess_type(name)
-            if content_type[0] is None:
-                content_type = 'application/octet-stream'
-            else:
-                content_type = content_type[0]
-            self.headers.append(('Content-type', content_type))
+            self.headers.append(('Content-type', content_type(name)))
             if hasattr(body, 'content_length'):
                 self.headers.append(('Content-Length', body.content_length))
         else:
@@ -277,6 +916,39 @@ class Request(object):
             body = [body]
         return body or ['']
 
+    def stream(self, producer, status=None, events=False, heartbeat=None,
+            queue_size=16):
+        '''Build a streaming response. The producer is called in a new
+        greenlet with a Channel object, and data sent on the channel is
+        written to the client as it arrives using chunked encoding. The
+        producer blocks when queue_size items are waiting to be written,
+        and the response ends when the producer returns. If events is true
+        the response is sent as server-sent events. If heartbeat is given,
+        the client connection is checked after that many seconds without
+        any data, and for events a comment is sent to keep it open. If the
+        client goes away the producer greenlet is killed.'''
+        if events:
+            self.headers.append(('Content-Type', 'text/event-stream'))
+            self.headers.append(('Cache-Control', 'no-cache'))
+        channel = Channel(self.env.get('clcommon.socket'), events, heartbeat,
+            queue_size)
+        import gevent
+        channel.producer = gevent.spawn(self._produce, producer, channel)
+        self._start(status or _('200 Ok'), self.headers)
+        return channel
+
+    def _produce(self, producer, channel):
+        '''Run the producer for a streaming response.'''
+        try:
+            producer(channel)
+        except ClientDisconnected:
+            pass
+        except Exception, exception:
+            self.log.error(_('Uncaught exception in stream: %s (%s)'),
+                exception, ''.join(traceback.format_exc().split('\n')))
+        finally:
+            channel.end()
+
     def ok(self, body=None):
         '''Build a 200 response.'''
         return self.respond(_('200 Ok'), body)
@@ -296,14 +968,17 @@ class StatusCode(Exception):
     status = '000 Undefined'
 
     def __init__(self, body=None, headers=None):
+        self.default = body is None and headers is None
         self.headers = headers or []
         self.body = body or self.status
         if isinstance(self.body, basestring):
             self.body = [self.body]
         if body is None and not header_exists('Content-Type', self.headers):
-            self.headers.append(('Content-Type', 'text/plain'))
-        super(StatusCode, self).__init__(_('status=%s headers=%s') %
-            (self.status, headers))
+            self.headers.extend(_DEFAULT_HEADERS)
+        super(StatusCode, self).__init__(self.status, headers)
+
+    def __str__(self):
+        return _('status=%s headers=%s') % self.args
 
 
 class BadRequest(StatusCode):
@@ -336,6 +1011,19 @@ class MethodNotAllowed(StatusCode):
     status = _('405 Method Not Allowed')
 
 
+class RequestTimeout(StatusCode):
+    '''Exception for a 408 response.'''
+
+    status = _('408 Request Timeout')
+
+
+class BodyTimeout(RequestTimeout):
+    '''Exception raised by Input objects when reading the request body
+    times out, which gives a 408 response.'''
+
+    pass
+
+
 class UnsupportedMediaType(StatusCode):
     '''Exception for a 415 response.'''
 
@@ -348,14 +1036,283 @@ class InternalServerError(StatusCode):
     status = _('500 Internal Server Error')
 
 
+class ServiceUnavailable(StatusCode):
+    '''Exception for a 503 response.'''
+
+    status = _('503 Service Unavailable')
+
+
 def header_exists(name, headers):
-    '''Check to see if a header exists in a list of headers.'''
+    '''Check to see if a header exists in a list of headers, ignoring
+    case.'''
+    if isinstance(headers, Headers):
+        return headers.exists(name)
+    name = name.lower()
     for header in headers:
-        if header[0] == name:
+        if header[0].lower() == name:
             return True
     return False
 
 
+def parse_cookies(header):
+    '''Parse a cookie header into a dictionary. Quoted values are
+    unquoted, and cookies without a value are set to None.'''
+    cookies = {}
+    if header is None:
+        return cookies
+    for cookie in header.split(';'):
+        cookie = cookie.split('=', 1)
+        name = cookie[0].strip()
+        if len(cookie) == 1:
+            cookies[name] = None
+            continue
+        value = cookie[1].strip(' \t')
+        if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            value = _COOKIE_UNESCAPE.sub(_unescape_cookie, value[1:-1])
+        cookies[name] = value
+    return cookies
+
+
+def _unescape_cookie(match):
+    '''Unescape an octal or backslash escape in a quoted cookie value.'''
+    if match.group(1) is not None:
+        return chr(int(match.group(1), 8))
+    return match.group(2)
+
+
+def format_cookie(name, value, expires=None, path=None, domain=None,
+        max_age=None, secure=False, http_only=False, same_site=None):
+    '''Format a Set-Cookie header value. The name must be a token, and the
+    value is quoted if needed. If expires is a number it is the number of
+    seconds from now, otherwise it is used as is.'''
+    if not _COOKIE_NAME.match(name):
+        raise ValueError(_('Invalid cookie name: %s') % name)
+    value = str(value)
+    if not _COOKIE_LEGAL.match(value):
+        value = '"%s"' % ''.join(_COOKIE_ESCAPES.get(char, char)
+            for char in value)
+    cookie = ['%s=%s' % (name, value)]
+    if expires is not None:
+        if isinstance(expires, (int, long, float)):
+            expires = email.utils.formatdate(time.time() + expires,
+                usegmt=True)
+        cookie.append('Expires=%s' % expires)
+    if max_age is not None:
+        cookie.append('Max-Age=%d' % max_age)
+    if path is not None:
+        cookie.append('Path=%s' % path)
+    if domain is not None:
+        cookie.append('Domain=%s' % domain)
+    if secure:
+        cookie.append('Secure')
+    if http_only:
+        cookie.append('HttpOnly')
+    if same_site is not None:
+        cookie.append('SameSite=%s' % same_site)
+    return '; '.join(cookie)
+
+
+def _sign(key, name, value, signed):
+    '''Sign a cookie name, value, and time using a copy of a cached HMAC
+    key object.'''
+    key = key.copy()
+    key.update('%s|%s|%s' % (name, value, signed))
+    return key.hexdigest()
+
+
+def content_type(name):
+    '''Get the content type for a file name, caching the result for each
+    file extension.'''
+    extension = os.path.splitext(name)[1]
+    cached = _CONTENT_TYPES.get(extension)
+    if cached is not None:
+        return cached
+    guessed = mimetypes.guess_type(name)
+    cached = guessed[0] or 'application/octet-stream'
+    if guessed[1] is None:
+        _CONTENT_TYPES[extension] = cached
+    return cached
+
+
+class Headers(list):
+    '''List of (name, value) header tuples that can be passed anywhere a
+    list of headers is expected, but also keeps a count of each lower case
+    header name so checking if a header exists doesn't need to scan the
+    list. Copying a Headers object also copies the counts.'''
+
+    def __init__(self, headers=()):
+        super(Headers, self).__init__(headers)
+        if isinstance(headers, Headers):
+            self._names = dict(headers._names)
+        else:
+            self._names = {}
+            self._count(self, 1)
+
+    def exists(self, name):
+        '''Check to see if a header exists, ignoring case.'''
+        return name.lower() in self._names
+
+    def get(self, name, default=None):
+        '''Get the value of the first header with the given name, ignoring
+        case.'''
+        name = name.lower()
+        if name in self._names:
+            for header in self:
+                if header[0].lower() == name:
+                    return header[1]
+        return default
+
+    def _count(self, headers, change):
+        '''Update the name counts for the given headers.'''
+        for header in headers:
+            name = header[0].lower()
+            count = self._names.get(name, 0) + change
+            if count > 0:
+                self._names[name] = count
+            else:
+                self._names.pop(name, None)
+
+    def append(self, header):
+        self._count([header], 1)
+        super(Headers, self).append(header)
+
+    def insert(self, index, header):
+        self._count([header], 1)
+        super(Headers, self).insert(index, header)
+
+    def extend(self, headers):
+        headers = list(headers)
+        self._count(headers, 1)
+        super(Headers, self).extend(headers)
+
+    def __iadd__(self, headers):
+        self.extend(headers)
+        return self
+
+    def remove(self, header):
+        super(Headers, self).remove(header)
+        self._count([header], -1)
+
+    def pop(self, index=-1):
+        header = super(Headers, self).pop(index)
+        self._count([header], -1)
+        return header
+
+    def __setitem__(self, index, header):
+        if isinstance(index, slice):
+            self._count(self[index], -1)
+            header = list(header)
+            self._count(header, 1)
+        else:
+            self._count([self[index]], -1)
+            self._count([header], 1)
+        super(Headers, self).__setitem__(index, header)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            self._count(self[index], -1)
+        else:
+            self._count([self[index]], -1)
+        super(Headers, self).__delitem__(index)
+
+    def __setslice__(self, start, end, headers):
+        self.__setitem__(slice(start, end), headers)
+
+    def __delslice__(self, start, end):
+        self.__delitem__(slice(start, end))
+
+
+class ClientDisconnected(Exception):
+    '''Exception raised when sending on a channel for a streaming response
+    after the client has gone away.'''
+
+    pass
+
+
+class Channel(object):
+    '''Channel between a producer greenlet and the response body iterator
+    for a streaming response. This is created by Request.stream.'''
+
+    def __init__(self, client_socket, events, heartbeat, queue_size):
+        import gevent.queue
+        self._empty = gevent.queue.Empty
+        self._queue = gevent.queue.Queue(queue_size)
+        self._socket = client_socket
+        self._events = events
+        self._heartbeat = heartbeat
+        self.closed = False
+        self.producer = None
+
+    def send(self, data):
+        '''Send data to the client, blocking if the queue is full.'''
+        if self.closed:
+            raise ClientDisconnected()
+        if data:
+            self._queue.put(data)
+
+    def send_event(self, data, event=None, event_id=None, retry=None):
+        '''Send a server-sent event to the client.'''
+        lines = []
+        if event is not None:
+            lines.append('event: %s' % event)
+        if event_id is not None:
+            lines.append('id: %s' % event_id)
+        if retry is not None:
+            lines.append('retry: %d' % retry)
+        lines.extend('data: %s' % line for line in str(data).split('\n'))
+        lines.extend(['', ''])
+        self.send('\n'.join(lines))
+
+    def end(self):
+        '''End the response once all queued data has been written.'''
+        if not self.closed:
+            self._queue.put(StopIteration)
+
+    def close(self):
+        '''Close the channel, this is called by the server when the
+        response is done or the client has gone away.'''
+        if self.closed:
+            return
+        self.closed = True
+        if self.producer is not None:
+            self.producer.kill(block=False)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        '''Return the next data sent by the producer, checking that the
+        client is still around while waiting.'''
+        while not self.closed:
+            try:
+                data = self._queue.get(timeout=self._heartbeat)
+            except self._empty:
+                if _disconnected(self._socket):
+                    self.close()
+                    break
+                if self._events:
+                    return ':\n\n'
+                continue
+            if data is StopIteration:
+                self.closed = True
+                break
+            return data
+        raise StopIteration
+
+
+def _disconnected(client_socket):
+    '''Check if the client has closed the connection without reading
+    any data that is waiting.'''
+    if client_socket is None:
+        return False
+    try:
+        if not select.select([client_socket], [], [], 0)[0]:
+            return False
+        return client_socket.recv(1, socket.MSG_PEEK) == ''
+    except (select.error, socket.error):
+        return True
+
+
 class Input(object):
     '''Wrapper around WSGI input objecst to ensure we've read the entire
     content length.'''
@@ -366,8 +1323,12 @@ class Input(object):
         self._read = 0
 
     def read(self, length=None):
-        '''Read and return data, checking content length if this is the end.'''
-        data = self._input.read(length)
+        '''Read and return data, checking content length if this is the end.
+        BodyTimeout is raised if the client is too slow to send it.'''
+        try:
+            data = self._input.read(length)
+        except socket.timeout:
+            raise BodyTimeout()
         self._read += len(data)
         if (data == '' or length is None) and \
                 self.content_length is not None and \
@@ -397,21 +1358,34 @@ class Chunk(object):
 
 
 class Stream(object):
-    '''Wrapper around httplib responses that adds an iterator interface.'''
+    '''Wrapper around httplib responses that adds an iterator interface.
+    The complete callback is called once when the response has been read
+    completely.'''
 
     def __init__(self, response, buffer_size, complete=None):
         self._response = response
         self._buffer_size = buffer_size
         self._complete = complete
+        self.status = response.status
         content_length = response.getheader('Content-Length')
         if content_length is not None:
             self.content_length = content_length
 
+    def getheader(self, name, default=None):
+        '''Get a header from the response.'''
+        return self._response.getheader(name, default)
+
+    def getheaders(self):
+        '''Get a list of (name, value) header tuples from the response.'''
+        return self._response.getheaders()
+
     def read(self, size=None):
         '''Read wrapper that calls complete callback if needed when done.'''
         data = self._response.read(size)
         if (size is None or not data) and self._complete is not None:
-            self._complete()
+            complete = self._complete
+            self._complete = None
+            complete()
         return data
 
     def __iter__(self):
@@ -423,3 +1397,432 @@ class Stream(object):
         if not data:
             raise StopIteration
         return data
+
+
+class Client(object):
+    '''HTTP client class that keeps a pool of persistent connections for
+    each host. Responses are returned as Stream objects, and the connection
+    is put back in the pool once the response has been read completely.
+    Responses that are never read to the end simply close their connection
+    when they are garbage collected. At most pool_size idle connections are
+    kept for each host, and idle connections older than idle_timeout are
+    closed instead of being reused. The number of connections in use at
+    once is not limited, since a response that is never read would hold
+    its connection forever, so callers should limit their own concurrency
+    if they need to. This works with gevent as long as monkey patching has
+    been done before requests are made.
+
+    If coalesce is enabled, concurrent GET and HEAD requests for the same
+    URL and headers share a single backend request, and each caller gets
+    its own Stream over the same buffered response body.'''
+
+    def __init__(self, config):
+        self.config = config
+        config = config['clcommon']['http_client']
+        self.log = clcommon.log.get_log('clcommon_http_client',
+            config['log_level'])
+        self._buffer_size = config['buffer_size']
+        self._coalesce = config['coalesce']
+        self._connect_timeout = config['connect_timeout']
+        self._idle_timeout = config['idle_timeout']
+        self._pool_size = config['pool_size']
+        self._timeout = config['timeout']
+        self._pools = {}
+        self._in_flight = {}
+
+    def request(self, method, url, body=None, headers=None):
+        '''Perform a request and return a Stream for the response. If a
+        pooled connection was closed by the server, requests with idempotent
+        methods are retried once on a new connection unless the body is a
+        file-like object.'''
+        headers = headers or {}
+        if self._coalesce and body is None and method in ['GET', 'HEAD']:
+            return self._coalesced_request(method, url, headers)
+        return self._stream_request(method, url, body, headers)
+
+    def _coalesced_request(self, method, url, headers):
+        '''Perform a request, waiting up to the read timeout on an identical
+        request if one is already in flight instead of sending a new one.
+        Waiting requests fail if the request they wait on is killed.'''
+        import gevent
+        import gevent.event
+        key = (method, url, tuple(sorted(headers.iteritems())))
+        result = self._in_flight.get(key)
+        if result is not None:
+            try:
+                response = result.get(timeout=self._timeout)
+            except gevent.Timeout:
+                raise socket.timeout(_('Timed out waiting for request: %s') %
+                    url)
+            return Stream(response.copy(), self._buffer_size)
+        result = gevent.event.AsyncResult()
+        self._in_flight[key] = result
+        try:
+            stream = self._stream_request(method, url, None, headers)
+            response = _Response(stream.status, stream.getheaders(),
+                stream.read())
+            result.set(response)
+        except Exception, exception:
+            result.set_exception(exception)
+            raise
+        finally:
+            del self._in_flight[key]
+            if not result.ready():
+                result.set_exception(socket.error(
+                    _('Request was interrupted: %s') % url))
+        return Stream(response.copy(), self._buffer_size)
+
+    def pipeline(self, method, urls, headers=None):
+        '''Perform requests with the same method for a list of URLs on one
+        host, sending them all on a single connection before reading any
+        responses. This should only be used with idempotent methods since
+        requests are sent again on a new connection if the server closes
+        the connection before responding to all of them. Responses are
+        read completely and returned as a list of Stream objects in the
+        same order as the URLs. A Host header in headers replaces the one
+        that is added for the URLs.'''
+        hosts = [_split_url(url) for url in urls]
+        for host in hosts:
+            if host[:3] != hosts[0][:3]:
+                raise ValueError(_('Pipelined URLs must use the same host'))
+        headers = headers or {}
+        responses = []
+        while len(responses) < len(hosts):
+            connection = self._get_connection(hosts[0])
+            try:
+                responses.extend(self._pipeline(connection, method,
+                    hosts[len(responses):], headers))
+            except (httplib.HTTPException, socket.error), exception:
+                connection.close()
+                if not connection.reused or \
+                        isinstance(exception, socket.timeout):
+                    raise
+        return [Stream(response, self._buffer_size) for response in responses]
+
+    def _pipeline(self, connection, method, hosts, headers):
+        '''Send all requests on the connection and then read the responses
+        until they have all been read or the server closes the
+        connection.'''
+        requests = []
+        for host in hosts:
+            request = ['%s %s HTTP/1.1' % (method, host[3])]
+            if not header_exists('Host', headers.iteritems()):
+                request.append('Host: %s:%d' % (host[1], host[2]))
+            request.extend('%s: %s' % header for header in headers.iteritems())
+            request.extend(['', ''])
+            requests.append('\r\n'.join(request))
+        connection.sock.sendall(''.join(requests))
+        responses = []
+        for _host in hosts:
+            response = httplib.HTTPResponse(connection.sock, method=method)
+            response.begin()
+            responses.append(_Response(response.status, response.getheaders(),
+                response.read()))
+            if response.will_close:
+                connection.close()
+                return responses
+        self._put_connection(hosts[0], connection, response)
+        return responses
+
+    def _stream_request(self, method, url, body, headers):
+        '''Perform a request on a pooled connection.'''
+        host = _split_url(url)
+        connection = self._get_connection(host)
+        try:
+            response = self._request(connection, method, host[3], body,
+                headers)
+        except (httplib.HTTPException, socket.error), exception:
+            connection.close()
+            if not connection.reused or hasattr(body, 'read') or \
+                    method.upper() not in _IDEMPOTENT_METHODS or \
+                    isinstance(exception, socket.timeout):
+                raise
+            self.log.debug(_('Retrying request on new connection: %s (%s)'),
+                url, exception)
+            connection = self._connect(host)
+            response = self._request(connection, method, host[3], body,
+                headers)
+        return Stream(response, self._buffer_size,
+            functools.partial(self._put_connection, host, connection,
+                response))
+
+    def _request(self, connection, method, path, body, headers):
+        '''Send a request on the connection and get the response. httplib
+        would open a closed connection again by itself and keep the connect
+        timeout for reading, so it is opened here first instead.'''
+        if connection.sock is None:
+            self._open(connection)
+        connection.request(method, path, body, headers)
+        return connection.getresponse()
+
+    def close(self):
+        '''Close all idle connections in the pools.'''
+        pools = self._pools
+        self._pools = {}
+        for pool in pools.itervalues():
+            for connection, _last_used in pool:
+                connection.close()
+
+    def _get_connection(self, host):
+        '''Get an idle connection for the host from the pool, or create a
+        new one if none are available. The most recently used connection is
+        returned first since it is the least likely to have been closed.'''
+        pool = self._pools.get(host[:3])
+        now = time.time()
+        while pool:
+            connection, last_used = pool.pop()
+            if now - last_used > self._idle_timeout:
+                connection.close()
+                continue
+            connection.reused = True
+            return connection
+        return self._connect(host)
+
+    def _connect(self, host):
+        '''Create and open a new connection.'''
+        if host[0] == 'https':
+            connection = httplib.HTTPSConnection(host[1], host[2],
+                timeout=self._connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(host[1], host[2],
+                timeout=self._connect_timeout)
+        self._open(connection)
+        connection.reused = False
+        return connection
+
+    def _open(self, connection):
+        '''Open a connection using the connect timeout, and then switch to
+        the read timeout once connected.'''
+        connection.connect()
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.sock.settimeout(self._timeout)
+
+    def _put_connection(self, host, connection, response):
+        '''Return a connection to the pool if it can be reused.'''
+        if response.will_close:
+            connection.close()
+            return
+        pool = self._pools.setdefault(host[:3], [])
+        if len(pool) >= self._pool_size:
+            connection.close()
+            return
+        pool.append((connection, time.time()))
+
+
+class _Response(object):
+    '''Buffered response with the same interface as httplib responses so it
+    can be wrapped with a Stream. Copies share the same body data but keep
+    their own read position.'''
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self._headers = headers
+        self._header_map = dict((name.lower(), value)
+            for name, value in headers)
+        self._body = body
+        self._position = 0
+
+    def copy(self):
+        '''Get a copy of the response that has not been read yet.'''
+        return _Response(self.status, self._headers, self._body)
+
+    def getheader(self, name, default=None):
+        '''Get a header from the response.'''
+        return self._header_map.get(name.lower(), default)
+
+    def getheaders(self):
+        '''Get a list of (name, value) header tuples from the response.'''
+        return self._headers
+
+    def read(self, size=None):
+        '''Read data from the buffered body.'''
+        start = self._position
+        if size is None:
+            self._position = len(self._body)
+        else:
+            self._position = min(start + size, len(self._body))
+        return self._body[start:self._position]
+
+
+class _AccessLog(object):
+    '''Buffered access log. Only the fields needed are saved for each
+    request, and they are formatted and logged in batches by a writer
+    greenlet so requests never wait on log handlers. This does not use a
+    real thread since it would share the logging locks with greenlets, so
+    a greenlet waiting on a lock held by the thread would block the whole
+    event loop.'''
+
+    def __init__(self, log, stats, size, pending, sample):
+        import gevent.queue
+        self._log = log
+        self._stats = stats
+        self._size = size
+        self._pending = pending
+        self._sample = sample
+        self._records = []
+        self._batches = gevent.queue.Queue()
+        self._writer = None
+
+    def start(self):
+        '''Start the writer greenlet.'''
+        import gevent
+        if self._writer is None:
+            self._writer = gevent.spawn(self._run)
+
+    def add(self, handler):
+        '''Save the fields for a finished request.'''
+        if self._sample < 1 and random.random() >= self._sample:
+            self._stats['access_log_sampled'] += 1
+            return
+        client_address = handler.client_address
+        if isinstance(client_address, tuple):
+            client_address = client_address[0]
+        if handler.time_finish:
+            delta = handler.time_finish - handler.time_start
+        else:
+            delta = None
+        self._records.append((client_address, time.time(),
+            handler.requestline, handler.status, handler.response_length,
+            delta))
+        if len(self._records) >= self._size:
+            self.flush()
+
+    def flush(self):
+        '''Hand the saved records to the writer greenlet to be logged, or
+        drop them if too many batches are already waiting.'''
+        if not self._records:
+            return
+        records = self._records
+        self._records = []
+        if self._writer is None or self._batches.qsize() >= self._pending:
+            self._stats['access_log_dropped'] += len(records)
+            return
+        self._stats['access_log_written'] += len(records)
+        self._batches.put(records)
+
+    def stop(self):
+        '''Flush saved records and wait for the writer to log them and
+        exit.'''
+        self.flush()
+        if self._writer is not None:
+            self._batches.put(StopIteration)
+            self._writer.join()
+            self._writer = None
+
+    def _run(self):
+        '''Log batches of records until stopped.'''
+        for records in self._batches:
+            self._write(records)
+
+    def _write(self, records):
+        '''Format and log records, this runs in the writer greenlet.'''
+        for client_address, now, requestline, status, length, delta in \
+                records:
+            if delta is None:
+                delta = '-'
+            else:
+                delta = '%.6f' % delta
+            self._log.info('%s - - [%s] "%s" %s %s %s', client_address or '-',
+                datetime.datetime.fromtimestamp(int(now)), requestline or '',
+                (status or '000').split()[0], length or '-', delta)
+
+
+class _CacheEntry(object):
+    '''Cached response along with the times it expires and can no longer
+    be served stale.'''
+
+    def __init__(self, status, headers, body, ttl, stale, public=False):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.size = len(body) + sum(len(name) + len(value)
+            for name, value in headers)
+        self.created = time.time()
+        self.expires = self.created + ttl
+        self.stale = self.expires + stale
+        self.public = public
+        self.revalidating = False
+        self.key = None
+        self.prev = None
+        self.next = None
+
+    def respond(self, now, start):
+        '''Start the cached response and return the body.'''
+        headers = list(self.headers)
+        headers.append(('Age', str(int(now - self.created))))
+        start(self.status, headers)
+        return [self.body]
+
+
+class _Cache(object):
+    '''Least recently used cache with a limit on the total size of the
+    cached responses. Entries are kept in a circular doubly linked list
+    with the most recently used entry at the front.'''
+
+    def __init__(self, size, stats):
+        self.size = size
+        self.used = 0
+        self._stats = stats
+        self._entries = {}
+        self._head = _CacheEntry('', [], '', 0, 0)
+        self._head.prev = self._head
+        self._head.next = self._head
+
+    def get(self, key):
+        '''Get an entry, removing it if it can no longer be used.'''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() >= entry.stale:
+            self._remove(entry)
+            return None
+        self._unlink(entry)
+        self._link(entry)
+        return entry
+
+    def put(self, key, entry):
+        '''Add an entry, evicting least recently used entries to make
+        room if needed.'''
+        if key in self._entries:
+            self._remove(self._entries[key])
+        if entry.size > self.size:
+            return
+        while self.used + entry.size > self.size:
+            self._remove(self._head.prev)
+            self._stats['cache_evict'] += 1
+        entry.key = key
+        self._entries[key] = entry
+        self.used += entry.size
+        self._link(entry)
+
+    def _remove(self, entry):
+        '''Remove an entry from the cache.'''
+        del self._entries[entry.key]
+        self.used -= entry.size
+        self._unlink(entry)
+
+    def _link(self, entry):
+        '''Link an entry at the front of the list.'''
+        entry.prev = self._head
+        entry.next = self._head.next
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    @staticmethod
+    def _unlink(entry):
+        '''Unlink an entry from the list.'''
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+
+def _split_url(url):
+    '''Split a URL into a tuple of scheme, host, port, and the request path
+    with any query string.'''
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path = '%s?%s' % (path, parts.query)
+    port = parts.port
+    if port is None:
+        port = 443 if parts.scheme == 'https' else 80
+    return parts.scheme, parts.hostname, port, path
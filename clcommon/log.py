@@ -31,6 +31,8 @@ import os
 import signal
 import socket
 
+import clcommon.process
+
 DEFAULT_CONFIG = {
     'clcommon': {
         'log': {
@@ -52,9 +54,10 @@ def setup(config):
 
     if config['syslog_ident'] is not None:
         address = config['syslog_address']
-        if isinstance(address, list):
+        if isinstance(address, (list, tuple)):
             if address[0] is None:
-                address[0] = socket.gethostname().split('.')[0]
+                address = [socket.gethostname().split('.')[0]] + \
+                    list(address[1:])
             address = tuple(address)
         handler = _SysLogHandler(address=address)
         format_string = str(config['syslog_ident'] + config['format'])
@@ -100,22 +103,29 @@ def get_log(name, level='NOTSET'):
 
 
 class _ParentWatcher(object):
-    '''Watch if parent process is still around using SIGALRM. This is
-    used by the stdio log forwarder process if enabled.'''
+    '''Watch if parent process is still around using SIGALRM. The kernel
+    sends SIGALRM as soon as the parent exits when it supports it, and
+    otherwise an alarm checks every second. This is used by the stdio log
+    forwarder process if enabled.'''
 
     def __init__(self, log, parent):
         self.log = log
         self.parent = parent
         signal.signal(signal.SIGALRM, self._alarm)
-        signal.alarm(1)
+        try:
+            clcommon.process.set_parent_death_signal(signal.SIGALRM)
+            self.poll = False
+        except OSError:
+            self.poll = True
+        self._alarm(signal.SIGALRM, None)
 
     def _alarm(self, _number, _frame):
         '''Alarm signal handler to make sure parent is still around.'''
         if self.parent != os.getppid():
             self.log.info(_('Parent %d gone, exiting (log)'), self.parent)
             exit(0)
-        signal.signal(signal.SIGALRM, self._alarm)
-        signal.alarm(1)
+        if self.poll:
+            signal.alarm(1)
 
 
 class _SysLogHandler(logging.handlers.SysLogHandler):
@@ -0,0 +1,165 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''craigslist common process module.
+
+This module provides helper functions for Linux process features that
+are not available in the os module, such as CPU affinity and NUMA node
+information, and for cheaply reading process and socket load from the
+kernel. The os module functions are used when they exist, and otherwise
+the C library is called through ctypes.'''
+
+import ctypes
+import ctypes.util
+import errno
+import glob
+import os
+import re
+import socket
+import struct
+
+_CPU_SETSIZE = 1024
+_LONG_BITS = ctypes.sizeof(ctypes.c_ulong) * 8
+_CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+_PIDFD_OPEN = 434
+_PR_SET_PDEATHSIG = 1
+_PR_GET_PDEATHSIG = 2
+_TCP_INFO = struct.Struct('8B6I')
+
+_libc = None
+
+
+def _get_libc():
+    '''Load the C library the first time it is needed.'''
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+def _check(result):
+    '''Raise an OSError with errno if a C library call failed.'''
+    if result < 0:
+        number = ctypes.get_errno()
+        raise OSError(number, os.strerror(number))
+    return result
+
+
+def get_affinity(pid=0):
+    '''Get the sorted list of CPUs a process is allowed to run on.'''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(pid))
+    mask = (ctypes.c_ulong * (_CPU_SETSIZE / _LONG_BITS))()
+    _check(_get_libc().sched_getaffinity(pid, ctypes.sizeof(mask), mask))
+    return [cpu for cpu in xrange(_CPU_SETSIZE)
+        if mask[cpu / _LONG_BITS] & (1 << (cpu % _LONG_BITS))]
+
+
+def set_affinity(cpus, pid=0):
+    '''Set the CPUs a process is allowed to run on.'''
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, cpus)
+        return
+    mask = (ctypes.c_ulong * (_CPU_SETSIZE / _LONG_BITS))()
+    for cpu in cpus:
+        mask[cpu / _LONG_BITS] |= 1 << (cpu % _LONG_BITS)
+    _check(_get_libc().sched_setaffinity(pid, ctypes.sizeof(mask), mask))
+
+
+def parse_cpu_list(cpu_list):
+    '''Parse a CPU list such as 0-3,8,10-11 as used by the kernel into a
+    list of CPU numbers. Lists of numbers are returned as they are.'''
+    if not isinstance(cpu_list, basestring):
+        return list(cpu_list)
+    cpus = []
+    for cpu_range in cpu_list.split(','):
+        cpu_range = cpu_range.strip()
+        if not cpu_range:
+            continue
+        first, _separator, last = cpu_range.partition('-')
+        cpus.extend(xrange(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_nodes(path='/sys/devices/system/node'):
+    '''Get the list of CPUs for each NUMA node, ordered by node number.
+    Nodes without CPUs are skipped, and an empty list is returned if NUMA
+    information isn't available.'''
+    nodes = []
+    for node in glob.glob(os.path.join(path, 'node[0-9]*')):
+        match = re.search(r'node(\d+)$', node)
+        try:
+            cpus = parse_cpu_list(open(os.path.join(node, 'cpulist')).read())
+        except IOError:
+            continue
+        if match and cpus:
+            nodes.append((int(match.group(1)), cpus))
+    return [cpus for _node, cpus in sorted(nodes)]
+
+
+def _prctl(option, *args):
+    '''Call prctl, raising an OSError if it isn't available.'''
+    prctl = getattr(_get_libc(), 'prctl', None)
+    if prctl is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    args += (0,) * (4 - len(args))
+    return _check(prctl(option, *args))
+
+
+def set_parent_death_signal(number):
+    '''Have the kernel send a signal to this process as soon as its
+    parent exits, or stop it with 0. The signal is sent when the thread
+    that forked this process exits, so the parent should fork from its
+    main thread. The parent may have already exited, so callers should
+    check os.getppid() after setting this.'''
+    _prctl(_PR_SET_PDEATHSIG, number)
+
+
+def get_parent_death_signal():
+    '''Get the signal that is sent when the parent exits, or 0.'''
+    number = ctypes.c_int()
+    _prctl(_PR_GET_PDEATHSIG, ctypes.byref(number))
+    return number.value
+
+
+def cpu_time(pid):
+    '''Get the user and system CPU time in seconds used by a process.'''
+    stat = open('/proc/%d/stat' % pid).read()
+    # Skip past the command name since it can contain spaces.
+    fields = stat[stat.rindex(')') + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+
+
+def rss(pid):
+    '''Get the resident set size in bytes of a process.'''
+    return int(open('/proc/%d/statm' % pid).read().split()[1]) * _PAGE_SIZE
+
+
+def listen_queue(sock):
+    '''Get the number of connections waiting to be accepted and the
+    maximum backlog for a listening TCP socket.'''
+    info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO,
+        _TCP_INFO.size)
+    fields = _TCP_INFO.unpack(info)
+    return fields[12], fields[13]
+
+
+def pidfd_open(pid):
+    '''Get a file descriptor for a child process that becomes readable
+    when the process exits. This needs Linux 5.3 or later and raises an
+    OSError if it isn't supported.'''
+    if hasattr(os, 'pidfd_open'):
+        return os.pidfd_open(pid)
+    return _check(_get_libc().syscall(_PIDFD_OPEN, pid, 0))
@@ -19,29 +19,244 @@ fixed amount of children with their own event loop using gevent via
 monkey patching. It does common setup and handles starting and restarting
 children as needed. It provides graceful and forceful shutdown of children,
 and children will also exit on their own if the managing parent process
-disappears.'''
+disappears.
 
+Listening sockets should be created with the listen function so they can be
+shared by all children and handed to a new version of the server. On SIGHUP
+the parent loads the config again, recreates the objects created from the
+managed list while keeping those that were appended, and replaces its
+children one at a time. Each old child is only stopped once its replacement
+reports that it is ready, so capacity never drops. Log settings other than
+the server log level are not reloaded. On SIGUSR2 the parent executes a new
+copy of itself that inherits the listening sockets. The old children keep
+accepting connections until the new server reports that all of its children
+are ready, and are then stopped gracefully, so a new version can be deployed
+without refusing any connections. If the new server exits or doesn't report
+within reexec_timeout seconds, it is stopped and the old one keeps running.
+
+Managed objects can provide a preload method that is called in the parent
+before any children are forked, for loading large read-only data once so the
+pages are shared by all children. Garbage is collected after preloading, and
+setting gc_disable turns off the cycle collector in the children so its
+passes don't write to those pages, at the cost of never freeing reference
+cycles. A warmup method can be provided as well. It is called in each child
+after gevent is setup and before any managed object is started, so children
+don't report ready or accept requests until they are warm.
+
+Each child has a slot number from 0 to children - 1 that a replacement child
+takes over, which is available in the child as the slot attribute. Children
+can be pinned to CPUs based on their slot with the cpu_affinity option. It
+can be round_robin to give each child one of the CPUs the parent is allowed
+to use, numa to give each child all the CPUs of one NUMA node, or a list of
+CPU lists such as ["0-3", "4-7"]. Slots cycle through the CPU sets if there
+are more children than sets.
+
+The number of children can be scaled automatically by setting children_max
+above children_min, in which case children is the number to start with.
+Every scale_interval seconds the parent checks the average CPU use of the
+children from /proc and the number of connections waiting to be accepted on
+the listening sockets. If the children limit concurrent requests and keep
+their counters in shared slots, it also checks the busy ratio, the number of
+requests running or queued divided by the total limit from the
+admission_active, admission_queued, and admission_limit counters. A child is
+added if CPU use is at least scale_up_cpu, the accept queue has at least
+scale_up_queue connections, or the busy ratio is at least scale_up_busy, and
+a child is stopped gracefully if CPU use is at most scale_down_cpu, the
+accept queue is empty, and the busy ratio is at most scale_down_busy. After
+any change, scaling up waits for scale_up_cooldown seconds and scaling down
+waits for scale_down_cooldown seconds.
+
+Managed objects can keep their counters in a clcommon.stats.Counters object
+in their stats attribute. A shared memory segment with a slot of up to
+shared_counters counters for each child is created before any children are
+forked, and each child moves the counters of its managed objects into its
+slot so the parent can read them without any messages or locks. The
+get_stats method returns the totals for all children, including those that
+have exited. There are shared_slots slots, or twice the maximum number of
+children if it is 0, so old and new children both have one during a rolling
+restart. Setting shared_counters to 0 disables this.
+
+If heartbeat_timeout is set, each child records a heartbeat in its shared
+slot from its event loop every heartbeat_interval seconds, along with how
+late the loop was in waking up for it. A child that has not had a heartbeat
+for heartbeat_timeout seconds, or whose loop was late by more than
+heartbeat_lag seconds if that is set, is considered hung. The parent sends
+it SIGUSR1 so it logs the stacks of all its threads and greenlets, and kills
+it a second later so it is replaced.
+
+A child that exits on its own is replaced right away the first time. If the
+child in the same slot keeps exiting within restart_reset seconds of
+starting, each restart waits longer, starting at restart_backoff seconds and
+doubling up to restart_backoff_max, with random jitter so slots don't
+restart in lockstep. If crash_limit children exit within crash_window
+seconds, no children are restarted until the rate drops again. Restart
+counts are included in get_stats.
+
+Children can be recycled so slow growth from fragmentation or caches doesn't
+build up. A child is replaced once it has been running for recycle_age
+seconds, has handled recycle_requests requests according to the requests
+counters in its shared slot, or uses more than recycle_rss bytes of resident
+memory from /proc. These are checked every recycle_interval seconds and 0
+disables each limit. Each child gets limits up to recycle_jitter lower so
+children started together don't all recycle together. Children are replaced
+one at a time and each replacement must be ready before the old child is
+stopped gracefully, as with a rolling restart.
+
+Children can be split into named groups that each run their own managed
+objects, by passing a dictionary of group names to lists for managed instead
+of a list, which is the same as {"default": list}. Settings that apply to
+children, such as children, cpu_affinity, nice, and the scaling, restart,
+heartbeat, recycle, start, and stop settings, can be set for a group in the
+groups option, for example {"workers": {"children": 2, "cpu_affinity":
+["3"], "nice": 10}}, and the rest of the server settings are used for
+anything not set there. Each group has its own slots, so a child's group and
+slot are available in the group and slot attributes, and managed is the list
+of managed objects for its group. The config, listening sockets, and
+preloaded data are still loaded once in the parent and shared by all groups.
+The groups attribute maps each group name to its list of managed objects,
+and managed is the default group's list in the parent.
+
+If admin_socket is set to a path, the parent listens on a Unix socket there
+for admin commands, one JSON object per line with a command key, and answers
+each with one JSON object per line. The children command lists the pid,
+slot, uptime, restarts, resident memory and counters of each child, and
+stats returns the same as get_stats. The roll, reexec, and stop commands do
+the same as SIGHUP, SIGUSR2, and SIGTERM. The scale command sets the number
+of children in the group key, or the default group, to the children key
+until the config is reloaded, and the stacks command returns the stacks of
+the child with the given pid. Any errors are returned in the error key. For
+example::
+
+    echo '{"command": "stacks", "pid": 1234}' | nc -U /run/app.sock'''
+
+import collections
 import errno
+import fcntl
+import functools
+import gc
 import grp
+import heapq
+import itertools
+import json
 import os
 import pwd
+import random
+import select
 import signal
+import socket
+import sys
 import time
+import traceback
 
 import clcommon.config
 import clcommon.log
+import clcommon.process
+import clcommon.stats
 
 DEFAULT_CONFIG = clcommon.config.update(clcommon.log.DEFAULT_CONFIG, {
     'clcommon': {
         'server': {
+            'admin_socket': None,
+            'admin_timeout': 5,
             'children': 1,
+            'children_max': 0,
+            'children_min': 1,
+            'cpu_affinity': None,
+            'crash_limit': 20,
+            'crash_window': 60,
             'daemonize': False,
+            'gc_disable': False,
             'group': None,
+            'groups': {},
+            'heartbeat_interval': 1,
+            'heartbeat_lag': 0,
+            'heartbeat_timeout': 0,
             'log_level': 'NOTSET',
+            'nice': 0,
             'pid_file': None,
+            'recycle_age': 0,
+            'recycle_interval': 10,
+            'recycle_jitter': 0.1,
+            'recycle_requests': 0,
+            'recycle_rss': 0,
+            'reexec_timeout': 60,
+            'restart_backoff': 0.5,
+            'restart_backoff_max': 30,
+            'restart_reset': 30,
+            'scale_down_busy': 0.2,
+            'scale_down_cooldown': 60,
+            'scale_down_cpu': 0.2,
+            'scale_interval': 5,
+            'scale_up_busy': 0.8,
+            'scale_up_cooldown': 10,
+            'scale_up_cpu': 0.8,
+            'scale_up_queue': 1,
+            'shared_counters': 256,
+            'shared_slots': 0,
+            'start_timeout': 30,
             'stop_timeout': 3,
             'user': None}}})
 
+LISTEN_FDS = 'CLCOMMON_LISTEN_FDS'
+READY_FD = 'CLCOMMON_READY_FD'
+DEFAULT_GROUP = 'default'
+
+_listeners = {}
+_inherited = None
+
+
+def listen(host, port, backlog):
+    '''Get a listening TCP socket for the given address. Sockets are kept
+    so later calls for the same address in this process get the same one,
+    and sockets inherited from a parent that executed this process are used
+    instead of binding again.'''
+    global _inherited
+    key = '%s:%d' % (host, port)
+    if port and key in _listeners:
+        return _listeners[key]
+    if _inherited is None:
+        _inherited = {}
+        for listener in os.environ.pop(LISTEN_FDS, '').split(','):
+            if not listener:
+                continue
+            address, fd = listener.rsplit('=', 1)
+            _inherited[address] = int(fd)
+    fd = _inherited.pop(key, None) if port else None
+    if fd is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+    else:
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+    sock.listen(backlog)
+    _listeners['%s:%d' % (host, sock.getsockname()[1])] = sock
+    return sock
+
+
+def dump_stacks(frame=None):
+    '''Format the stacks of all threads and greenlets. If a frame is given,
+    such as the one passed to a signal handler, it is shown first since
+    it is what the process was running.'''
+    stacks = []
+    if frame is not None:
+        stacks.append(_('Current:\n%s') %
+            ''.join(traceback.format_stack(frame)))
+    for thread, thread_frame in sys._current_frames().iteritems():
+        if thread_frame is sys._getframe():
+            continue
+        stacks.append(_('Thread %d:\n%s') % (thread,
+            ''.join(traceback.format_stack(thread_frame))))
+    try:
+        import greenlet
+    except ImportError:
+        return '\n'.join(stacks)
+    for item in gc.get_objects():
+        if isinstance(item, greenlet.greenlet) and item.gr_frame is not None:
+            stacks.append(_('Greenlet %r:\n%s') % (item,
+                ''.join(traceback.format_stack(item.gr_frame))))
+    return '\n'.join(stacks)
+
 
 class Server(object):
     '''Server manager class. Managed objects are created by calling the
@@ -49,11 +264,14 @@ class Server(object):
     config object. Managed objects can also be append to the managed
     attribute after the server manager has been initialized. All objects
     that are managed must provide a start and stop method that get called
-    when the child process is starting and stopping.'''
+    when the child process is starting and stopping, and they can provide
+    preload and warmup methods. The module documentation describes these
+    and the other features of the server.'''
 
     def __init__(self, config, config_files=None, config_dirs=None,
             managed=None):
         config = clcommon.config.update(DEFAULT_CONFIG, config)
+        self._config_sources = (config, config_files, config_dirs)
         self.config, _args = clcommon.config.load(config, config_files,
             config_dirs, False)
         config = self.config['clcommon']['server']
@@ -76,47 +294,1117 @@ class Server(object):
             os.setuid(pwd.getpwnam(config['user']).pw_uid)
         self.log = clcommon.log.get_log('clcommon_server', config['log_level'])
         self._children = {}
+        self.group = None
+        self.slot = None
+        self._loop = None
+        self._pidfd = False
+        self._wakeup = None
+        self._stop_pipe = None
+        self._stacks_write = None
+        self._admin = None
+        self._admin_inode = None
+        self._admin_connections = {}
+        self._checks = set()
+        self._preloaded = {}
+        self._shared = None
+        self._retired = {}
+        self._failures = {}
+        self._pending = {}
+        self._slot_restarts = {}
+        self.restarts = dict(breaker=0, crashes=0, delayed=0, recycled=0,
+            restarts=0)
+        self._running = False
         self._stopping = False
-        if managed is None:
-            self.managed = []
-        else:
-            self.managed = [method(self.config) for method in managed]
+        self._stop_requested = False
+        self._roll_requested = False
+        self._rolling = None
+        self._recycling = None
+        self._reexecuting = False
+        self._reexec_pid = None
+        self._reexec_ready = None
+        self._reexec_timer = None
+        self._ready_report = None
+        self._unreported = 0
+        self._managed_methods = managed or []
+        if not isinstance(self._managed_methods, dict):
+            self._managed_methods = {DEFAULT_GROUP: self._managed_methods}
+        self._groups = self._get_groups(self.config)
+        self.groups = dict((name, group.managed)
+            for name, group in self._groups.iteritems())
+        self.managed = self.groups.get(DEFAULT_GROUP, [])
+
+    def _get_groups(self, config):
+        '''Create the groups of children for a config, each with its own
+        settings and new managed objects.'''
+        server = config['clcommon']['server']
+        for name in server['groups']:
+            if name not in self._managed_methods:
+                raise ValueError(_('No managed objects for group: %s') %
+                    name)
+        groups = {}
+        for name, methods in self._managed_methods.iteritems():
+            group_config = clcommon.config.update(server,
+                server['groups'].get(name, {}))
+            group = _Group(name, group_config,
+                [method(config) for method in methods],
+                self._get_cpu_sets(group_config['cpu_affinity']))
+            group.target = self._get_target(group_config,
+                group_config['children'])
+            groups[name] = group
+        return groups
+
+    def _sorted_groups(self):
+        '''Get the groups sorted by name.'''
+        return [self._groups[name] for name in sorted(self._groups)]
+
+    def preload(self):
+        '''Preload data for managed objects in the parent. This is called
+        by start, but it can be called earlier if managed objects were
+        appended. Each object is only preloaded once.'''
+        self._preload([item for group in self._sorted_groups()
+            for item in group.managed])
+
+    def _preload(self, managed):
+        '''Call preload on the managed objects that provide it and were not
+        preloaded yet, and then collect garbage so children share what is
+        left.'''
+        for item in managed:
+            if id(item) in self._preloaded:
+                continue
+            if hasattr(item, 'preload'):
+                item.preload()
+            self._preloaded[id(item)] = item
+        gc.collect()
+
+    def _forget_preloaded(self):
+        '''Forget preloaded objects that are no longer managed.'''
+        self._preloaded = dict((id(item), item)
+            for group in self._groups.itervalues()
+            for item in group.managed)
 
     def start(self):
-        '''Start the configured number of children and restart as needed.'''
+        '''Start the configured number of children and restart as needed.
+        The parent runs an event loop that waits for signals, children
+        exiting, and timers all at once, so its cost does not grow with
+        the number of children while nothing is happening.'''
+        self._loop = _Loop()
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._loop.add_reader(self._wakeup[0], self._signaled)
+        signal.set_wakeup_fd(self._wakeup[1])
         self._set_signals(self._stop_signal)
-        for _child in xrange(self.config['clcommon']['server']['children']):
-            self._start_child_wrapper()
-        while len(self._children):
+        signal.signal(signal.SIGHUP, self._roll_signal)
+        signal.signal(signal.SIGUSR2, self._reexec_signal)
+        self._pidfd = self._pidfd_supported()
+        signal.signal(signal.SIGCHLD, self._child_signal)
+        self.preload()
+        config = self.config['clcommon']['server']
+        if config['shared_counters'] > 0:
+            self._shared = clcommon.stats.Shared(config['shared_slots'] or
+                2 * sum(max(group.config['children'],
+                    group.config['children_max'])
+                    for group in self._groups.itervalues()),
+                config['shared_counters'])
+        if config['admin_socket'] is not None:
+            self._start_admin(config['admin_socket'])
+        ready_report = os.environ.pop(READY_FD, None)
+        if ready_report is not None:
+            self._start_reported(int(ready_report))
+        else:
+            for group in self._sorted_groups():
+                for slot in xrange(group.target):
+                    self._start_child_wrapper(group, slot)
+        self._running = True
+        self._start_checks()
+        while self._children or (self._pending and not self._stopping):
+            self._loop.run_once()
+        self._close_admin()
+        for connection in self._admin_connections.values():
+            self._admin_close(connection)
+        signal.set_wakeup_fd(-1)
+        self._loop.close()
+        for fd in self._wakeup:
+            os.close(fd)
+        self.log.info(_('All children stopped'))
+
+    @staticmethod
+    def _pidfd_supported():
+        '''Check if children can be watched with pidfds.'''
+        try:
+            os.close(clcommon.process.pidfd_open(os.getpid()))
+        except (AttributeError, OSError):
+            return False
+        return True
+
+    def _signaled(self):
+        '''Handle the signals that have arrived since the last time the
+        wakeup pipe was read.'''
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError, exception:
+            if exception.errno != errno.EAGAIN:
+                raise
+        if self._stop_requested:
+            self._stop_requested = False
+            self.stop()
+        if self._reexecuting:
+            self._reexecuting = False
+            self._reexec()
+        if self._roll_requested:
+            self._roll_requested = False
+            self._start_roll()
+        for pid, status in self._reap():
+            self._child_exited(pid, status)
+
+    def _start_checks(self):
+        '''Schedule the periodic checks that are not already scheduled.
+        Checks that are not enabled stop on their first run.'''
+        for method in (self._scale, self._check_heartbeats,
+                self._check_recycle):
+            if method.__name__ not in self._checks:
+                self._checks.add(method.__name__)
+                self._loop.call_later(0, self._periodic, method)
+
+    def _periodic(self, method):
+        '''Run a periodic check and schedule the next run for the number
+        of seconds it returns, or stop if it returns None.'''
+        delay = None
+        if not self._stopping:
+            delay = method()
+        if delay is None:
+            self._checks.discard(method.__name__)
+            return
+        self._loop.call_later(delay, self._periodic, method)
+
+    def _check_heartbeats(self):
+        '''Dump the stacks of children that have stopped sending
+        heartbeats or whose event loop is lagging, and kill them if they
+        were already found hung. Returns the number of seconds until the
+        next check, or None if heartbeats are disabled.'''
+        intervals = [group.config['heartbeat_interval']
+            for group in self._groups.itervalues()
+            if group.config['heartbeat_timeout']]
+        if self._shared is None or not intervals:
+            return None
+        now = time.time()
+        for child in self._children.values():
+            config = self._groups[child.group].config
+            if child.shared is None or child.stopping or \
+                    not config['heartbeat_timeout']:
+                continue
+            if child.hung is not None:
+                if not child.killed and now >= child.hung + 1:
+                    self.log.error(_('Killing hung child %d'), child.pid)
+                    os.kill(child.pid, signal.SIGKILL)
+                    child.killed = True
+                continue
+            beat, lag = self._shared.heartbeat(child.shared)
+            if not beat:
+                continue
+            if now - beat > config['heartbeat_timeout']:
+                self.log.error(_('Child %d has no heartbeat for %.1f '
+                    'seconds'), child.pid, now - beat)
+            elif config['heartbeat_lag'] and lag > config['heartbeat_lag']:
+                self.log.error(_('Child %d event loop lag is %.1f seconds'),
+                    child.pid, lag)
+            else:
+                continue
+            os.kill(child.pid, signal.SIGUSR1)
+            child.hung = now
+        if any(child.hung is not None and not child.killed
+                for child in self._children.itervalues()):
+            intervals.append(1)
+        return min(intervals)
+
+    @staticmethod
+    def _reap():
+        '''Get the pid and status of all children that have exited.'''
+        exited = []
+        while True:
             try:
-                pid, status = os.wait()
+                pid, status = os.waitpid(-1, os.WNOHANG)
             except OSError, exception:
                 if exception.errno == errno.EINTR:
                     continue
+                if exception.errno != errno.ECHILD:
+                    raise
+                break
+            if pid == 0:
+                break
+            exited.append((pid, status))
+        return exited
+
+    def _reap_child(self, pid):
+        '''Reap a child whose pidfd became readable, unless it was already
+        reaped after SIGCHLD.'''
+        if pid not in self._children:
+            return
+        try:
+            exited, status = os.waitpid(pid, os.WNOHANG)
+        except OSError, exception:
+            if exception.errno != errno.ECHILD:
                 raise
-            if self._children.pop(pid, None) is None:
-                self.log.error(_('Unmanaged child %d died with status %d'),
-                    pid, os.WEXITSTATUS(status))
+            exited, status = pid, 0
+        if exited == pid:
+            self._child_exited(pid, status)
+
+    def _child_exited(self, pid, status):
+        '''Replace a child that exited unless it or the server is being
+        stopped, and run any callbacks waiting for it.'''
+        child = self._remove_child(pid)
+        if child is None:
+            self.log.error(_('Unmanaged child %d died with status %d'),
+                pid, os.WEXITSTATUS(status))
+            return
+        if child.kill_timer is not None:
+            child.kill_timer.cancel()
+        if child.on_ready is not None:
+            self.log.error(_('Child %d died before it was ready'), pid)
+            self._child_ready(child, False)
+            return
+        if child.stopping:
+            for callback in child.on_exit:
+                callback()
+            return
+        if self._stopping:
+            return
+        self.log.error(_('Child %d died with status %d'), pid,
+            os.WEXITSTATUS(status))
+        group = self._groups[child.group]
+        config = group.config
+        key = (child.group, child.slot)
+        now = time.time()
+        self.restarts['crashes'] += 1
+        group.crashes.append(now)
+        failures = 0
+        if now - child.started < config['restart_reset']:
+            failures = self._failures.get(key, 0) + 1
+        self._failures[key] = failures
+        delay = 0
+        if failures > 1:
+            delay = min(config['restart_backoff'] * 2 ** (failures - 2),
+                config['restart_backoff_max'])
+            delay = random.uniform(delay / 2.0, delay)
+            self.restarts['delayed'] += 1
+            self.log.info(_('Restarting %s slot %d in %.1f seconds'),
+                child.group, child.slot, delay)
+        self._pending[key] = self._loop.call_later(delay, self._restart,
+            group, child.slot)
+
+    def _restart(self, group, slot):
+        '''Restart the child in a slot unless too many children in its
+        group have crashed recently, in which case the restart waits until
+        the oldest crash leaves the window.'''
+        config = group.config
+        key = (group.name, slot)
+        now = time.time()
+        while group.crashes and \
+                group.crashes[0] < now - config['crash_window']:
+            group.crashes.popleft()
+        if len(group.crashes) >= config['crash_limit']:
+            if not group.breaker:
+                group.breaker = True
+                self.restarts['breaker'] += 1
+                self.log.error(_('%d %s children crashed in %d seconds, '
+                    'pausing restarts'), len(group.crashes), group.name,
+                    config['crash_window'])
+            self._pending[key] = self._loop.call_later(
+                group.crashes[0] + config['crash_window'] - now,
+                self._restart, group, slot)
+            return
+        if group.breaker:
+            group.breaker = False
+            self.log.info(_('Resuming %s restarts'), group.name)
+        del self._pending[key]
+        if self._count(group) >= group.target:
+            return
+        self.restarts['restarts'] += 1
+        self._slot_restarts[key] = self._slot_restarts.get(key, 0) + 1
+        self._start_child_wrapper(group, slot)
+
+    def _count(self, group):
+        '''Get the number of children in a group that are running and not
+        being stopped, including those waiting to be restarted.'''
+        return len([name for name, _slot in self._pending
+            if name == group.name]) + len([child
+            for child in self._children.itervalues()
+            if child.group == group.name and not child.stopping])
+
+    @staticmethod
+    def _get_target(config, children):
+        '''Get the number of children to run, limiting it to the scaling
+        range if autoscaling is enabled.'''
+        if config['children_max'] > config['children_min']:
+            return max(config['children_min'],
+                min(children, config['children_max']))
+        return config['children']
+
+    @staticmethod
+    def _autoscale(group):
+        '''Check if autoscaling is enabled for a group.'''
+        return group.config['children_max'] > group.config['children_min']
+
+    def _scale(self):
+        '''Scale each group that has autoscaling enabled and is due for a
+        check. Returns the number of seconds until the next check, or None
+        if autoscaling is disabled for all groups.'''
+        now = time.time()
+        delays = []
+        for group in self._sorted_groups():
+            if not self._autoscale(group):
+                group.scale_checked = None
                 continue
-            if self._stopping:
+            interval = group.config['scale_interval']
+            if group.scale_checked is not None and \
+                    now < group.scale_checked + interval:
+                delays.append(group.scale_checked + interval - now)
                 continue
-            self._start_child_wrapper()
-            self.log.error(_('Child %d died with status %d'), pid,
-                os.WEXITSTATUS(status))
-            time.sleep(1)
-        self.log.info(_('All children stopped'))
+            self._scale_group(group, now)
+            delays.append(interval)
+        if delays:
+            return min(delays)
+        return None
+
+    def _scale_group(self, group, now):
+        '''Start or stop a child in a group if the load calls for it and
+        the cooldown has passed.'''
+        config = group.config
+        elapsed = now - (group.scale_checked or now)
+        group.scale_checked = now
+        cpu = 0
+        sampled = 0
+        for child in self._children.itervalues():
+            if child.group != group.name:
+                continue
+            try:
+                cpu_time = clcommon.process.cpu_time(child.pid)
+            except (IOError, OSError):
+                continue
+            if child.cpu_time is not None:
+                cpu += cpu_time - child.cpu_time
+                sampled += 1
+            child.cpu_time = cpu_time
+        if not sampled or not elapsed or self._rolling is not None or \
+                self._recycling is not None:
+            return
+        cpu /= elapsed * sampled
+        queue = 0
+        for sock in _listeners.itervalues():
+            try:
+                queue += clcommon.process.listen_queue(sock)[0]
+            except socket.error:
+                pass
+        busy = self._busy(group)
+        children = self._count(group)
+        if (cpu >= config['scale_up_cpu'] or (config['scale_up_queue'] and
+                queue >= config['scale_up_queue']) or (busy is not None and
+                busy >= config['scale_up_busy'])) and \
+                children < config['children_max'] and \
+                now >= group.scaled + config['scale_up_cooldown']:
+            self.log.info(_('Adding %s child (cpu=%.2f queue=%d busy=%s)'),
+                group.name, cpu, queue, self._format_busy(busy))
+            group.target = children + 1
+            group.scaled = now
+            self._start_child_wrapper(group, self._free_slot(group))
+        elif cpu <= config['scale_down_cpu'] and queue == 0 and \
+                (busy is None or busy <= config['scale_down_busy']) and \
+                children > config['children_min'] and \
+                now >= group.scaled + config['scale_down_cooldown']:
+            self.log.info(_('Removing %s child (cpu=%.2f queue=%d busy=%s)'),
+                group.name, cpu, queue, self._format_busy(busy))
+            group.target = children - 1
+            group.scaled = now
+            self._stop_highest_child(group)
+
+    def _busy(self, group):
+        '''Get the busy ratio of a group from the admission counters in the
+        shared slots of its children, or None if none of them limit
+        concurrent requests.'''
+        if self._shared is None:
+            return None
+        busy = 0
+        limit = 0
+        for child in self._children.itervalues():
+            if child.group != group.name or child.shared is None or \
+                    child.stopping:
+                continue
+            counters = self._shared.read(child.shared, child.counter_names)
+            busy += counters.get('admission_active', 0) + \
+                counters.get('admission_queued', 0)
+            limit += counters.get('admission_limit', 0)
+        if not limit:
+            return None
+        return float(busy) / limit
+
+    @staticmethod
+    def _format_busy(busy):
+        '''Format a busy ratio for logging.'''
+        if busy is None:
+            return '-'
+        return '%.2f' % busy
+
+    def _check_recycle(self):
+        '''Start replacing a child that is over a recycle limit for its
+        group unless children are already being replaced. Returns the
+        number of seconds until the next check, or None if recycling is
+        disabled for all groups.'''
+        intervals = [group.config['recycle_interval']
+            for group in self._groups.itervalues()
+            if group.config['recycle_age'] or
+                group.config['recycle_requests'] or
+                group.config['recycle_rss']]
+        if not intervals:
+            return None
+        if self._rolling is not None or self._recycling is not None:
+            return min(intervals)
+        now = time.time()
+        for child in sorted(self._children.itervalues(),
+                key=lambda child: child.started):
+            if child.stopping or child.on_ready is not None:
+                continue
+            group = self._groups[child.group]
+            reason = self._recycle_reason(group.config, child, now)
+            if reason is not None:
+                self.log.info(_('Recycling child %d (%s)'), child.pid, reason)
+                self.restarts['recycled'] += 1
+                self._recycling = child.pid
+                self._start_ready_child(group, child.slot,
+                    functools.partial(self._recycled, child.pid))
+                break
+        return min(intervals)
+
+    def _recycle_reason(self, config, child, now):
+        '''Get the limit a child is over, or None if it is within them.'''
+        limit = config['recycle_age'] * child.recycle_scale
+        if limit and now - child.started > limit:
+            return _('age=%d') % (now - child.started)
+        limit = config['recycle_requests'] * child.recycle_scale
+        if limit and child.shared is not None:
+            requests = self._shared.read(child.shared,
+                child.counter_names).get('requests', 0)
+            if requests > limit:
+                return _('requests=%d') % requests
+        limit = config['recycle_rss'] * child.recycle_scale
+        if limit:
+            try:
+                rss = clcommon.process.rss(child.pid)
+            except (IOError, OSError):
+                return None
+            if rss > limit:
+                return _('rss=%d') % rss
+        return None
+
+    def _recycled(self, pid, ready):
+        '''Stop a recycled child once its replacement is ready.'''
+        if not ready:
+            self.log.error(_('Could not replace child %d'), pid)
+            self._recycling = None
+            return
+        self._stop_child_pid(pid, self._recycle_done)
+
+    def _recycle_done(self):
+        '''Allow the next child to be recycled.'''
+        self._recycling = None
+
+    def _child_signal(self, _number, _frame):
+        '''Signal handler for children exiting. It only needs to wake up the
+        parent, which the signal wakeup pipe does, so that children are
+        reaped even if they are not watched with pidfds, such as the one
+        started to execute a new version.'''
 
     def stop(self):
-        '''Stop the server by killing all children. Set a timeout for
-        force kill limit in case they don't exit gracefully.'''
+        '''Stop the server by killing all children gracefully, and kill
+        them forcefully if they are still running after the stop
+        timeout.'''
         self._stopping = True
+        self._rolling = None
+        self._recycling = None
+        for timer in self._pending.itervalues():
+            timer.cancel()
+        self._pending.clear()
         self._kill_children(signal.SIGTERM)
-        signal.signal(signal.SIGALRM, self._alarm)
-        signal.alarm(self.config['clcommon']['server']['stop_timeout'])
+        for child in self._children.itervalues():
+            child.stopping = True
+        if self._loop is not None:
+            self._loop.call_later(max(group.config['stop_timeout']
+                for group in self._groups.itervalues()), self._alarm)
 
     def _stop_signal(self, _number, _frame):
         '''Signal handler for stopping the server.'''
+        self._stop_requested = True
+
+    def _roll_signal(self, _number, _frame):
+        '''Signal handler for replacing all children.'''
+        self._roll_requested = True
+
+    def _reexec_signal(self, _number, _frame):
+        '''Signal handler for executing a new version of the server.'''
+        self._reexecuting = True
+
+    def _reload(self):
+        '''Load the config again and recreate the managed objects with it.
+        The current config and objects are kept if either fails.'''
+        config, config_files, config_dirs = self._config_sources
+        try:
+            config, _args = clcommon.config.load(config, config_files,
+                config_dirs, False)
+            groups = self._get_groups(config)
+            self._preload([item for group in groups.itervalues()
+                for item in group.managed])
+        except (Exception, SystemExit), exception:
+            self.log.error(_('Could not reload config: %s'), exception)
+            self._forget_preloaded()
+            return False
+        self.config = config
+        for name, new_group in groups.iteritems():
+            group = self._groups[name]
+            group.config = new_group.config
+            group.cpu_sets = new_group.cpu_sets
+            group.target = self._get_target(group.config,
+                group.target if self._autoscale(group) else
+                group.config['children'])
+            group.managed[:len(new_group.managed)] = new_group.managed
+        self._forget_preloaded()
+        self.log.setLevel(clcommon.log._get_level(
+            config['clcommon']['server']['log_level']))
+        self.log.info(_('Reloaded config'))
+        self._start_checks()
+        return True
+
+    def _start_roll(self):
+        '''Reload the config and replace all children unless the server
+        is stopping or already replacing children. Returns an error
+        message if the children are not being replaced.'''
+        if self._stopping:
+            return _('Server is stopping')
+        if self._rolling is not None:
+            self.log.warning(_('Already replacing children'))
+            return _('Already replacing children')
+        if not self._reload():
+            return _('Could not reload config')
+        self._roll()
+        return None
+
+    def _roll(self):
+        '''Replace the running children one at a time, and then start or
+        stop children to match the configured number. Each replacement
+        must report that it is ready before the child it replaces is
+        stopped so capacity never drops, and old children drain their
+        connections before exiting. If a replacement fails the remaining
+        old children are kept. This runs from the event loop, so the
+        parent keeps handling other children while it waits.'''
+        self._rolling = [pid for pid, child in self._children.iteritems()
+            if not child.stopping]
+        self.log.info(_('Replacing %d children'), len(self._rolling))
+        self._roll_next()
+
+    def _roll_next(self):
+        '''Start the next step of a rolling restart.'''
+        if self._rolling is None or self._stopping:
+            return
+        while self._rolling:
+            child = self._children.get(self._rolling.pop(0))
+            if child is not None and not child.stopping:
+                self._start_ready_child(self._groups[child.group],
+                    child.slot, functools.partial(self._rolled, child.pid))
+                return
+        for group in self._sorted_groups():
+            if self._count(group) < group.target:
+                self._start_ready_child(group, self._free_slot(group),
+                    functools.partial(self._rolled, None))
+                return
+        for group in self._sorted_groups():
+            while self._count(group) > group.target:
+                self._stop_highest_child(group)
+        self._rolling = None
+        self.log.info(_('Finished replacing children'))
+
+    def _rolled(self, pid, ready):
+        '''Stop the child that was replaced once its replacement is ready
+        and continue the rolling restart after it exits.'''
+        if not ready:
+            self.log.error(_('Stopping rolling restart'))
+            self._rolling = None
+        elif pid is None:
+            self._roll_next()
+        else:
+            self._stop_child_pid(pid, self._roll_next)
+
+    def _free_slot(self, group):
+        '''Get the lowest slot in a group that has no child.'''
+        slots = set(child.slot for child in self._children.itervalues()
+            if child.group == group.name and not child.stopping)
+        slots.update(slot for name, slot in self._pending
+            if name == group.name)
+        slot = 0
+        while slot in slots:
+            slot += 1
+        return slot
+
+    @staticmethod
+    def _get_cpu_sets(cpu_affinity):
+        '''Get the list of CPU sets to assign to slots for the given
+        cpu_affinity option, or None if children should not be pinned.'''
+        if not cpu_affinity:
+            return None
+        if cpu_affinity == 'round_robin':
+            return [[cpu] for cpu in clcommon.process.get_affinity()]
+        if cpu_affinity == 'numa':
+            return clcommon.process.numa_nodes() or \
+                [clcommon.process.get_affinity()]
+        if isinstance(cpu_affinity, (list, tuple)):
+            return [clcommon.process.parse_cpu_list(cpus)
+                for cpus in cpu_affinity]
+        raise ValueError(_('Invalid cpu_affinity: %s') % cpu_affinity)
+
+    def _start_ready_child(self, group, slot, on_ready):
+        '''Start a child in a group and call on_ready with whether it
+        reported that it is ready within the start timeout. A child that is
+        not ready in time is stopped.'''
+        pid = self._start_child_wrapper(group, slot)
+        child = self._children[pid]
+        child.on_ready = on_ready
+        child.ready_timer = self._loop.call_later(
+            group.config['start_timeout'], self._child_ready, child, False)
+        self._loop.add_reader(child.ready,
+            functools.partial(self._child_ready, child, True))
+
+    def _child_ready(self, child, readable):
+        '''Handle a child reporting that it is ready, closing its ready
+        pipe, or not doing either within the start timeout. The ready pipe
+        is non-blocking, so a wakeup without any data keeps waiting.'''
+        on_ready = child.on_ready
+        if on_ready is None:
+            return
+        ready = False
+        if readable and child.ready is not None:
+            try:
+                ready = os.read(child.ready, 1) == '1'
+            except OSError, exception:
+                if exception.errno != errno.EAGAIN:
+                    raise
+                return
+        child.on_ready = None
+        child.ready_timer.cancel()
+        if child.ready is not None:
+            self._loop.remove_reader(child.ready)
+            child.close_ready()
+        if not ready and child.pid in self._children:
+            self.log.error(_('Child %d not ready after %d seconds'),
+                child.pid,
+                self._groups[child.group].config['start_timeout'])
+            self._stop_child_pid(child.pid)
+        on_ready(ready)
+
+    def _stop_child_pid(self, pid, on_exit=None):
+        '''Stop a child gracefully, killing it if it is still running after
+        the stop timeout, and call on_exit once it has exited.'''
+        child = self._children.get(pid)
+        if child is None:
+            if on_exit is not None:
+                on_exit()
+            return
+        if on_exit is not None:
+            child.on_exit.append(on_exit)
+        if child.stopping:
+            return
+        self.log.info(_('Killing child %d with %d'), pid, signal.SIGTERM)
+        os.kill(pid, signal.SIGTERM)
+        child.stopping = True
+        child.kill_timer = self._loop.call_later(
+            self._groups[child.group].config['stop_timeout'],
+            self._kill_child, pid)
+
+    def _stop_highest_child(self, group):
+        '''Stop the running child in a group with the highest slot, or
+        cancel the restart with the highest slot if there is one.'''
+        pending = [key for key in self._pending if key[0] == group.name]
+        if pending:
+            self._pending.pop(max(pending)).cancel()
+            return
+        self._stop_child_pid(max((child for child in
+            self._children.itervalues()
+            if child.group == group.name and not child.stopping),
+            key=lambda child: child.slot).pid)
+
+    def _kill_child(self, pid):
+        '''Kill a child that did not exit within the stop timeout.'''
+        if pid in self._children:
+            self.log.info(_('Killing child %d with %d'), pid,
+                signal.SIGKILL)
+            os.kill(pid, signal.SIGKILL)
+
+    def _remove_child(self, pid):
+        '''Remove a child that has exited, keeping its counters in the
+        totals and freeing its shared slot.'''
+        child = self._children.pop(pid, None)
+        if child is None:
+            return None
+        for fd in (child.ready, child.pidfd, child.stacks):
+            if fd is not None:
+                self._loop.remove_reader(fd)
+        child.close()
+        for connection in child.stacks_waiting:
+            self._admin_send(connection, dict(error=_('Child exited')))
+        if child.shared is not None:
+            clcommon.stats.merge(self._retired,
+                self._shared.read(child.shared, child.counter_names))
+            self._shared.clear(child.shared)
+        return child
+
+    def get_stats(self):
+        '''Get the number of children in total and in each group, the
+        totals of their counters from the shared slots, and restart
+        counts.'''
+        counters = dict(self._retired)
+        groups = dict((name, 0) for name in self._groups)
+        for child in self._children.itervalues():
+            groups[child.group] += 1
+            if child.shared is not None:
+                clcommon.stats.merge(counters,
+                    self._shared.read(child.shared, child.counter_names))
+        return dict(children=len(self._children), counters=counters,
+            groups=groups, restarts=dict(self.restarts))
+
+    @staticmethod
+    def _counters(managed):
+        '''Get the counters objects of a list of managed objects.'''
+        return [item.stats for item in managed
+            if isinstance(getattr(item, 'stats', None),
+                clcommon.stats.Counters)]
+
+    def _free_shared_slot(self):
+        '''Get a shared slot no child is using, or None if there is no
+        shared segment or all the slots are used.'''
+        if self._shared is None:
+            return None
+        used = set(child.shared for child in self._children.itervalues())
+        for slot in xrange(self._shared.slots):
+            if slot not in used:
+                return slot
+        self.log.warning(_('No free shared slots, not sharing counters'))
+        return None
+
+    def _start_admin(self, path):
+        '''Listen for admin connections on a Unix socket that only the
+        user running the server can connect to.'''
+        try:
+            os.unlink(path)
+        except OSError, exception:
+            if exception.errno != errno.ENOENT:
+                raise
+        self._admin = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        fcntl.fcntl(self._admin.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        umask = os.umask(0077)
+        try:
+            self._admin.bind(path)
+        finally:
+            os.umask(umask)
+        self._admin_inode = os.stat(path).st_ino
+        self._admin.listen(5)
+        self._admin.setblocking(False)
+        self._loop.add_reader(self._admin.fileno(), self._admin_accept)
+        self.log.info(_('Admin socket listening on %s'), path)
+
+    def _close_admin(self):
+        '''Stop listening for admin connections and remove the socket so
+        a new server can use the path, unless another server already
+        listens there. Open connections are kept.'''
+        if self._admin is None:
+            return
+        self._loop.remove_reader(self._admin.fileno())
+        path = self._admin.getsockname()
+        self._admin.close()
+        self._admin = None
+        try:
+            if os.stat(path).st_ino == self._admin_inode:
+                os.unlink(path)
+        except OSError:
+            pass
+
+    def _admin_accept(self):
+        '''Accept an admin connection.'''
+        try:
+            sock, _address = self._admin.accept()
+        except socket.error, exception:
+            if exception.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        sock.settimeout(self.config['clcommon']['server']['admin_timeout'])
+        connection = _AdminConnection(sock)
+        self._admin_connections[sock.fileno()] = connection
+        self._loop.add_reader(sock.fileno(),
+            functools.partial(self._admin_read, connection))
+
+    def _admin_read(self, connection):
+        '''Read admin requests from a connection and run each complete
+        line as a command.'''
+        try:
+            data = connection.sock.recv(65536)
+        except socket.error:
+            data = ''
+        if not data:
+            self._admin_close(connection)
+            return
+        lines = (connection.buffer + data).split('\n')
+        connection.buffer = lines.pop()
+        for line in lines:
+            if line.strip() and connection.sock is not None:
+                self._admin_request(connection, line)
+
+    def _admin_request(self, connection, line):
+        '''Run an admin command and send the response, unless the command
+        sends it later.'''
+        try:
+            request = json.loads(line)
+            method = getattr(self, '_command_%s' % request['command'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            self._admin_send(connection, dict(error=_('Invalid request')))
+            return
+        try:
+            response = method(connection, request)
+        except Exception, exception:
+            self.log.error(_('Admin command failed: %s'), exception)
+            response = dict(error=str(exception))
+        if response is not None:
+            self._admin_send(connection, response)
+
+    def _admin_send(self, connection, response):
+        '''Send a response on an admin connection, closing it on errors.'''
+        if connection.sock is None:
+            return
+        try:
+            connection.sock.sendall(json.dumps(response,
+                separators=(',', ':')) + '\n')
+        except socket.error, exception:
+            self.log.warning(_('Could not send admin response: %s'),
+                exception)
+            self._admin_close(connection)
+
+    def _admin_close(self, connection):
+        '''Close an admin connection.'''
+        if connection.sock is None:
+            return
+        fd = connection.sock.fileno()
+        self._loop.remove_reader(fd)
+        del self._admin_connections[fd]
+        connection.sock.close()
+        connection.sock = None
+
+    def _command_children(self, _connection, _request):
+        '''List the children.'''
+        now = time.time()
+        children = []
+        for child in sorted(self._children.itervalues(),
+                key=lambda child: (child.group, child.slot)):
+            try:
+                rss = clcommon.process.rss(child.pid)
+            except (IOError, OSError):
+                rss = None
+            counters = {}
+            if child.shared is not None:
+                counters = self._shared.read(child.shared,
+                    child.counter_names)
+            children.append(dict(pid=child.pid, group=child.group,
+                slot=child.slot, uptime=now - child.started,
+                restarts=self._slot_restarts.get((child.group, child.slot),
+                    0), rss=rss,
+                stopping=child.stopping, hung=child.hung is not None,
+                counters=counters))
+        return dict(children=children, pending=sorted(self._pending))
+
+    def _command_stats(self, _connection, _request):
+        '''Get the stats for all children.'''
+        return self.get_stats()
+
+    def _command_roll(self, _connection, _request):
+        '''Reload the config and replace all children.'''
+        error = self._start_roll()
+        if error is not None:
+            return dict(error=error)
+        return dict(ok=True)
+
+    def _command_reexec(self, connection, _request):
+        '''Execute a new version of the server.'''
+        if self._stopping:
+            return dict(error=_('Server is stopping'))
+        if self._reexec_pid is not None:
+            return dict(error=_('Already starting a new server'))
+        self._admin_send(connection, dict(ok=True))
+        self._reexec()
+        return None
+
+    def _command_stop(self, _connection, _request):
+        '''Stop the server.'''
         self.stop()
+        return dict(ok=True)
+
+    def _command_scale(self, _connection, request):
+        '''Set the number of children to run in a group until the config
+        is reloaded, starting or stopping children to match.'''
+        group = self._groups.get(request.get('group', DEFAULT_GROUP))
+        if group is None:
+            return dict(error=_('No such group'))
+        children = request.get('children')
+        if not isinstance(children, (int, long)) or \
+                isinstance(children, bool) or children < 0:
+            return dict(error=_('Invalid number of children'))
+        if self._stopping:
+            return dict(error=_('Server is stopping'))
+        if self._rolling is not None:
+            return dict(error=_('Already replacing children'))
+        group.target = self._get_target(group.config, children) \
+            if self._autoscale(group) else children
+        self.log.info(_('Scaling %s to %d children'), group.name,
+            group.target)
+        while self._count(group) < group.target:
+            self._start_child_wrapper(group, self._free_slot(group))
+        while self._count(group) > group.target:
+            self._stop_highest_child(group)
+        return dict(children=group.target, group=group.name)
+
+    def _command_stacks(self, connection, request):
+        '''Get the stacks of a child. The response is sent once the child
+        writes them to its stacks pipe.'''
+        child = self._children.get(request.get('pid'))
+        if child is None or child.stacks is None:
+            return dict(error=_('No such child'))
+        child.stacks_waiting.append(connection)
+        if len(child.stacks_waiting) == 1:
+            os.kill(child.pid, signal.SIGUSR1)
+        return None
+
+    def _read_stacks(self, child):
+        '''Read stack dumps from a child and send them to the admin
+        connections waiting for them.'''
+        try:
+            data = os.read(child.stacks, 65536)
+        except OSError, exception:
+            if exception.errno != errno.EINTR:
+                raise
+            return
+        if not data:
+            self._loop.remove_reader(child.stacks)
+            child.close_stacks()
+            return
+        dumps = (child.stacks_buffer + data).split('\0')
+        child.stacks_buffer = dumps.pop()
+        for dump in dumps:
+            waiting = child.stacks_waiting
+            child.stacks_waiting = []
+            for connection in waiting:
+                self._admin_send(connection, dict(pid=child.pid,
+                    stacks=dump))
+
+    def _reexec(self):
+        '''Execute a new copy of the server with the same arguments that
+        inherits all listening sockets. This one keeps running until the
+        new server reports that its children are ready, so connections are
+        still accepted while it starts.'''
+        if self._reexec_pid is not None:
+            self.log.warning(_('Already starting new server %d'),
+                self._reexec_pid)
+            return
+        listeners = []
+        for address, sock in _listeners.iteritems():
+            flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD,
+                flags & ~fcntl.FD_CLOEXEC)
+            listeners.append('%s=%d' % (address, sock.fileno()))
+        ready_read, ready_write = os.pipe()
+        fcntl.fcntl(ready_read, fcntl.F_SETFL,
+            fcntl.fcntl(ready_read, fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(ready_read, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        env = dict(os.environ)
+        env[LISTEN_FDS] = ','.join(listeners)
+        env[READY_FD] = str(ready_write)
+        self._close_admin()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.execve(sys.executable, [sys.executable] + sys.argv, env)
+            finally:
+                os._exit(1)
+        os.close(ready_write)
+        self.log.info(_('Started new server %d, waiting for it to be ready'),
+            pid)
+        self._reexec_pid = pid
+        self._reexec_ready = ready_read
+        self._reexec_timer = self._loop.call_later(
+            self.config['clcommon']['server']['reexec_timeout'],
+            self._reexec_done, False)
+        self._loop.add_reader(ready_read,
+            functools.partial(self._reexec_done, True))
+
+    def _reexec_done(self, readable):
+        '''Stop this server once the new one reports that it is ready. If
+        it closes the ready pipe without doing so or doesn't report within
+        the reexec timeout, stop it and keep running this one.'''
+        ready = False
+        if readable:
+            try:
+                ready = os.read(self._reexec_ready, 1) == '1'
+            except OSError, exception:
+                if exception.errno != errno.EAGAIN:
+                    raise
+                return
+        pid = self._reexec_pid
+        self._reexec_pid = None
+        self._reexec_timer.cancel()
+        self._loop.remove_reader(self._reexec_ready)
+        os.close(self._reexec_ready)
+        self._reexec_ready = None
+        if ready:
+            self.log.info(_('New server %d is ready, stopping'), pid)
+            self.stop()
+            return
+        self.log.error(_('New server %d was not ready, keeping this one'),
+            pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+        path = self.config['clcommon']['server']['admin_socket']
+        if path is not None and not self._stopping:
+            self._start_admin(path)
+
+    def _start_reported(self, ready_report):
+        '''Start the children for a server that was executed by another
+        one, and report on the ready_report pipe once they are all ready
+        so the other server can stop.'''
+        self._ready_report = ready_report
+        fcntl.fcntl(ready_report, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._unreported = 1
+        for group in self._sorted_groups():
+            for slot in xrange(group.target):
+                self._unreported += 1
+                self._start_ready_child(group, slot, self._reported)
+        self._reported(True)
+
+    def _reported(self, ready):
+        '''Count a child that reported whether it is ready, and tell the
+        server that executed this one once all of them are ready or as
+        soon as one is not.'''
+        if self._ready_report is None:
+            return
+        self._unreported -= 1
+        if ready and self._unreported:
+            return
+        if ready:
+            try:
+                os.write(self._ready_report, '1')
+            except OSError, exception:
+                self.log.warning(_('Could not report ready: %s'), exception)
+        else:
+            self.log.error(_('Not all children are ready, not replacing '
+                'the old server'))
+        os.close(self._ready_report)
+        self._ready_report = None
 
     def _kill_children(self, number):
         '''Send given signal to all running children.'''
@@ -124,50 +1412,179 @@ class Server(object):
             self.log.info(_('Killing child %d with %d'), pid, number)
             os.kill(pid, number)
 
-    def _alarm(self, _number=0, _frame=0):
-        '''Signal handler to forcefully kill children.'''
+    def _alarm(self):
+        '''Forcefully kill children still running after the stop
+        timeout.'''
         self._kill_children(signal.SIGKILL)
 
-    def _start_child_wrapper(self):
-        '''Wrapper for starting a new child.'''
+    def _start_child_wrapper(self, group, slot):
+        '''Wrapper for starting a new child in a slot of a group. The child
+        writes to a pipe once its managed objects have started so the
+        parent can tell when it is ready.'''
+        ready_read, ready_write = os.pipe()
+        stacks_read = stacks_write = None
+        if self._admin is not None:
+            stacks_read, stacks_write = os.pipe()
+        shared = self._free_shared_slot()
+        counters = self._counters(group.managed)
+        if shared is not None and \
+                sum(len(item) for item in counters) > self._shared.size:
+            self.log.warning(_('Too many counters for shared slot, not '
+                'sharing counters'))
+            shared = None
         pid = os.fork()
         if pid > 0:
-            self._children[pid] = True
-            self.log.info(_('Child %d started'), pid)
-            return
+            os.close(ready_write)
+            child = _Child(pid, group.name, slot, ready_read)
+            jitter = group.config['recycle_jitter']
+            child.recycle_scale = random.uniform(1 - jitter, 1)
+            if stacks_read is not None:
+                os.close(stacks_write)
+                fcntl.fcntl(stacks_read, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                child.stacks = stacks_read
+                self._loop.add_reader(stacks_read,
+                    functools.partial(self._read_stacks, child))
+            if shared is not None:
+                child.shared = shared
+                child.counter_names = [name for item in counters
+                    for name in item.names]
+            fcntl.fcntl(ready_read, fcntl.F_SETFL,
+                fcntl.fcntl(ready_read, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(ready_read, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            if self._pidfd:
+                child.pidfd = clcommon.process.pidfd_open(pid)
+                fcntl.fcntl(child.pidfd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                self._loop.add_reader(child.pidfd,
+                    functools.partial(self._reap_child, pid))
+            self._children[pid] = child
+            self.log.info(_('Child %d started in %s slot %d'), pid,
+                group.name, slot)
+            return pid
+        os.close(ready_read)
+        if stacks_read is not None:
+            os.close(stacks_read)
+            fcntl.fcntl(stacks_write, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            self._stacks_write = stacks_write
+        for child in self._children.itervalues():
+            child.close()
+        if self._ready_report is not None:
+            os.close(self._ready_report)
+        if self._reexec_ready is not None:
+            os.close(self._reexec_ready)
+        if self._admin is not None:
+            self._admin.close()
+        for connection in self._admin_connections.itervalues():
+            connection.sock.close()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self._loop.close()
+        for fd in self._wakeup:
+            os.close(fd)
+        self.group = group.name
+        self.slot = slot
+        self.managed = group.managed
+        self._stop_pipe = os.pipe()
+        for fd in self._stop_pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
         self._set_signals(self._stop_child_signal)
+        try:
+            clcommon.process.set_parent_death_signal(signal.SIGTERM)
+            watched = True
+        except OSError:
+            watched = False
+        if os.getppid() != self._parent:
+            self._stopping = True
+        signal.signal(signal.SIGUSR1, self._dump_signal)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        if group.cpu_sets:
+            cpus = group.cpu_sets[slot % len(group.cpu_sets)]
+            try:
+                clcommon.process.set_affinity(cpus)
+            except OSError, exception:
+                self.log.warning(_('Could not set CPU affinity to %s: %s'),
+                    cpus, exception)
+        if group.config['nice']:
+            os.nice(group.config['nice'])
+        if group.config['gc_disable']:
+            gc.disable()
+        if shared is not None:
+            self._shared.attach(shared, counters)
         import gevent.monkey
         gevent.monkey.patch_all()
         try:
             self._start_child()
         except:
-            os.kill(self._parent, signal.SIGTERM)
+            if not self._running:
+                os.kill(self._parent, signal.SIGTERM)
             raise
-        # Watch for parent death and die if detected.
+        os.write(ready_write, '1')
+        os.close(ready_write)
+        config = group.config
+        interval = None
+        if shared is not None and config['heartbeat_timeout']:
+            interval = config['heartbeat_interval']
+            self._shared.beat(shared)
+        else:
+            shared = None
+        if not watched:
+            interval = min(interval or 1, 1)
+        # The kernel sends SIGTERM when the parent exits, and stop signals
+        # write to the stop pipe, so an idle child only wakes up for them
+        # or heartbeats. Since this runs in the event loop, heartbeats show
+        # if the loop is running and how late it is.
         try:
-            while not self._stopping:
-                if os.getppid() != self._parent:
-                    self.log.info(_('Parent %d gone, exiting'), self._parent)
-                    break
-                time.sleep(1)
+            while not self._stopping and os.getppid() == self._parent:
+                slept = time.time()
+                select.select([self._stop_pipe[0]], [], [], interval)
+                if shared is not None:
+                    self._shared.beat(shared,
+                        max(time.time() - slept - interval, 0))
         except KeyboardInterrupt:
             pass
+        if os.getppid() != self._parent:
+            self.log.info(_('Parent %d gone, exiting'), self._parent)
         self._stop_child()
         exit(0)
 
+    def _dump_signal(self, _number, frame):
+        '''Signal handler for logging the stacks of a child. They are also
+        written to the stacks pipe if the parent has an admin socket.'''
+        stacks = dump_stacks(frame)
+        self.log.error(_('Stacks for child %d:\n%s'), os.getpid(), stacks)
+        if self._stacks_write is None:
+            return
+        if isinstance(stacks, unicode):
+            stacks = stacks.encode('utf-8')
+        data = stacks.replace('\0', '') + '\0'
+        try:
+            while data:
+                data = data[os.write(self._stacks_write, data):]
+        except OSError, exception:
+            self.log.warning(_('Could not write stacks: %s'), exception)
+
     def _stop_child_signal(self, _number, _frame):
-        '''Signal handler for stopping children.'''
+        '''Signal handler for stopping children. Writing to the stop pipe
+        wakes up the child if it is waiting.'''
         self._stopping = True
+        try:
+            os.write(self._stop_pipe[1], '1')
+        except OSError:
+            pass
 
     def _start_child(self):
-        '''Start a new child.'''
+        '''Start a new child, warming up all managed objects first.'''
+        for managed in self.managed:
+            if hasattr(managed, 'warmup'):
+                managed.warmup()
         for managed in self.managed:
             managed.start()
 
     def _stop_child(self):
         '''Stop a child.'''
         for managed in self.managed:
-            managed.stop(self.config['clcommon']['server']['stop_timeout'])
+            managed.stop(self._groups[self.group].config['stop_timeout'])
 
     @staticmethod
     def _set_signals(handler):
@@ -176,3 +1593,157 @@ class Server(object):
         signal.signal(signal.SIGINT, handler)
         signal.signal(signal.SIGQUIT, handler)
         signal.signal(signal.SIGTERM, handler)
+
+
+class _Child(object):
+    '''State the parent keeps for each child.'''
+
+    def __init__(self, pid, group, slot, ready):
+        self.pid = pid
+        self.group = group
+        self.slot = slot
+        self.ready = ready
+        self.pidfd = None
+        self.stacks = None
+        self.stacks_buffer = ''
+        self.stacks_waiting = []
+        self.on_ready = None
+        self.ready_timer = None
+        self.stopping = False
+        self.on_exit = []
+        self.kill_timer = None
+        self.cpu_time = None
+        self.shared = None
+        self.counter_names = []
+        self.hung = None
+        self.killed = False
+        self.recycle_scale = 1
+        self.started = time.time()
+
+    def close_ready(self):
+        '''Close the ready pipe if it is still open.'''
+        if self.ready is not None:
+            os.close(self.ready)
+            self.ready = None
+
+    def close_stacks(self):
+        '''Close the stacks pipe if it is still open.'''
+        if self.stacks is not None:
+            os.close(self.stacks)
+            self.stacks = None
+
+    def close(self):
+        '''Close the ready pipe, stacks pipe, and pidfd if they are still
+        open.'''
+        self.close_ready()
+        self.close_stacks()
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+
+class _Group(object):
+    '''State the parent keeps for each group of children. The config is the
+    server config with the settings for the group applied.'''
+
+    def __init__(self, name, config, managed, cpu_sets):
+        self.name = name
+        self.config = config
+        self.managed = managed
+        self.cpu_sets = cpu_sets
+        self.target = 0
+        self.scale_checked = None
+        self.scaled = 0
+        self.crashes = collections.deque()
+        self.breaker = False
+
+
+class _AdminConnection(object):
+    '''State the parent keeps for each admin connection.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ''
+
+
+class _Loop(object):
+    '''Minimal event loop for the parent. It waits for file descriptors to
+    become readable with epoll, or poll where epoll is not available, and
+    keeps timers in a heap, so each wakeup only costs as much as the
+    events that are ready.'''
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            fcntl.fcntl(self._poll.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            self._events = select.EPOLLIN
+            self._scale = 1
+        else:
+            self._poll = select.poll()
+            self._events = select.POLLIN
+            self._scale = 1000
+        self._readers = {}
+        self._timers = []
+        self._sequence = itertools.count()
+
+    def add_reader(self, fd, callback):
+        '''Call callback whenever fd is readable.'''
+        self._readers[fd] = callback
+        self._poll.register(fd, self._events)
+
+    def remove_reader(self, fd):
+        '''Stop watching fd. This must be called before fd is closed.'''
+        if self._readers.pop(fd, None) is not None:
+            self._poll.unregister(fd)
+
+    def call_later(self, delay, callback, *args):
+        '''Call callback with args after delay seconds. Returns a timer
+        that can be cancelled.'''
+        timer = _Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers,
+            (timer.deadline, next(self._sequence), timer))
+        return timer
+
+    def run_once(self):
+        '''Wait until a file descriptor is readable or the next timer is
+        due, and run the callbacks that are ready.'''
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        timeout = -1
+        if self._timers:
+            timeout = max(self._timers[0][0] - time.time(), 0) * self._scale
+        try:
+            events = self._poll.poll(timeout)
+        except (IOError, select.error), exception:
+            if exception.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, _events in events:
+            callback = self._readers.get(fd)
+            if callback is not None:
+                callback()
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                timer.cancelled = True
+                timer.callback(*timer.args)
+
+    def close(self):
+        '''Close the epoll file descriptor.'''
+        if hasattr(self._poll, 'close'):
+            self._poll.close()
+
+
+class _Timer(object):
+    '''Timer returned by _Loop.call_later.'''
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        '''Keep the timer from running if it hasn't already.'''
+        self.cancelled = True
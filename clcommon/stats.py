@@ -0,0 +1,313 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''craigslist common stats module.
+
+This module provides a histogram class and helper functions for collecting
+stats in a process with low overhead and aggregating them across multiple
+processes. Histograms use logarithmic buckets so they have a fixed size no
+matter how many values are added, can be merged by adding bucket counts,
+and give percentiles with a bounded relative error.
+
+Stats are plain nested dictionaries of numbers and histogram dictionaries
+so they can be serialized as JSON. Each process can periodically save its
+stats into a shared directory with save(), and any process can then use
+load_dir() to get the totals for all processes still running. For
+example::
+
+    clcommon.stats.save('/var/run/app/stats', {'requests': 10})
+    totals = clcommon.stats.load_dir('/var/run/app/stats')
+
+Counters can also be shared between related processes without files. A
+Counters object holds a fixed set of named integers, and a Shared segment
+created before forking gives each process a slot that its counters can
+be moved into. Each slot is only written by the process that owns it, so
+counters are updated without locks and any process can read the totals.'''
+
+import ctypes
+import errno
+import json
+import math
+import mmap
+import os
+import time
+
+BUCKETS_PER_DOUBLING = 4
+BUCKETS = 160
+
+
+class Histogram(object):
+    '''Histogram of positive values using logarithmic buckets. Each bucket
+    covers values up to 2 ** (1.0 / BUCKETS_PER_DOUBLING) times larger than
+    the previous bucket, so percentiles are within about 19% of the real
+    value.'''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * BUCKETS
+
+    def add(self, value):
+        '''Add a value to the histogram.'''
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value < 1:
+            self.buckets[0] += 1
+        else:
+            self.buckets[min(int(math.log(value, 2) * BUCKETS_PER_DOUBLING)
+                + 1, BUCKETS - 1)] += 1
+
+    def percentile(self, percent):
+        '''Get the given percentile using the upper bound of the bucket it
+        falls in, limited to the largest value seen.'''
+        if self.count == 0:
+            return 0
+        target = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(2 ** (float(index) / BUCKETS_PER_DOUBLING),
+                    self.max)
+        return self.max
+
+    def merge(self, other):
+        '''Add the values from another histogram to this one.'''
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+
+    def to_dict(self):
+        '''Get a dictionary of the histogram that can be serialized. Only
+        buckets with values are included, and common percentiles are added
+        for convenience.'''
+        return dict(count=self.count, total=self.total, min=self.min,
+            max=self.max, p50=self.percentile(50), p90=self.percentile(90),
+            p99=self.percentile(99), buckets=dict((str(index), count)
+                for index, count in enumerate(self.buckets) if count))
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Create a histogram from a dictionary given by to_dict.'''
+        histogram = cls()
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        for index, count in data['buckets'].iteritems():
+            histogram.buckets[int(index)] = count
+        return histogram
+
+
+class Counters(object):
+    '''Fixed set of named integer counters. Values are kept in a ctypes
+    array so they can be moved into a Shared segment after they are
+    created without changing the object, since other objects may keep a
+    reference to it. This supports the dictionary methods used for
+    counting, so dict(counters) gives a copy of the current values.'''
+
+    def __init__(self, names):
+        self.names = list(names)
+        self._index = dict((name, index)
+            for index, name in enumerate(self.names))
+        self._values = (ctypes.c_int64 * len(self.names))()
+
+    def __getitem__(self, name):
+        return self._values[self._index[name]]
+
+    def __setitem__(self, name, value):
+        self._values[self._index[name]] = value
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name, default=None):
+        '''Get a counter value, or the default if there is no counter.'''
+        index = self._index.get(name)
+        if index is None:
+            return default
+        return self._values[index]
+
+    def keys(self):
+        '''Get the counter names.'''
+        return list(self.names)
+
+    def iteritems(self):
+        '''Iterate over counter names and values.'''
+        for index, name in enumerate(self.names):
+            yield name, self._values[index]
+
+    def items(self):
+        '''Get a list of counter names and values.'''
+        return list(self.iteritems())
+
+    def move(self, buffer, offset=0):
+        '''Move the counters into a writable buffer at the given offset,
+        keeping their current values.'''
+        values = (ctypes.c_int64 * len(self.names)).from_buffer(buffer,
+            offset)
+        values[:] = self._values[:]
+        self._values = values
+
+
+class Shared(object):
+    '''Shared memory segment with a fixed-size slot for each process that
+    holds the pid of the process using it, the time and event loop lag of
+    its last heartbeat, and up to size counters. This must be created
+    before forking so all processes share the segment.'''
+
+    HEADER = 3
+
+    def __init__(self, slots, size):
+        self.slots = slots
+        self.size = size
+        self._slot_bytes = (self.HEADER + size) * \
+            ctypes.sizeof(ctypes.c_int64)
+        self._mmap = mmap.mmap(-1, slots * self._slot_bytes)
+        self._values = [(ctypes.c_int64 * (self.HEADER + size)).from_buffer(
+            self._mmap, slot * self._slot_bytes) for slot in xrange(slots)]
+
+    def attach(self, slot, counters):
+        '''Move a list of counters objects into a slot. This should only be
+        called by the process that will write to the slot.'''
+        if sum(len(item) for item in counters) > self.size:
+            raise ValueError(_('Too many counters for shared slot'))
+        self._values[slot][0] = os.getpid()
+        offset = slot * self._slot_bytes + \
+            self.HEADER * ctypes.sizeof(ctypes.c_int64)
+        for item in counters:
+            item.move(self._mmap, offset)
+            offset += len(item) * ctypes.sizeof(ctypes.c_int64)
+
+    def pid(self, slot):
+        '''Get the pid of the process using a slot, or 0 if it is free.'''
+        return self._values[slot][0]
+
+    def beat(self, slot, lag=0):
+        '''Record a heartbeat for a slot with the number of seconds the
+        event loop was late in waking up for it.'''
+        values = self._values[slot]
+        values[2] = int(lag * 1000000)
+        values[1] = int(time.time() * 1000000)
+
+    def heartbeat(self, slot):
+        '''Get the time and lag of the last heartbeat for a slot. The time
+        is 0 if there has not been a heartbeat.'''
+        values = self._values[slot]
+        return values[1] / 1000000.0, values[2] / 1000000.0
+
+    def read(self, slot, names):
+        '''Read the counters in a slot given the list of names for all the
+        counters attached to it. Counters with the same name are added, and
+        names past the size of the slot are ignored.'''
+        values = self._values[slot]
+        counters = {}
+        for index, name in enumerate(names[:self.size]):
+            counters[name] = counters.get(name, 0) + \
+                values[self.HEADER + index]
+        return counters
+
+    def clear(self, slot):
+        '''Clear a slot so it can be used by another process.'''
+        ctypes.memset(ctypes.addressof(self._values[slot]), 0,
+            self._slot_bytes)
+
+
+def merge(total, stats):
+    '''Merge stats into a total, adding numbers and histogram dictionaries
+    and merging nested dictionaries. The total dictionary is modified and
+    returned.'''
+    for key, value in stats.iteritems():
+        if isinstance(value, dict):
+            if 'buckets' in value:
+                histogram = Histogram.from_dict(value)
+                if key in total:
+                    histogram.merge(Histogram.from_dict(total[key]))
+                total[key] = histogram.to_dict()
+            else:
+                total[key] = merge(total.get(key, {}), value)
+        elif isinstance(value, (int, long, float)) and \
+                not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def save(stats_dir, stats, pid=None):
+    '''Save stats for a process into a directory. The file is replaced
+    atomically so readers never see partial stats.'''
+    pid = pid or os.getpid()
+    path = os.path.join(stats_dir, '%d.json' % pid)
+    temp_path = '%s.tmp' % path
+    stats_file = open(temp_path, 'w')
+    try:
+        json.dump(stats, stats_file, separators=(',', ':'))
+    finally:
+        stats_file.close()
+    os.rename(temp_path, path)
+
+
+def remove(stats_dir, pid=None):
+    '''Remove saved stats for a process.'''
+    try:
+        os.unlink(os.path.join(stats_dir, '%d.json' % (pid or os.getpid())))
+    except OSError, exception:
+        if exception.errno != errno.ENOENT:
+            raise
+
+
+def load_dir(stats_dir):
+    '''Load and merge the stats saved by all processes in a directory. Stats
+    for processes that are no longer running are removed, and files that
+    are not named for a pid are skipped. The number of processes merged is
+    added as processes.'''
+    total = dict(processes=0)
+    for name in os.listdir(stats_dir):
+        if not name.endswith('.json'):
+            continue
+        try:
+            pid = int(name[:-5])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)
+        except OSError, exception:
+            if exception.errno == errno.ESRCH:
+                remove(stats_dir, pid)
+                continue
+        try:
+            stats = json.load(open(os.path.join(stats_dir, name)))
+        except (IOError, ValueError):
+            continue
+        merge(total, stats)
+        total['processes'] += 1
+    return total
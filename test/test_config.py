@@ -14,8 +14,13 @@
 
 '''Tests for craigslist common config module.'''
 
+import copy
+import os
+import pickle
+import shutil
 import StringIO
 import sys
+import tempfile
 import unittest
 
 import clcommon.config
@@ -63,6 +68,30 @@ class TestConfig(unittest.TestCase):
         self.assertEquals('test', config['clcommon']['log']['syslog_ident'])
         self.assertEquals([], args)
 
+    def test_load_dir_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            for name, value in [('a.json', 1), ('b.json', 2)]:
+                open(os.path.join(path, name), 'w').write(
+                    '# Comment\n{"a": {"%s": %d}}' % (name[0], value))
+            config = clcommon.config.load_dir({}, path)
+            self.assertEquals(dict(a=dict(a=1, b=2)), config)
+            self.assertTrue(config['a'] is
+                clcommon.config.load_dir({}, path)['a'])
+            open(os.path.join(path, 'b.json'), 'w').write(
+                '{"a": {"b": 3}}')
+            self.assertEquals(dict(a=dict(a=1, b=3)),
+                clcommon.config.load_dir({}, path))
+            open(os.path.join(path, 'c.json'), 'w').write('[]')
+            self.assertRaises(clcommon.config.ConfigError,
+                clcommon.config.load_dir, {}, path)
+            os.unlink(os.path.join(path, 'c.json'))
+            clcommon.config.clear_cache()
+            self.assertEquals(dict(a=dict(a=1, b=3)),
+                clcommon.config.load_dir({}, path))
+        finally:
+            shutil.rmtree(path)
+
     def test_parse_value(self):
         self.assertEquals('', clcommon.config.parse_value(''))
         self.assertEquals([1, 2, 'three'],
@@ -102,6 +131,31 @@ class TestConfig(unittest.TestCase):
         config = clcommon.config.update(original, dict(a=1, b=1), dict(a=2))
         self.assertEquals(config, dict(a=2, b=1))
         self.assertEquals(original, dict(a=0, b=0))
+        self.assertTrue(isinstance(config, clcommon.config.Config))
+        self.assertRaises(TypeError, config.__setitem__, 'a', 3)
+        self.assertRaises(TypeError, config.update, a=3)
+        self.assertRaises(TypeError, config.pop, 'a')
+        self.assertEquals(dict(a=2, b=1), config.copy())
+        self.assertTrue(config is copy.deepcopy(config))
+        self.assertTrue(config is pickle.loads(pickle.dumps(config)))
+
+    def test_update_sharing(self):
+        original = clcommon.config.update({}, dict(a=dict(b=dict(c=1)),
+            d=dict(e=[1, dict(f=2)])))
+        config = clcommon.config.update_option(original, 'a.b.c', '2')
+        self.assertEquals(1, original['a']['b']['c'])
+        self.assertEquals(2, config['a']['b']['c'])
+        self.assertTrue(config['d'] is original['d'])
+        self.assertEquals((1, dict(f=2)), config['d']['e'])
+        self.assertRaises(TypeError, config['d']['e'][1].__setitem__, 'f', 3)
+        self.assertTrue(original is clcommon.config.update(original,
+            dict(a=dict(b=dict(c=1)))))
+        self.assertTrue(original is clcommon.config.update_option(config,
+            'a.b.c', '1'))
+        self.assertTrue(clcommon.config.freeze(dict(a=1)) is
+            clcommon.config.freeze(dict(a=1)))
+        self.assertTrue(clcommon.config.freeze(dict(a=1))['a'] is not True)
+        self.assertTrue(clcommon.config.freeze(dict(a=True))['a'] is True)
 
     def test_method_help(self):
         self.assertEquals('test_method_help',
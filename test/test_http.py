@@ -15,18 +15,27 @@
 '''Tests for craigslist common http module.'''
 
 import httplib
+import json
+import shutil
 import socket
 import StringIO
+import tempfile
+import time
 import unittest
 
+import gevent
+import gevent.event
+
 import clcommon.config
 import clcommon.http
+import clcommon.stats
 
 HOST = '127.0.0.1'
 PORT = 8123
 CONFIG = clcommon.config.update(clcommon.http.DEFAULT_CONFIG, {
     'clcommon': {
         'http': {
+            'cookie_secret': ['secret', 'old secret'],
             'host': HOST,
             'port': PORT}}})
 
@@ -56,45 +65,97 @@ class TestFile(object):
         raise StopIteration()
 
 
+class MinimalServer(object):
+
+    log = None
+
+
 class TestRequest(clcommon.http.Request):
 
+    count = 0
+
     def run(self):
+        TestRequest.count += 1
+        if self.params.get('sleep'):
+            time.sleep(float(self.params['sleep']))
         if self.params.get('created'):
             return self.created()
         if self.params.get('no_content'):
             return self.no_content()
         if self.params.get('not_found'):
             raise clcommon.http.NotFound()
+        if self.params.get('not_found_auth'):
+            exception = clcommon.http.NotFound()
+            exception.headers.append(('WWW-Authenticate', 'Basic'))
+            raise exception
         if self.params.get('not_found_html'):
             raise clcommon.http.NotFound('<html><body>Oops</body></html>',
                 [('Content-Type', 'text/html')])
         if self.params.get('error'):
             raise Exception('unknown')
+        if self.params.get('socket_timeout'):
+            raise socket.timeout('backend')
         if self.params.get('set_content'):
             body = TestFile()
             return self.ok(self.set_content(self.params.get('name'), body))
         if self.params.get('set_content_json'):
             return self.ok(self.set_content(self.params.get('name'), {}))
+        if self.params.get('max_age'):
+            self.headers.append(('Cache-Control',
+                'max-age=%s, stale-while-revalidate=1' %
+                self.params['max_age']))
+            if self.params.get('public'):
+                self.headers.append(('Cache-Control', 'public'))
+            if self.params.get('vary'):
+                self.headers.append(('Vary', self.params['vary']))
+            return self.ok(str(TestRequest.count))
+        if self.params.get('stream'):
+            return self.stream(self._stream_producer,
+                events=self.params['stream'] == 'events', heartbeat=0.05)
+        if self.params.get('host'):
+            return self.ok(self.env.get('HTTP_HOST'))
         if self.params.get('parse_params'):
             self.parse_params(['str'], ['int'], ['bool'], ['list'])
         if 'test' in self.cookies:
             self.set_cookie('test', self.cookies['test'])
         if 'test_full' in self.cookies:
             self.set_cookie('test', 'found it', 100, '/', 'example.com')
+        if self.params.get('set_signed'):
+            self.set_signed_cookie('signed', self.params['set_signed'],
+                http_only=True)
+        if self.params.get('signed'):
+            return self.ok(str(self.signed_cookie('signed',
+                self.parse_int_param('signed'))))
         if self.body_data == '':
             return self.ok()
         return self.ok(self.body_data)
 
+    @staticmethod
+    def _stream_producer(channel):
+        '''Producer for streaming responses.'''
+        TestRequest.channel = channel
+        if channel._events:
+            channel.send_event('one\ntwo', 'test', 1)
+            time.sleep(0.12)
+            channel.send_event('three')
+            return
+        for count in xrange(3):
+            channel.send(str(count))
+        while True:
+            time.sleep(0.01)
+
 
 class ServerBase(unittest.TestCase):
     '''Base class for HTTP server testing.'''
 
+    config = CONFIG
+
     def __init__(self, *args, **kwargs):
         super(ServerBase, self).__init__(*args, **kwargs)
         self.server = None
 
     def setUp(self):
-        self.server = clcommon.http.Server(CONFIG, TestRequest)
+        self.server = clcommon.http.Server(self.config, TestRequest)
         self.server.start()
 
     def tearDown(self):
@@ -144,6 +205,56 @@ class TestServer(ServerBase):
             parts.remove(key.lower())
         self.assertEquals([], parts)
 
+    def test_signed_cookie(self):
+        response = request('GET', '/?set_signed=a|b')
+        cookie = response.getheader('Set-Cookie')
+        self.assertTrue(cookie.startswith('signed=a|b|'))
+        self.assertTrue(cookie.endswith('; HttpOnly'))
+        cookie = cookie.split(';')[0]
+        response = request('GET', '/?signed=60', headers={'Cookie': cookie})
+        self.assertEquals('a|b', response.read())
+        response = request('GET', '/?signed=-60', headers={'Cookie': cookie})
+        self.assertEquals('None', response.read())
+        response = request('GET', '/?signed=60',
+            headers={'Cookie': cookie.replace('a|b', 'a|c')})
+        self.assertEquals('None', response.read())
+        response = request('GET', '/?signed=60',
+            headers={'Cookie': 'signed=x'})
+        self.assertEquals('None', response.read())
+        env = {'REQUEST_METHOD': 'GET', 'wsgi.input': TestFile()}
+        test_request = TestRequest(self.server, env, None)
+        self.assertRaises(ValueError, test_request.set_signed_cookie, 'a|b',
+            'c')
+        self.assertRaises(ValueError, test_request.set_signed_cookie, 'a;b',
+            'c')
+        self.server.cookie_keys = []
+        self.assertRaises(ValueError, test_request.set_signed_cookie, 'a',
+            'c')
+
+    def test_rotated_cookie_secret(self):
+        key = self.server.cookie_keys[1]
+        cookie = 'signed=a|1|%s' % clcommon.http._sign(key, 'signed', 'a', '1')
+        response = request('GET', '/?signed=1', headers={'Cookie': cookie})
+        self.assertEquals('None', response.read())
+        response = request('GET', '/?signed=2000000000',
+            headers={'Cookie': cookie})
+        self.assertEquals('a', response.read())
+
+    def test_format_cookie(self):
+        self.assertEquals('a=b', clcommon.http.format_cookie('a', 'b'))
+        self.assertEquals('a="b c\\073\\"d\\\\"; Max-Age=10; Secure; '
+            'SameSite=Lax', clcommon.http.format_cookie('a', 'b c;"d\\',
+                max_age=10, secure=True, same_site='Lax'))
+        self.assertEquals('a=1; Expires=x',
+            clcommon.http.format_cookie('a', 1, 'x'))
+        cookie = clcommon.http.format_cookie('a', 'b c;"d\\')
+        self.assertEquals({'a': 'b c;"d\\', 'e': None, 'f': ''},
+            clcommon.http.parse_cookies(cookie + '; e; f='))
+        self.assertEquals({}, clcommon.http.parse_cookies(None))
+        for name in ['', 'a b', 'a;b', 'a=b', 'a\r\nb', 'a:b']:
+            self.assertRaises(ValueError, clcommon.http.format_cookie, name,
+                'b')
+
     def test_content(self):
         response = request('GET', '/?set_content=1&name=test.html')
         self.assertEquals('0', response.getheader('Content-Length'))
@@ -167,6 +278,68 @@ class TestServer(ServerBase):
 
     def test_header_exists(self):
         self.assertTrue(clcommon.http.header_exists('test', [('test', '1')]))
+        self.assertTrue(clcommon.http.header_exists('TEST', [('test', '1')]))
+        self.assertFalse(clcommon.http.header_exists('x', [('test', '1')]))
+
+    def test_headers(self):
+        headers = clcommon.http.Headers([('Server', 'test')])
+        self.assertTrue(clcommon.http.header_exists('server', headers))
+        headers.append(('Set-Cookie', 'a=1'))
+        headers.insert(0, ('Set-Cookie', 'b=1'))
+        headers.extend([('Content-Type', 'text/plain')])
+        copy = clcommon.http.Headers(headers)
+        headers.remove(('Set-Cookie', 'a=1'))
+        self.assertTrue(headers.exists('set-cookie'))
+        self.assertEquals('b=1', headers.get('Set-Cookie'))
+        headers.pop(0)
+        self.assertFalse(headers.exists('Set-Cookie'))
+        self.assertEquals(None, headers.get('Set-Cookie'))
+        del headers[0]
+        self.assertFalse(headers.exists('Server'))
+        headers[0] = ('X-Test', '1')
+        self.assertFalse(headers.exists('Content-Type'))
+        self.assertTrue(headers.exists('x-test'))
+        headers[:] = [('Server', 'test')]
+        self.assertEquals(['server'], headers._names.keys())
+        self.assertEquals(4, len(copy))
+        self.assertTrue(copy.exists('Set-Cookie'))
+
+    def test_request_headers(self):
+        env = {'REQUEST_METHOD': 'GET', 'wsgi.input': TestFile()}
+        request = TestRequest(self.server, env, None)
+        self.assertTrue(request.headers.exists('Server'))
+        request = TestRequest(MinimalServer(), env, None)
+        self.assertEquals([], request.headers)
+
+    def test_content_type(self):
+        self.assertEquals('text/html', clcommon.http.content_type('a.html'))
+        self.assertEquals('text/html', clcommon.http.content_type('b.html'))
+        self.assertEquals('application/octet-stream',
+            clcommon.http.content_type('a.unknown'))
+        self.assertEquals('text/html', clcommon.http._CONTENT_TYPES['.html'])
+
+    def test_no_stats_path(self):
+        response = request('GET', '/_stats')
+        self.assertEquals(200, response.status)
+        self.assertEquals('', response.read())
+
+    def test_default_response(self):
+        request('GET', '/?not_found=1').read()
+        response = request('GET', '/?not_found=1')
+        self.assertEquals(404, response.status)
+        self.assertEquals('404 Not Found', response.read())
+        self.assertEquals(1, len(self.server._responses))
+        self.assertEquals("status=404 Not Found headers=None",
+            str(clcommon.http.NotFound()))
+
+    def test_changed_default_response(self):
+        response = request('GET', '/?not_found_auth=1')
+        self.assertEquals(404, response.status)
+        self.assertEquals('Basic', response.getheader('WWW-Authenticate'))
+        response.read()
+        response = request('GET', '/?not_found=1')
+        self.assertEquals(404, response.status)
+        self.assertEquals(None, response.getheader('WWW-Authenticate'))
 
     def test_parse_params(self):
         response = request('PUT', '/?parse_params=1&str=test')
@@ -208,6 +381,376 @@ class TestServer(ServerBase):
         self.assertEquals(500, response.status)
 
 
+class TestCache(ServerBase):
+
+    config = clcommon.config.update(CONFIG, {
+        'clcommon': {'http': {'cache_size': 1024}}})
+
+    def test_cache(self):
+        body = request('GET', '/?max_age=60').read()
+        response = request('GET', '/?max_age=60')
+        self.assertEquals(body, response.read())
+        self.assertEquals('0', response.getheader('Age'))
+        self.assertNotEquals(body, request('GET', '/?max_age=60',
+            headers={'Cache-Control': 'no-cache'}).read())
+        self.assertNotEquals(body, request('GET', '/?max_age=60&a=1').read())
+        self.assertEquals(1, self.server.stats['cache_hit'])
+        self.assertEquals(3, self.server.stats['cache_store'])
+
+    def test_uncached(self):
+        count = TestRequest.count
+        request('GET', '/').read()
+        request('GET', '/').read()
+        request('PUT', '/?max_age=60').read()
+        request('PUT', '/?max_age=60').read()
+        self.assertEquals(count + 4, TestRequest.count)
+        self.assertEquals(0, self.server.stats['cache_store'])
+
+    def test_stale(self):
+        body = request('GET', '/?max_age=0').read()
+        self.assertEquals(0, self.server.stats['cache_store'])
+        self.server._cache_ttl = 0.1
+        body = request('GET', '/?max_age=x').read()
+        time.sleep(0.2)
+        self.assertEquals(body, request('GET', '/?max_age=x').read())
+        time.sleep(0.1)
+        self.assertNotEquals(body, request('GET', '/?max_age=x').read())
+        self.assertTrue(self.server.stats['cache_stale'] > 0)
+
+    def test_credentials(self):
+        for headers in ({'Authorization': 'Basic dGVzdA=='},
+                {'Cookie': 'other=1'}):
+            body = request('GET', '/?max_age=60', headers=headers).read()
+            self.assertNotEquals(body, request('GET', '/?max_age=60',
+                headers=headers).read())
+        self.assertEquals(0, self.server.stats['cache_store'])
+        body = request('GET', '/?max_age=60').read()
+        self.assertNotEquals(body, request('GET', '/?max_age=60',
+            headers=headers).read())
+        self.assertEquals(body, request('GET', '/?max_age=60').read())
+        body = request('GET', '/?max_age=60&public=1', headers=headers).read()
+        self.assertEquals(body, request('GET', '/?max_age=60&public=1',
+            headers=headers).read())
+        self.server._cache_vary = ['HTTP_COOKIE']
+        body = request('GET', '/?max_age=60&a=1', headers=headers).read()
+        self.assertEquals(body, request('GET', '/?max_age=60&a=1',
+            headers=headers).read())
+
+    def test_vary(self):
+        for vary in ('Accept-Encoding', '*', 'Accept,Accept-Encoding'):
+            url = '/?max_age=60&vary=%s' % vary
+            body = request('GET', url).read()
+            self.assertNotEquals(body, request('GET', url).read())
+        self.assertEquals(0, self.server.stats['cache_store'])
+        self.server._cache_vary = ['HTTP_ACCEPT', 'HTTP_ACCEPT_ENCODING']
+        body = request('GET', url).read()
+        self.assertEquals(body, request('GET', url).read())
+
+    def test_evict(self):
+        for count in xrange(50):
+            request('GET', '/?max_age=60&body=%d' % count).read()
+        self.assertTrue(self.server._cache.used <= 1024)
+        self.assertTrue(self.server.stats['cache_evict'] > 0)
+
+
+class TestWarmup(ServerBase):
+
+    config = clcommon.config.update(CONFIG, {
+        'clcommon': {
+            'http': {
+                'cache_size': 10000,
+                'cache_ttl': 10,
+                'warmup_paths': ['/?max_age=60', '/?not_found=1']}}})
+
+    def test_warmup(self):
+        self.server.warmup()
+        self.assertEquals(1, self.server.stats['cache_store'])
+        self.assertEquals({}, self.server.routes)
+        response = request('GET', '/?max_age=60')
+        self.assertEquals(200, response.status)
+        self.assertEquals(1, self.server.stats['cache_hit'])
+
+
+class TestAdmission(ServerBase):
+
+    config = clcommon.config.update(CONFIG, {
+        'clcommon': {
+            'http': {
+                'max_requests': 1,
+                'queue_size': 1,
+                'queue_timeout': 0.2}}})
+
+    def test_queue(self):
+        greenlets = [gevent.spawn(request, 'GET', '/?sleep=0.1')
+            for _count in xrange(3)]
+        gevent.joinall(greenlets)
+        statuses = sorted(greenlet.value.status for greenlet in greenlets)
+        self.assertEquals([200, 200, 503], statuses)
+        response = [greenlet.value for greenlet in greenlets
+            if greenlet.value.status == 503][0]
+        self.assertEquals('1', response.getheader('Retry-After'))
+        self.assertEquals(1, self.server.stats['admission_rejected'])
+        self.assertEquals(1, self.server.stats['admission_waited'])
+        self.assertEquals(0, self.server.stats['admission_active'])
+        self.assertEquals(0, self.server.stats['admission_queued'])
+
+    def test_timeout(self):
+        greenlets = [gevent.spawn(request, 'GET', '/?sleep=0.3')
+            for _count in xrange(2)]
+        gevent.joinall(greenlets)
+        statuses = sorted(greenlet.value.status for greenlet in greenlets)
+        self.assertEquals([200, 503], statuses)
+        self.assertEquals(1, self.server.stats['admission_timeout'])
+
+    def test_fifo(self):
+        order = []
+        release = gevent.event.Event()
+
+        def cached(env, _start):
+            order.append(env)
+            if env == 'first':
+                release.wait()
+            return env
+
+        def first_then_third():
+            self.server._admit('first', None)
+            return self.server._admit('third', None)
+
+        self.server._cached = cached
+        first = gevent.spawn(first_then_third)
+        gevent.sleep(0)
+        second = gevent.spawn(self.server._admit, 'second', None)
+        gevent.sleep(0)
+        self.assertEquals(1, self.server.stats['admission_queued'])
+        release.set()
+        gevent.joinall([first, second])
+        self.assertEquals(['first', 'second', 'third'], order)
+        self.assertEquals(['third', 'second'], [first.value, second.value])
+        self.assertEquals(2, self.server.stats['admission_waited'])
+        self.assertEquals(0, self.server.stats['admission_active'])
+        self.assertEquals(0, self.server.stats['admission_queued'])
+        self.assertEquals(0, self.server._admitted)
+
+
+class TestStats(ServerBase):
+
+    config = clcommon.config.update(CONFIG, {
+        'clcommon': {'http': {'stats_path': '/_stats'}}})
+
+    def test_stats(self):
+        request('GET', '/').read()
+        request('PUT', '/test/path', body='test body').read()
+        request('GET', '/test?not_found=1').read()
+        stats = json.loads(request('GET', '/_stats').read())
+        self.assertEquals(1, stats['routes']['/']['requests'])
+        self.assertEquals(2, stats['routes']['/test']['requests'])
+        self.assertEquals(dict([('200', 1), ('404', 1)]),
+            stats['routes']['/test']['status'])
+        self.assertEquals(9, stats['routes']['/test']['bytes_in'])
+        self.assertEquals(2, stats['routes']['/test']['latency_us']['count'])
+        self.assertTrue('cache_hit' in stats['counters'])
+
+    def test_routes(self):
+        self.server._stats_routes = ['/a/b', '/a']
+        request('GET', '/a/b/c').read()
+        request('GET', '/b').read()
+        self.assertEquals(['/a/b', 'other'], sorted(self.server.routes))
+        self.server._stats_routes = []
+        self.server._stats_max_routes = 2
+        request('GET', '/c').read()
+        self.assertEquals(2, self.server.routes['other']['requests'])
+
+    def test_all(self):
+        stats_dir = tempfile.mkdtemp()
+        try:
+            self.server._stats_dir = stats_dir
+            request('GET', '/').read()
+            clcommon.stats.save(stats_dir, self.server.get_stats())
+            stats = json.loads(request('GET', '/_stats?all=1').read())
+            self.assertEquals(1, stats['processes'])
+            self.assertEquals(1, stats['routes']['/']['requests'])
+        finally:
+            shutil.rmtree(stats_dir)
+
+
+class TestAccessLog(ServerBase):
+
+    config = clcommon.config.update(CONFIG, {
+        'clcommon': {
+            'http': {
+                'access_log': 'buffered',
+                'access_log_buffer': 2}}})
+
+    def test_buffered(self):
+        for _count in xrange(3):
+            request('GET', '/').read()
+        self.assertEquals(2, self.server.stats['access_log_written'])
+        self.server.stop()
+        self.assertEquals(3, self.server.stats['access_log_written'])
+        self.assertEquals(None, self.server._access_log._writer)
+        self.server.start()
+
+    def test_sample(self):
+        self.server._access_log._sample = 0
+        request('GET', '/').read()
+        self.assertEquals(1, self.server.stats['access_log_sampled'])
+
+    def test_dropped(self):
+        self.server._access_log._pending = 0
+        for _count in xrange(2):
+            request('GET', '/').read()
+        self.assertEquals(2, self.server.stats['access_log_dropped'])
+
+
+class TestTimeouts(ServerBase):
+
+    config = clcommon.config.update(CONFIG, {
+        'clcommon': {
+            'http': {
+                'body_timeout': 0.1,
+                'connection_requests': 2,
+                'header_timeout': 0.1,
+                'idle_timeout': 0.1}}})
+
+    def test_idle(self):
+        client = socket.create_connection((HOST, PORT))
+        self.assertEquals('', client.recv(1024))
+        self.assertEquals(1, self.server.stats['reaped_idle'])
+
+    def test_header(self):
+        client = socket.create_connection((HOST, PORT))
+        client.sendall('GET / HTTP/1.1\r\n')
+        self.assertTrue(client.recv(1024).startswith('HTTP/1.1 400'))
+        self.assertEquals(1, self.server.stats['reaped_header'])
+
+    def test_body(self):
+        client = socket.create_connection((HOST, PORT))
+        client.sendall('PUT / HTTP/1.1\r\nContent-Length: 10\r\n\r\ntest')
+        self.assertTrue(client.recv(1024).startswith('HTTP/1.1 408'))
+        self.assertEquals(1, self.server.stats['reaped_body'])
+
+    def test_other_timeout(self):
+        self.assertEquals(500, request('GET', '/?socket_timeout=1').status)
+        self.assertEquals(0, self.server.stats['reaped_body'])
+
+    def test_connection_requests(self):
+        connection = httplib.HTTPConnection(HOST, PORT)
+        connection.request('GET', '/')
+        response = connection.getresponse()
+        response.read()
+        self.assertFalse(response.will_close)
+        connection.request('GET', '/')
+        response = connection.getresponse()
+        response.read()
+        self.assertTrue(response.will_close)
+        self.assertEquals(1, self.server.stats['reaped_requests'])
+        self.assertEquals(1, self.server.stats['connections'])
+
+
+class TestLongIdleTimeout(ServerBase):
+
+    config = clcommon.config.update(CONFIG, {
+        'clcommon': {
+            'http': {
+                'body_timeout': 0.1,
+                'idle_timeout': 0.4}}})
+
+    def test_idle(self):
+        client = socket.create_connection((HOST, PORT))
+        time.sleep(0.2)
+        client.sendall('GET / HTTP/1.1\r\n')
+        time.sleep(0.2)
+        client.sendall('\r\n')
+        self.assertTrue(client.recv(1024).startswith('HTTP/1.1 200'))
+        self.assertEquals(0, self.server.stats['reaped_idle'])
+        self.assertEquals(0, self.server.stats['reaped_header'])
+        start = time.time()
+        self.assertEquals('', client.recv(1024))
+        self.assertTrue(0.3 < time.time() - start < 0.6)
+        self.assertEquals(1, self.server.stats['reaped_idle'])
+
+
+class TestDrain(ServerBase):
+
+    def test_drain(self):
+        idle = httplib.HTTPConnection(HOST, PORT)
+        idle.request('GET', '/')
+        idle.getresponse().read()
+        busy = httplib.HTTPConnection(HOST, PORT)
+        busy.request('GET', '/?sleep=0.2')
+        gevent.sleep(0.05)
+        self.assertEquals(2, self.server.stats['connections_active'])
+        drain = gevent.spawn(self.server.drain, 1)
+        response = busy.getresponse()
+        self.assertEquals(200, response.status)
+        self.assertTrue(response.will_close)
+        self.assertTrue(drain.get())
+        self.assertEquals(0, self.server.stats['connections_active'])
+        self.assertEquals('', idle.sock.recv(1024))
+
+    def test_timeout(self):
+        busy = httplib.HTTPConnection(HOST, PORT)
+        busy.request('GET', '/?sleep=0.3')
+        gevent.sleep(0.05)
+        self.assertFalse(self.server.drain(0.1))
+        self.assertEquals(200, busy.getresponse().status)
+
+    def test_restart(self):
+        self.server.stop()
+        self.server.start()
+        self.assertEquals(200, request('GET', '/').status)
+
+    def test_stop_timeout(self):
+        busy = httplib.HTTPConnection(HOST, PORT)
+        busy.request('GET', '/?sleep=0.5')
+        gevent.sleep(0.05)
+        started = time.time()
+        self.server.stop(0.2)
+        self.assertTrue(time.time() - started < 0.35)
+        self.server.start()
+
+
+class TestStreaming(ServerBase):
+
+    def test_events(self):
+        response = request('GET', '/?stream=events')
+        self.assertEquals('text/event-stream',
+            response.getheader('Content-Type'))
+        self.assertEquals('chunked', response.getheader('Transfer-Encoding'))
+        body = response.read()
+        self.assertTrue(body.startswith(
+            'event: test\nid: 1\ndata: one\ndata: two\n\n:\n\n'))
+        self.assertTrue(body.endswith(':\n\ndata: three\n\n'))
+        self.assertTrue(TestRequest.channel.closed)
+
+    def test_disconnect(self):
+        client = socket.create_connection((HOST, PORT))
+        client.sendall('GET /?stream=1 HTTP/1.1\r\n\r\n')
+        data = ''
+        while '2\r\n' not in data:
+            data += client.recv(1024)
+        channel = TestRequest.channel
+        self.assertFalse(channel.closed)
+        client.close()
+        time.sleep(0.1)
+        self.assertTrue(channel.closed)
+        self.assertTrue(channel.producer.dead)
+        self.assertRaises(clcommon.http.ClientDisconnected, channel.send, 'x')
+
+    def test_error(self):
+
+        def producer(channel):
+            '''Producer that fails after sending some data.'''
+            channel.send('test')
+            raise Exception('test')
+
+        channel = clcommon.http.Channel(None, False, None, 1)
+        request = TestRequest(self.server, {'REQUEST_METHOD': 'GET',
+            'wsgi.input': TestFile(), 'SERVER_SOFTWARE': 'test'}, None)
+        gevent.spawn(request._produce, producer, channel)
+        self.assertEquals(['test'], list(channel))
+
+
 class TestChunk(ServerBase):
 
     def test_chunk(self):
@@ -227,3 +770,107 @@ class TestStream(ServerBase):
             data += chunk
         self.assertEquals('test body', data)
         self.assertEquals(int(stream.content_length), len(data))
+
+
+class TestClient(ServerBase):
+
+    def test_request(self):
+        client = clcommon.http.Client(CONFIG)
+        stream = client.request('PUT', 'http://%s:%d/' % (HOST, PORT),
+            'test body')
+        self.assertEquals(200, stream.status)
+        self.assertEquals('test body', ''.join(stream))
+        self.assertEquals(1, len(client._pools.values()[0]))
+        client.close()
+
+    def test_reuse(self):
+        client = clcommon.http.Client(CONFIG)
+        url = 'http://%s:%d/' % (HOST, PORT)
+        client.request('GET', url).read()
+        connection = client._pools.values()[0][0][0]
+        stream = client.request('GET', url)
+        self.assertEquals(0, len(client._pools.values()[0]))
+        stream.read()
+        self.assertEquals(connection, client._pools.values()[0][0][0])
+        connection.sock.close()
+        self.assertEquals(200, client.request('GET', url).status)
+
+    def test_no_retry(self):
+        client = clcommon.http.Client(CONFIG)
+        url = 'http://%s:%d/' % (HOST, PORT)
+        client.request('GET', url).read()
+        client._pools.values()[0][0][0].sock.close()
+        self.assertRaises(socket.error, client.request, 'POST', url, 'test')
+
+    def test_reopen_timeout(self):
+        client = clcommon.http.Client(CONFIG)
+        url = 'http://%s:%d/' % (HOST, PORT)
+        client.request('GET', url).read()
+        connection = client._pools.values()[0][0][0]
+        connection.close()
+        self.assertEquals(200, client.request('GET', url).status)
+        self.assertEquals(10, connection.sock.gettimeout())
+
+    def test_pool_size(self):
+        config = clcommon.config.update(CONFIG, {
+            'clcommon': {'http_client': {'pool_size': 1}}})
+        client = clcommon.http.Client(config)
+        url = 'http://%s:%d/' % (HOST, PORT)
+        streams = [client.request('GET', url), client.request('GET', url)]
+        for stream in streams:
+            stream.read()
+        self.assertEquals(1, len(client._pools.values()[0]))
+
+    def test_idle_timeout(self):
+        config = clcommon.config.update(CONFIG, {
+            'clcommon': {'http_client': {'idle_timeout': -1}}})
+        client = clcommon.http.Client(config)
+        url = 'http://%s:%d/' % (HOST, PORT)
+        client.request('GET', url).read()
+        connection = client._pools.values()[0][0][0]
+        client.request('GET', url).read()
+        self.assertNotEquals(connection, client._pools.values()[0][0][0])
+
+    def test_coalesce(self):
+        config = clcommon.config.update(CONFIG, {
+            'clcommon': {'http_client': {'coalesce': True}}})
+        client = clcommon.http.Client(config)
+        url = 'http://%s:%d/?sleep=0.1' % (HOST, PORT)
+        count = TestRequest.count
+        greenlets = [gevent.spawn(client.request, 'GET', url)
+            for _count in xrange(5)]
+        gevent.joinall(greenlets)
+        self.assertEquals(count + 1, TestRequest.count)
+        for greenlet in greenlets:
+            self.assertEquals(200, greenlet.value.status)
+            self.assertEquals('', greenlet.value.read())
+        self.assertEquals({}, client._in_flight)
+
+    def test_coalesce_killed(self):
+        config = clcommon.config.update(CONFIG, {
+            'clcommon': {'http_client': {'coalesce': True}}})
+        client = clcommon.http.Client(config)
+        url = 'http://%s:%d/?sleep=0.2' % (HOST, PORT)
+        first = gevent.spawn(client.request, 'GET', url)
+        gevent.sleep(0.05)
+        second = gevent.spawn(client.request, 'GET', url)
+        gevent.sleep(0.05)
+        first.kill()
+        second.join(1)
+        self.assertTrue(isinstance(second.exception, socket.error))
+        self.assertEquals({}, client._in_flight)
+
+    def test_pipeline(self):
+        client = clcommon.http.Client(CONFIG)
+        url = 'http://%s:%d/' % (HOST, PORT)
+        count = TestRequest.count
+        streams = client.pipeline('GET', [url, url + '?created=1', url])
+        self.assertEquals([200, 201, 200],
+            [stream.status for stream in streams])
+        self.assertEquals(count + 3, TestRequest.count)
+        self.assertEquals(1, len(client._pools.values()[0]))
+        self.assertRaises(ValueError, client.pipeline, 'GET',
+            [url, 'http://example.com/'])
+        streams = client.pipeline('GET', [url + '?host=1'],
+            {'Host': 'example.com'})
+        self.assertEquals('example.com', streams[0].read())
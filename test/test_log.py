@@ -33,6 +33,11 @@ class TestLog(unittest.TestCase):
                     'syslog_ident': 'test'}}})
         clcommon.log.setup(config)
         self.assertEquals(logging.ERROR, logging.getLogger().level)
+        config = clcommon.config.update(config, {
+            'clcommon': {'log': {'syslog_address': [None, 514]}}})
+        clcommon.log.setup(config)
+        self.assertEquals((None, 514),
+            config['clcommon']['log']['syslog_address'])
 
     def test_get_log(self):
         logger = clcommon.log.get_log('test', logging.DEBUG)
@@ -0,0 +1,121 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Tests for craigslist common process module.'''
+
+import os
+import select
+import shutil
+import signal
+import socket
+import tempfile
+import unittest
+
+import clcommon.process
+
+
+class TestAffinity(unittest.TestCase):
+
+    def test_affinity(self):
+        cpus = clcommon.process.get_affinity()
+        self.assertTrue(len(cpus) > 0)
+        try:
+            clcommon.process.set_affinity(cpus[:1])
+            self.assertEquals(cpus[:1], clcommon.process.get_affinity())
+        finally:
+            clcommon.process.set_affinity(cpus)
+        self.assertEquals(cpus, clcommon.process.get_affinity())
+
+    def test_invalid(self):
+        self.assertRaises(OSError, clcommon.process.set_affinity, [1023])
+
+
+class TestParentDeath(unittest.TestCase):
+
+    def test_parent_death_signal(self):
+        clcommon.process.set_parent_death_signal(signal.SIGTERM)
+        try:
+            self.assertEquals(signal.SIGTERM,
+                clcommon.process.get_parent_death_signal())
+        finally:
+            clcommon.process.set_parent_death_signal(0)
+        self.assertEquals(0, clcommon.process.get_parent_death_signal())
+
+    def test_invalid(self):
+        self.assertRaises(OSError,
+            clcommon.process.set_parent_death_signal, 1000)
+
+
+class TestCPUList(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEquals([0, 1, 2, 3, 8, 10, 11],
+            clcommon.process.parse_cpu_list('0-3,8,10-11\n'))
+        self.assertEquals([], clcommon.process.parse_cpu_list(''))
+        self.assertEquals([4, 5], clcommon.process.parse_cpu_list([4, 5]))
+
+    def test_numa_nodes(self):
+        path = tempfile.mkdtemp()
+        try:
+            for node, cpus in [(1, '4-7'), (0, '0-3'), (2, '')]:
+                os.mkdir(os.path.join(path, 'node%d' % node))
+                open(os.path.join(path, 'node%d' % node, 'cpulist'),
+                    'w').write(cpus)
+            os.mkdir(os.path.join(path, 'node3'))
+            self.assertEquals([[0, 1, 2, 3], [4, 5, 6, 7]],
+                clcommon.process.numa_nodes(path))
+        finally:
+            shutil.rmtree(path)
+
+    def test_no_numa(self):
+        self.assertEquals([], clcommon.process.numa_nodes('/does/not/exist'))
+
+
+class TestLoad(unittest.TestCase):
+
+    def test_cpu_time(self):
+        start = clcommon.process.cpu_time(os.getpid())
+        deadline = start + 0.05
+        while clcommon.process.cpu_time(os.getpid()) < deadline:
+            pass
+        self.assertTrue(clcommon.process.cpu_time(os.getpid()) >= deadline)
+
+    def test_rss(self):
+        start = clcommon.process.rss(os.getpid())
+        self.assertTrue(start > 0)
+        data = 'x' * (16 * 1024 * 1024)
+        self.assertTrue(clcommon.process.rss(os.getpid()) >
+            start + len(data) / 2)
+
+    def test_listen_queue(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        self.assertEquals((0, 5), clcommon.process.listen_queue(sock))
+        clients = [socket.create_connection(sock.getsockname())
+            for _count in xrange(2)]
+        self.assertEquals((2, 5), clcommon.process.listen_queue(sock))
+        sock.accept()[0].close()
+        self.assertEquals((1, 5), clcommon.process.listen_queue(sock))
+        for client in clients:
+            client.close()
+        sock.close()
+
+    def test_pidfd_open(self):
+        try:
+            pidfd = clcommon.process.pidfd_open(os.getpid())
+        except OSError:
+            return
+        self.assertEquals([], select.select([pidfd], [], [], 0)[0])
+        os.close(pidfd)
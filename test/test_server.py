@@ -0,0 +1,666 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Tests for craigslist common server module. These drive the parent's
+state directly and never fork.'''
+
+import fcntl
+import itertools
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import unittest
+
+import clcommon.config
+import clcommon.process
+import clcommon.server
+import clcommon.stats
+
+
+class TestLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = clcommon.server._Loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_timers(self):
+        calls = []
+        self.loop.call_later(0.02, calls.append, 'c')
+        self.loop.call_later(0.01, calls.append, 'a')
+        cancelled = self.loop.call_later(0.01, calls.append, 'x')
+        self.loop.call_later(0.01, calls.append, 'b')
+        cancelled.cancel()
+        while len(calls) < 3:
+            self.loop.run_once()
+        self.assertEquals(['a', 'b', 'c'], calls)
+        self.assertEquals([], self.loop._timers)
+
+    def test_reader(self):
+        calls = []
+        read_fd, write_fd = os.pipe()
+        try:
+            self.loop.add_reader(read_fd, lambda: calls.append(
+                os.read(read_fd, 1)))
+            self.loop.call_later(0.01, calls.append, 'timer')
+            os.write(write_fd, '1')
+            self.loop.run_once()
+            self.assertEquals(['1'], calls)
+            self.loop.remove_reader(read_fd)
+            os.write(write_fd, '2')
+            self.loop.run_once()
+            self.assertEquals(['1', 'timer'], calls)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+
+class Managed(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.preloaded = 0
+
+    def preload(self):
+        '''Count preloads.'''
+        self.preloaded += 1
+
+    def start(self):
+        '''Start in a child.'''
+
+    def stop(self, timeout):
+        '''Stop in a child.'''
+
+
+class ServerBase(unittest.TestCase):
+
+    config = {}
+    managed = None
+
+    def setUp(self):
+        self.server = self.load(clcommon.server.Server, self.config,
+            managed=self.managed)
+        self.server._loop = clcommon.server._Loop()
+        self.group = self.server._groups['default']
+        self.killed = []
+        self._kill = os.kill
+        os.kill = lambda pid, number: self.killed.append((pid, number))
+        self.started = []
+        self.pids = itertools.count(1001)
+        self.ready = {}
+        self.server._start_child_wrapper = self.start_child
+
+    def tearDown(self):
+        os.kill = self._kill
+        for child in self.server._children.itervalues():
+            child.close()
+        for fd in self.ready.itervalues():
+            os.close(fd)
+        self.server._loop.close()
+
+    @staticmethod
+    def load(method, *args, **kwargs):
+        '''Call a method that loads the config without the command line
+        arguments of the test runner.'''
+        argv = sys.argv
+        sys.argv = argv[:1]
+        try:
+            return method(*args, **kwargs)
+        finally:
+            sys.argv = argv
+
+    def start_child(self, group, slot):
+        '''Add a child to a slot of a group instead of forking one. The
+        write end of its ready pipe is kept in ready.'''
+        self.started.append((group.name, slot))
+        pid = next(self.pids)
+        ready_read, self.ready[pid] = os.pipe()
+        fcntl.fcntl(ready_read, fcntl.F_SETFL,
+            fcntl.fcntl(ready_read, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.server._children[pid] = clcommon.server._Child(pid,
+            group.name, slot, ready_read)
+        return pid
+
+    def child(self, pid, ready=None):
+        '''Make a child as though it had been forked into slot 0.'''
+        return clcommon.server._Child(pid, self.group.name, 0, ready)
+
+
+class TestReady(ServerBase):
+
+    def test_ready(self):
+        read_fd, write_fd = os.pipe()
+        fcntl.fcntl(read_fd, fcntl.F_SETFL,
+            fcntl.fcntl(read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        results = []
+        child = self.child(1, read_fd)
+        child.on_ready = results.append
+        child.ready_timer = self.server._loop.call_later(10, list)
+        self.server._child_ready(child, True)
+        self.assertEquals([], results)
+        self.assertEquals(read_fd, child.ready)
+        os.write(write_fd, '1')
+        self.server._child_ready(child, True)
+        self.assertEquals([True], results)
+        self.assertEquals(None, child.ready)
+        self.assertTrue(child.ready_timer.cancelled)
+        os.close(write_fd)
+
+    def test_not_ready(self):
+        read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+        results = []
+        child = self.child(1, read_fd)
+        child.on_ready = results.append
+        child.ready_timer = self.server._loop.call_later(10, list)
+        self.server._child_ready(child, True)
+        self.assertEquals([False], results)
+        self.assertEquals(None, child.ready)
+
+
+class TestRestart(ServerBase):
+
+    config = {
+        'clcommon': {
+            'server': {
+                'crash_limit': 2,
+                'crash_window': 60,
+                'restart_backoff': 1,
+                'restart_backoff_max': 4,
+                'restart_reset': 30}}}
+
+    def crash(self, pid, started=None):
+        '''Have a child in slot 0 exit and return the restart delay.'''
+        child = self.child(pid)
+        if started is not None:
+            child.started = started
+        self.server._children[pid] = child
+        self.server._child_exited(pid, 256)
+        timer = self.server._pending.pop((self.group.name, 0))
+        timer.cancel()
+        return timer.deadline - time.time()
+
+    def test_backoff(self):
+        self.assertTrue(self.crash(1) <= 0)
+        for pid, low, high in ((2, 0.5, 1), (3, 1, 2), (4, 2, 4),
+                (5, 2, 4)):
+            delay = self.crash(pid)
+            self.assertTrue(low - 0.1 < delay <= high, delay)
+        self.assertTrue(self.crash(6, time.time() - 60) <= 0)
+        self.assertEquals(6, self.server.restarts['crashes'])
+        self.assertEquals(4, self.server.restarts['delayed'])
+
+    def test_breaker(self):
+        key = (self.group.name, 0)
+        now = time.time()
+        self.group.crashes.extend([now - 10, now - 5])
+        self.server._pending[key] = None
+        self.server._restart(self.group, 0)
+        self.assertTrue(self.group.breaker)
+        self.assertEquals(1, self.server.restarts['breaker'])
+        timer = self.server._pending[key]
+        timer.cancel()
+        self.assertTrue(49 < timer.deadline - now < 51)
+        self.group.crashes.popleft()
+        self.group.target = 0
+        self.server._restart(self.group, 0)
+        self.assertFalse(self.group.breaker)
+        self.assertEquals({}, self.server._pending)
+        self.assertEquals(0, self.server.restarts['restarts'])
+
+
+class TestRecycle(ServerBase):
+
+    def recycle_reason(self, child, **config):
+        '''Get the recycle reason for a child with the given limits.'''
+        config = clcommon.config.update(self.group.config, config)
+        return self.server._recycle_reason(config, child, time.time())
+
+    def test_age(self):
+        child = self.child(1)
+        child.started = time.time() - 95
+        self.assertEquals(None, self.recycle_reason(child))
+        self.assertEquals(None, self.recycle_reason(child, recycle_age=100))
+        child.recycle_scale = 0.9
+        self.assertEquals('age=95',
+            self.recycle_reason(child, recycle_age=100))
+
+    def test_requests(self):
+        self.server._shared = clcommon.stats.Shared(1, 2)
+        counters = clcommon.stats.Counters(['requests'])
+        self.server._shared.attach(0, [counters])
+        child = self.child(1)
+        self.assertEquals(None, self.recycle_reason(child,
+            recycle_requests=1))
+        child.shared = 0
+        child.counter_names = counters.names
+        counters['requests'] = 10
+        self.assertEquals(None, self.recycle_reason(child,
+            recycle_requests=10))
+        child.recycle_scale = 0.9
+        self.assertEquals('requests=10', self.recycle_reason(child,
+            recycle_requests=10))
+
+    def test_rss(self):
+        child = self.child(os.getpid())
+        rss = clcommon.process.rss(child.pid)
+        self.assertEquals(None, self.recycle_reason(child,
+            recycle_rss=rss * 2))
+        self.assertTrue(self.recycle_reason(child,
+            recycle_rss=rss / 2).startswith('rss='))
+        child.pid = 0
+        self.assertEquals(None, self.recycle_reason(child, recycle_rss=1))
+
+
+class TestAdmin(ServerBase):
+
+    def setUp(self):
+        ServerBase.setUp(self)
+        server_sock, self.client = socket.socketpair()
+        self.connection = clcommon.server._AdminConnection(server_sock)
+        self.responses = self.client.makefile()
+
+    def tearDown(self):
+        self.connection.sock.close()
+        self.client.close()
+        ServerBase.tearDown(self)
+
+    def request(self, line):
+        '''Run an admin request and get the response.'''
+        self.server._admin_request(self.connection, line)
+        return json.loads(self.responses.readline())
+
+    def test_invalid(self):
+        for line in ('{"command": ', '[]', '{}', '"stats"',
+                '{"command": "unknown"}', '{"command": 1}'):
+            self.assertEquals(dict(error='Invalid request'),
+                self.request(line))
+
+    def test_stats(self):
+        response = self.request('{"command": "stats"}')
+        self.assertEquals(self.server.get_stats(), response)
+        self.assertEquals(dict(default=0), response['groups'])
+
+    def test_error(self):
+        self.assertEquals(dict(error='No such group'),
+            self.request('{"command": "scale", "group": "unknown"}'))
+        response = self.request('{"command": "scale", "group": []}')
+        self.assertTrue('unhashable' in response['error'])
+
+
+class TestReexec(ServerBase):
+
+    def reexec(self):
+        '''Set up the parent as though it executed a new server.'''
+        read_fd, write_fd = os.pipe()
+        fcntl.fcntl(read_fd, fcntl.F_SETFL,
+            fcntl.fcntl(read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.server._reexec_pid = 1234
+        self.server._reexec_ready = read_fd
+        self.server._reexec_timer = self.server._loop.call_later(10, list)
+        self.server._loop.add_reader(read_fd, list)
+        return write_fd
+
+    def test_ready(self):
+        write_fd = self.reexec()
+        self.server._reexec_done(True)
+        self.assertEquals(1234, self.server._reexec_pid)
+        os.write(write_fd, '1')
+        self.server._reexec_done(True)
+        os.close(write_fd)
+        self.assertEquals(None, self.server._reexec_pid)
+        self.assertTrue(self.server._stopping)
+        self.assertEquals([], self.killed)
+
+    def test_not_ready(self):
+        os.close(self.reexec())
+        self.server._reexec_done(True)
+        self.assertEquals(None, self.server._reexec_ready)
+        self.assertFalse(self.server._stopping)
+        self.assertEquals([(1234, signal.SIGTERM)], self.killed)
+        write_fd = self.reexec()
+        self.server._reexec_done(False)
+        os.close(write_fd)
+        self.assertFalse(self.server._stopping)
+        self.assertEquals(2, len(self.killed))
+
+    def test_report(self):
+        read_fd, write_fd = os.pipe()
+        self.server._ready_report = write_fd
+        self.server._unreported = 2
+        self.server._reported(True)
+        self.assertEquals(write_fd, self.server._ready_report)
+        self.server._reported(True)
+        self.assertEquals(None, self.server._ready_report)
+        self.assertEquals('1', os.read(read_fd, 2))
+        os.close(read_fd)
+
+    def test_report_not_ready(self):
+        read_fd, write_fd = os.pipe()
+        self.server._ready_report = write_fd
+        self.server._unreported = 2
+        self.server._reported(False)
+        self.server._reported(True)
+        self.assertEquals(None, self.server._ready_report)
+        self.assertEquals('', os.read(read_fd, 1))
+        os.close(read_fd)
+
+
+class TestPreload(ServerBase):
+
+    managed = [Managed]
+
+    def test_preload(self):
+        appended = Managed(None)
+        self.server.managed.append(appended)
+        self.server.preload()
+        self.server.preload()
+        created = self.server.managed[0]
+        self.assertEquals(1, created.preloaded)
+        self.assertEquals(1, appended.preloaded)
+        self.assertTrue(self.load(self.server._reload))
+        self.assertNotEquals(created, self.server.managed[0])
+        self.assertEquals(1, self.server.managed[0].preloaded)
+        self.assertEquals(appended, self.server.managed[1])
+        self.assertEquals(1, appended.preloaded)
+        self.assertEquals(2, len(self.server._preloaded))
+
+
+class TestGroups(ServerBase):
+
+    config = {
+        'clcommon': {
+            'server': {
+                'groups': {
+                    'workers': {
+                        'children': 2,
+                        'nice': 10,
+                        'stop_timeout': 7}}}}}
+    managed = dict(default=[Managed], workers=[Managed, Managed])
+
+    def test_groups(self):
+        groups = self.server._groups
+        self.assertEquals(['default', 'workers'], sorted(groups))
+        self.assertEquals(1, groups['default'].target)
+        self.assertEquals(0, groups['default'].config['nice'])
+        self.assertEquals(3, groups['default'].config['stop_timeout'])
+        self.assertEquals(2, groups['workers'].target)
+        self.assertEquals(10, groups['workers'].config['nice'])
+        self.assertEquals(7, groups['workers'].config['stop_timeout'])
+        self.assertEquals(2, len(self.server.groups['workers']))
+        self.assertTrue(self.server.managed is
+            self.server.groups['default'])
+        self.assertEquals(self.server.config,
+            self.server.managed[0].config)
+
+    def test_unknown_group(self):
+        config = clcommon.config.update(self.config, {
+            'clcommon': {'server': {'groups': {'other': {}}}}})
+        self.assertRaises(ValueError, self.load, clcommon.server.Server,
+            config, managed=self.managed)
+        self.assertRaises(ValueError, self.load, clcommon.server.Server,
+            self.config, managed=[Managed])
+
+    def test_slots(self):
+        default = self.server._groups['default']
+        workers = self.server._groups['workers']
+        self.start_child(default, 0)
+        first = self.start_child(workers, 0)
+        self.start_child(workers, 1)
+        self.assertEquals(1, self.server._count(default))
+        self.assertEquals(2, self.server._count(workers))
+        self.assertEquals(1, self.server._free_slot(default))
+        self.assertEquals(2, self.server._free_slot(workers))
+        self.server._children[first].stopping = True
+        self.assertEquals(1, self.server._count(workers))
+        self.assertEquals(0, self.server._free_slot(workers))
+        self.server._pending[('workers', 0)] = None
+        self.assertEquals(2, self.server._count(workers))
+        self.assertEquals(2, self.server._free_slot(workers))
+        self.assertEquals(1, self.server._count(default))
+
+    def test_scale(self):
+        self.start_child(self.server._groups['default'], 0)
+        self.assertEquals(dict(children=3, group='workers'),
+            self.server._command_scale(None,
+                dict(group='workers', children=3)))
+        self.assertEquals([('default', 0), ('workers', 0), ('workers', 1),
+            ('workers', 2)], self.started)
+        now = time.time()
+        self.assertEquals(dict(children=1, group='workers'),
+            self.server._command_scale(None,
+                dict(group='workers', children=1)))
+        self.assertEquals([(1004, signal.SIGTERM), (1003, signal.SIGTERM)],
+            self.killed)
+        for pid in (1003, 1004):
+            deadline = self.server._children[pid].kill_timer.deadline
+            self.assertTrue(6 < deadline - now < 8)
+        self.assertEquals(1, self.server._groups['default'].target)
+        self.assertEquals(dict(children=1, group='default'),
+            self.server._command_scale(None, dict(children=1)))
+        self.assertEquals(4, len(self.started))
+        self.assertEquals(dict(error='Invalid number of children'),
+            self.server._command_scale(None,
+                dict(group='workers', children=-1)))
+
+
+class TestScale(ServerBase):
+
+    config = {
+        'clcommon': {
+            'server': {
+                'children': 1,
+                'children_max': 3,
+                'children_min': 1}}}
+
+    def setUp(self):
+        ServerBase.setUp(self)
+        self.start_child(self.group, 0)
+        del self.started[:]
+        self.now = 1000
+        self.cpu = {}
+        self.queue = 0
+        self._cpu_time = clcommon.process.cpu_time
+        self._listen_queue = clcommon.process.listen_queue
+        self._listeners = clcommon.server._listeners
+        clcommon.process.cpu_time = lambda pid: self.cpu.get(pid, 0)
+        clcommon.process.listen_queue = lambda sock: (self.queue, 128)
+        clcommon.server._listeners = {'127.0.0.1:8080': None}
+        self.server._scale_group(self.group, self.now)
+
+    def tearDown(self):
+        clcommon.process.cpu_time = self._cpu_time
+        clcommon.process.listen_queue = self._listen_queue
+        clcommon.server._listeners = self._listeners
+        ServerBase.tearDown(self)
+
+    def scale(self, elapsed, cpu=0):
+        '''Run a scaling check after each child used the given share of a
+        CPU for a number of seconds. Returns the children started.'''
+        self.now += elapsed
+        for pid in self.server._children:
+            self.cpu[pid] = self.cpu.get(pid, 0) + cpu * elapsed
+        self.server._scale_group(self.group, self.now)
+        started = self.started[:]
+        del self.started[:]
+        return started
+
+    def stopped(self):
+        '''Get the pids of the children sent SIGTERM since the last
+        call.'''
+        pids = [pid for pid, number in self.killed
+            if number == signal.SIGTERM]
+        del self.killed[:]
+        return pids
+
+    def test_cpu(self):
+        self.assertEquals([('default', 1)], self.scale(10, 0.9))
+        self.assertEquals(2, self.group.target)
+        self.assertEquals([], self.scale(5, 0.9))
+        self.assertEquals([('default', 2)], self.scale(5, 0.9))
+        self.assertEquals([], self.scale(10, 0.9))
+        self.assertEquals(3, self.group.target)
+        self.assertEquals([], self.scale(10, 0.5))
+        self.assertEquals([], self.stopped())
+        self.assertEquals([], self.scale(30, 0.1))
+        self.assertEquals([], self.stopped())
+        self.assertEquals([], self.scale(10, 0.1))
+        self.assertEquals([1003], self.stopped())
+        self.assertEquals(2, self.group.target)
+        self.assertEquals([], self.scale(30, 0.1))
+        self.assertEquals([], self.stopped())
+        self.assertEquals([], self.scale(30, 0.1))
+        self.assertEquals([1002], self.stopped())
+        self.assertEquals([], self.scale(60))
+        self.assertEquals([], self.stopped())
+        self.assertEquals(1, self.group.target)
+
+    def test_queue(self):
+        self.queue = 1
+        self.assertEquals([('default', 1)], self.scale(10))
+        self.assertEquals([('default', 2)], self.scale(10))
+        self.assertEquals([], self.scale(60))
+        self.assertEquals([], self.stopped())
+        self.queue = 0
+        self.assertEquals([], self.scale(10))
+        self.assertEquals([1003], self.stopped())
+
+    def test_busy(self):
+        shared = self.server._shared = clcommon.stats.Shared(3, 3)
+        counters = []
+        for slot in xrange(3):
+            counters.append(clcommon.stats.Counters(['admission_active',
+                'admission_limit', 'admission_queued']))
+            shared.attach(slot, [counters[slot]])
+        child = self.server._children[1001]
+        child.shared = 0
+        child.counter_names = counters[0].names
+        self.assertEquals([], self.scale(10))
+        counters[0]['admission_limit'] = 4
+        counters[0]['admission_active'] = 3
+        self.assertEquals([], self.scale(10))
+        counters[0]['admission_queued'] = 1
+        self.assertEquals([('default', 1)], self.scale(10))
+        child = self.server._children[1002]
+        child.shared = 1
+        child.counter_names = counters[1].names
+        counters[1]['admission_limit'] = 4
+        counters[0]['admission_queued'] = 0
+        self.assertEquals(0.375, self.server._busy(self.group))
+        self.assertEquals([], self.scale(60))
+        self.assertEquals([], self.stopped())
+        counters[0]['admission_active'] = 1
+        self.assertEquals([], self.scale(10))
+        self.assertEquals([1002], self.stopped())
+        self.assertEquals(0.25, self.server._busy(self.group))
+
+
+class TestRoll(ServerBase):
+
+    config = {'clcommon': {'server': {'children': 2}}}
+
+    def setUp(self):
+        ServerBase.setUp(self)
+        for slot in xrange(self.group.target):
+            self.start_child(self.group, slot)
+        del self.started[:]
+
+    def report(self, pid, ready=True):
+        '''Have a child report whether it is ready.'''
+        if ready:
+            os.write(self.ready[pid], '1')
+        else:
+            os.close(self.ready.pop(pid))
+        self.server._child_ready(self.server._children[pid], True)
+
+    def replace(self, pid):
+        '''Have the newest child report it is ready and check that the
+        child in its slot is stopped, and then have that child exit.'''
+        new = max(self.server._children)
+        slot = self.server._children[new].slot
+        self.report(new)
+        self.assertEquals((pid, signal.SIGTERM), self.killed[-1])
+        self.assertEquals(slot, self.server._children[pid].slot)
+        self.server._child_exited(pid, 0)
+
+    def test_roll(self):
+        self.group.target = 3
+        self.server._roll()
+        second = self.server._rolling[0]
+        first = 1001 if second == 1002 else 1002
+        self.replace(first)
+        self.assertEquals([], self.server._rolling)
+        self.assertEquals(2, len(self.started))
+        self.replace(second)
+        self.assertEquals([1003, 1004, 1005], sorted(self.server._children))
+        self.assertEquals([0, 1, 2], sorted(child.slot
+            for child in self.server._children.itervalues()))
+        self.report(1005)
+        self.assertEquals(None, self.server._rolling)
+        self.assertEquals(2, len(self.killed))
+
+    def test_abort(self):
+        self.server._roll()
+        self.assertEquals(1, len(self.server._rolling))
+        self.report(1003, False)
+        self.assertEquals(None, self.server._rolling)
+        self.assertEquals([(1003, signal.SIGTERM)], self.killed)
+        self.server._child_exited(1003, 0)
+        self.assertEquals([1001, 1002], sorted(self.server._children))
+        self.assertEquals(None, self.load(self.server._start_roll))
+        self.assertEquals('Already replacing children',
+            self.server._start_roll())
+
+
+class TestHeartbeats(ServerBase):
+
+    config = {
+        'clcommon': {
+            'server': {
+                'heartbeat_interval': 2,
+                'heartbeat_lag': 0.5,
+                'heartbeat_timeout': 5}}}
+
+    def test_hung(self):
+        shared = self.server._shared = clcommon.stats.Shared(3, 1)
+        for slot in xrange(3):
+            pid = self.start_child(self.group, slot)
+            self.server._children[pid].shared = slot
+        shared.beat(0)
+        self.assertEquals(2, self.server._check_heartbeats())
+        shared.beat(1, 1)
+        self.assertEquals(1, self.server._check_heartbeats())
+        self.assertEquals([(1002, signal.SIGUSR1)], self.killed)
+        shared._values[0][1] -= 10 * 1000000
+        self.server._check_heartbeats()
+        self.assertEquals([(1002, signal.SIGUSR1), (1001, signal.SIGUSR1)],
+            self.killed)
+        self.server._children[1002].hung -= 1
+        self.assertEquals(1, self.server._check_heartbeats())
+        self.assertEquals((1002, signal.SIGKILL), self.killed[-1])
+        self.server._children[1001].hung -= 1
+        self.assertEquals(2, self.server._check_heartbeats())
+        self.assertEquals((1001, signal.SIGKILL), self.killed[-1])
+        self.server._check_heartbeats()
+        self.assertEquals(4, len(self.killed))
+
+    def test_disabled(self):
+        self.server._shared = clcommon.stats.Shared(1, 1)
+        self.server._groups['default'].config = clcommon.config.update(
+            self.group.config, dict(heartbeat_timeout=0))
+        self.assertEquals(None, self.server._check_heartbeats())
@@ -0,0 +1,132 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Tests for craigslist common stats module.'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import clcommon.stats
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentile(self):
+        histogram = clcommon.stats.Histogram()
+        self.assertEquals(0, histogram.percentile(50))
+        for value in xrange(1, 1001):
+            histogram.add(value)
+        self.assertEquals(1000, histogram.count)
+        self.assertEquals(1, histogram.min)
+        self.assertEquals(1000, histogram.max)
+        for percent in [50, 90, 99]:
+            value = histogram.percentile(percent)
+            self.assertTrue(percent * 10 <= value < percent * 10 * 1.2)
+        self.assertEquals(1000, histogram.percentile(100))
+        histogram.add(0.5)
+        self.assertEquals(0.5, histogram.min)
+
+    def test_merge(self):
+        first = clcommon.stats.Histogram()
+        first.add(10)
+        second = clcommon.stats.Histogram()
+        second.add(1000)
+        first.merge(second)
+        first.merge(clcommon.stats.Histogram())
+        self.assertEquals(2, first.count)
+        self.assertEquals(10, first.min)
+        self.assertEquals(1000, first.max)
+        data = clcommon.stats.Histogram.from_dict(first.to_dict()).to_dict()
+        self.assertEquals(first.to_dict(), data)
+
+
+class TestCounters(unittest.TestCase):
+
+    def test_counters(self):
+        counters = clcommon.stats.Counters(['a', 'b'])
+        counters['a'] += 2
+        counters['b'] -= 1
+        self.assertEquals(dict(a=2, b=-1), dict(counters))
+        self.assertTrue('a' in counters)
+        self.assertEquals(None, counters.get('c'))
+        self.assertRaises(KeyError, counters.__getitem__, 'c')
+
+    def test_shared(self):
+        shared = clcommon.stats.Shared(2, 3)
+        first = clcommon.stats.Counters(['a', 'b'])
+        first['a'] = 5
+        second = clcommon.stats.Counters(['a'])
+        shared.attach(1, [first, second])
+        self.assertEquals(os.getpid(), shared.pid(1))
+        self.assertEquals(0, shared.pid(0))
+        first['a'] += 1
+        second['a'] += 10
+        first['b'] += 1
+        self.assertEquals(dict(a=16, b=1), shared.read(1, ['a', 'b', 'a']))
+        shared.clear(1)
+        self.assertEquals(0, shared.pid(1))
+        self.assertEquals(dict(a=0, b=0), shared.read(1, ['a', 'b', 'a']))
+
+    def test_heartbeat(self):
+        shared = clcommon.stats.Shared(1, 1)
+        self.assertEquals((0, 0), shared.heartbeat(0))
+        now = time.time()
+        shared.beat(0, 0.25)
+        beat, lag = shared.heartbeat(0)
+        self.assertTrue(now - 1 < beat < now + 1)
+        self.assertEquals(0.25, lag)
+
+    def test_shared_full(self):
+        shared = clcommon.stats.Shared(1, 1)
+        self.assertRaises(ValueError, shared.attach, 0,
+            [clcommon.stats.Counters(['a', 'b'])])
+        self.assertEquals(dict(a=0), shared.read(0, ['a', 'b']))
+
+
+class TestStats(unittest.TestCase):
+
+    def test_merge(self):
+        histogram = clcommon.stats.Histogram()
+        histogram.add(5)
+        stats = dict(a=1, b=dict(c=2.5, d=histogram.to_dict()), e='x',
+            f=True)
+        total = clcommon.stats.merge({}, stats)
+        total = clcommon.stats.merge(total, stats)
+        self.assertEquals(2, total['a'])
+        self.assertEquals(5.0, total['b']['c'])
+        self.assertEquals(2, total['b']['d']['count'])
+        self.assertFalse('e' in total)
+        self.assertFalse('f' in total)
+
+    def test_load_dir(self):
+        stats_dir = tempfile.mkdtemp()
+        try:
+            clcommon.stats.save(stats_dir, dict(a=1))
+            clcommon.stats.save(stats_dir, dict(a=2), os.getppid())
+            # Larger than the maximum pid_max, so never a running process.
+            clcommon.stats.save(stats_dir, dict(a=4), 2 ** 22 + 1)
+            open(os.path.join(stats_dir, 'merged.json'), 'w').write('{}')
+            self.assertEquals(dict(a=3, processes=2),
+                clcommon.stats.load_dir(stats_dir))
+            self.assertEquals(3, len(os.listdir(stats_dir)))
+            os.unlink(os.path.join(stats_dir, 'merged.json'))
+            clcommon.stats.remove(stats_dir)
+            clcommon.stats.remove(stats_dir)
+            self.assertEquals(dict(a=2, processes=1),
+                clcommon.stats.load_dir(stats_dir))
+        finally:
+            shutil.rmtree(stats_dir)